@@ -0,0 +1,155 @@
+###############################################################################
+#
+#  Carelink ambulatory glucose profile (AGP)
+#
+#  Description:
+#
+#    This module computes ambulatory glucose profiles from sensor glucose
+#    readings: the 5/25/50/75/95 percentiles of the readings per time of
+#    day bucket (15 minutes by default) over the last days (14 by default).
+#
+#    The readings are given as series, i.e. a pair of arrays with the
+#    timestamps (epoch seconds) and the glucose values. Series can be
+#    taken from the Carelink data or from the history store.
+#
+#    All buckets of all series are computed with NumPy in one vectorized
+#    pass (sort by bucket and value, then interpolate the percentiles at
+#    the bucket offsets), so profiles of many patients can be computed
+#    at once with agp_batch().
+#
+#    Usage:
+#
+#      store = carelink_history.HistoryStore("history.db")
+#      profile = carelink_agp.agp(*carelink_agp.series_from_history(store))
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import time
+import numpy as np
+import carelink_history
+
+
+# Profile settings
+BUCKET      = 900
+DAYS        = 14
+PERCENTILES = carelink_history.ROLLUP_PERCENTILES
+
+SECONDS_PER_DAY = 86400
+
+
+###########################################################
+# Get series (timestamps, values) from Carelink data
+###########################################################
+def series_from_data(data):
+   readings = [ (r.timestamp, r.sg) for r in carelink_history.iter_sgs(data) if r.sg ]
+   return series_from_rows(readings)
+
+
+###########################################################
+# Get series (timestamps, values) from the history store
+# (default: last DAYS days)
+###########################################################
+def series_from_history(store, start=None, end=None, days=DAYS):
+   if end is None:
+      end = store.time_range()[1]
+      end = int(time.time()) if end is None else end + 1
+   if start is None:
+      start = end - days * SECONDS_PER_DAY
+   return series_from_rows(store.query("sgs", start, end, ["timestamp", "sg"]))
+
+
+###########################################################
+# Get series (timestamps, values) from rows (timestamp, sg)
+###########################################################
+def series_from_rows(rows):
+   a = np.array(list(rows), dtype=np.float64).reshape(-1, 2)
+   return a[:,0].astype(np.int64), a[:,1]
+
+
+###########################################################
+# Compute the profiles of many series at once
+# series: list of (timestamps, values)
+# Each profile covers the last days before the latest
+# reading of its series. utc_offset (seconds) shifts the
+# timestamps to the patient's local time of day.
+# Returns list of profiles (dict, see agp())
+###########################################################
+def agp_batch(series, days=DAYS, bucket=BUCKET, utc_offset=0):
+   nbuckets = SECONDS_PER_DAY // bucket
+
+   # Valid readings of the covered time range, tagged with their
+   # global bucket index (series number * nbuckets + time of day bucket)
+   index, values, ranges = [], [], []
+   for i, (ts, sg) in enumerate(series):
+      ts = np.asarray(ts, dtype=np.int64)
+      sg = np.asarray(sg, dtype=np.float64)
+      valid = sg > 0
+      if valid.any():
+         end = ts[valid].max()
+         valid &= ts > end - days * SECONDS_PER_DAY
+      ts, sg = ts[valid], sg[valid]
+      index.append(i * nbuckets + ((ts + utc_offset) % SECONDS_PER_DAY) // bucket)
+      values.append(sg)
+      ranges.append((int(ts.min()), int(ts.max())) if len(ts) else (None, None))
+   index = np.concatenate(index) if index else np.zeros(0, dtype=np.int64)
+   values = np.concatenate(values) if values else np.zeros(0)
+
+   # Sort by bucket, then by value
+   order = np.lexsort((values, index))
+   values = values[order]
+   counts = np.bincount(index, minlength=len(series) * nbuckets)
+   starts = np.cumsum(counts) - counts
+
+   # Percentiles by linear interpolation between the closest ranks
+   # (same as carelink_history.percentile()), empty buckets are NaN
+   last = np.maximum(counts - 1, 0)
+   pos = last[:,None] * (np.array(PERCENTILES) / 100.0)[None,:]
+   lo = np.floor(pos).astype(np.int64)
+   hi = np.minimum(lo + 1, last[:,None])
+   if len(values):
+      vlo = values[np.minimum(starts[:,None] + lo, len(values) - 1)]
+      vhi = values[np.minimum(starts[:,None] + hi, len(values) - 1)]
+      bands = vlo + (vhi - vlo) * (pos - lo)
+   else:
+      bands = np.zeros(pos.shape)
+   bands[counts == 0] = np.nan
+   bands = np.round(bands, 1).reshape(len(series), nbuckets, len(PERCENTILES))
+   counts = counts.reshape(len(series), nbuckets)
+
+   tod = (np.arange(nbuckets) * bucket).tolist()
+   profiles = []
+   for i in range(len(series)):
+      start, end = ranges[i]
+      profile = {
+         "from":   start,
+         "to":     end,
+         "days":   days,
+         "bucket": bucket,
+         "count":  int(counts[i].sum()),
+         "time":   tod,
+         "counts": counts[i].tolist(),
+         }
+      for j, q in enumerate(PERCENTILES):
+         profile["p%d" % q] = [ None if np.isnan(v) else v for v in bands[i,:,j].tolist() ]
+      profiles.append(profile)
+   return profiles
+
+
+###########################################################
+# Compute the profile of one series
+# Returns dict with the covered time range (from, to),
+# days, bucket size, total count and per bucket lists:
+# time (seconds since midnight), counts, p5 ... p95
+###########################################################
+def agp(timestamps, values, days=DAYS, bucket=BUCKET, utc_offset=0):
+   return agp_batch([(timestamps, values)], days, bucket, utc_offset)[0]
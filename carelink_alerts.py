@@ -0,0 +1,281 @@
+###############################################################################
+#
+#  Carelink alert engine
+#
+#  Description:
+#
+#    This module evaluates alert rules on each new Carelink data update.
+#    The rules are configured declaratively (e.g. in a JSON file) and
+#    compiled once into predicates. Each rule has one of these sources:
+#
+#    - "field": value at a path in the patient data, e.g. "lastSG.sg"
+#    - "rate":  glucose rate of change (mg/dL per minute) over the given
+#               number of minutes
+#    - "age":   minutes since the last data update of the pump/phone
+#    - "notifications": active pump notifications (see below)
+#
+#    and a threshold "below" or "above". An alert fires when the value
+#    crosses the threshold and clears only when it crosses back over the
+#    "clear" level (hysteresis, default: the threshold). While an alert is
+#    active it is not fired again, unless "repeat" (minutes) is given.
+#    Values in "ignore" (default for fields [0], no reading) leave the
+#    state unchanged.
+#
+#    Notification rules fire once for each new active pump notification
+#    (optionally only for the message ids in "messages").
+#
+#    Example rules:
+#
+#      [
+#        { "name": "urgent low",   "field": "lastSG.sg", "below": 55, "clear": 70 },
+#        { "name": "high",         "field": "lastSG.sg", "above": 250, "clear": 230, "repeat": 60 },
+#        { "name": "falling fast", "rate": 15, "below": -3, "clear": -1 },
+#        { "name": "stale data",   "age": true, "above": 20 },
+#        { "name": "pump",         "notifications": true }
+#      ]
+#
+#    Each fired or cleared alert is passed as event (dict) to the notify
+#    function of the engine.
+#
+#    Age rules also need to be evaluated when no new data arrives (e.g.
+#    while the Carelink Cloud is not reachable): check_timed() evaluates
+#    them on the last data, it should be called periodically.
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#    19/10/2026 - Evaluate age rules without new data (check_timed)
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import time
+import json
+import threading
+import carelink_history
+import logging as log
+from datetime import datetime, timezone
+
+
+# Event states
+FIRING  = "firing"
+CLEARED = "cleared"
+
+# Rule defaults
+DEFAULT_IGNORE = [0]
+RATE_MAX_GAP   = 2   # max gap between readings (in rate windows) for rate rules
+
+
+###########################################################
+# Compile a field path into a getter function
+###########################################################
+def compile_path(path):
+   keys = path.split(".")
+   def get(obj):
+      for key in keys:
+         if isinstance(obj, dict):
+            obj = obj.get(key)
+         elif isinstance(obj, list) and key.lstrip("-").isdigit() and obj:
+            try:
+               obj = obj[int(key)]
+            except IndexError:
+               return None
+         else:
+            return None
+      return obj
+   return get
+
+
+###########################################################
+# Compile the rate of change (mg/dL per minute) between the
+# latest reading and the reading the given minutes before
+###########################################################
+def compile_rate(minutes):
+   window = minutes * 60
+   def get(patient_data):
+      latest = None
+      for r in reversed(list(carelink_history.iter_sgs(patient_data))):
+         if not r.sg or r.sg <= 0:
+            continue
+         if latest is None:
+            latest = r
+         elif latest.timestamp - r.timestamp >= window:
+            if latest.timestamp - r.timestamp > window * RATE_MAX_GAP:
+               return None
+            return (latest.sg - r.sg) * 60.0 / (latest.timestamp - r.timestamp)
+      return None
+   return get
+
+
+###########################################################
+# Compile the data age (minutes since last update)
+###########################################################
+def compile_age(clock):
+   def get(patient_data):
+      update_time = patient_data.get("lastConduitUpdateServerTime")
+      if not update_time:
+         return None
+      return (clock() - update_time / 1000.0) / 60.0
+   return get
+
+
+###########################################################
+# Class ThresholdRule
+###########################################################
+class ThresholdRule(object):
+
+   def __init__(self, config, clock):
+      self.name = config["name"]
+      if "field" in config:
+         self.probe = compile_path(config["field"])
+      elif "rate" in config:
+         self.probe = compile_rate(float(config["rate"]))
+      elif "age" in config:
+         self.probe = compile_age(clock)
+      else:
+         raise ValueError("rule %s: one of field, rate, age or notifications required" % self.name)
+
+      if "below" in config:
+         threshold = float(config["below"])
+         clear = float(config.get("clear", threshold))
+         self.trigger = lambda v: v < threshold
+         self.release = lambda v: v >= clear
+      elif "above" in config:
+         threshold = float(config["above"])
+         clear = float(config.get("clear", threshold))
+         self.trigger = lambda v: v > threshold
+         self.release = lambda v: v <= clear
+      else:
+         raise ValueError("rule %s: below or above required" % self.name)
+
+      self.ignore = config.get("ignore", DEFAULT_IGNORE if "field" in config else [])
+      self.repeat = float(config["repeat"]) * 60 if "repeat" in config else None
+      self.message = config.get("message", self.name)
+      self.clock = clock
+      self.active = False
+      self.fired_at = None
+      # Value changes with time, not only with new data
+      self.timed = "age" in config
+
+   ###########################################################
+   # Evaluate rule, returns list of events
+   ###########################################################
+   def evaluate(self, patient_data):
+      value = self.probe(patient_data)
+      if value is None or value in self.ignore:
+         return []
+      now = self.clock()
+      if not self.active:
+         if self.trigger(value):
+            self.active, self.fired_at = True, now
+            return [(FIRING, value)]
+      elif self.release(value):
+         self.active = False
+         return [(CLEARED, value)]
+      elif self.repeat is not None and now - self.fired_at >= self.repeat:
+         self.fired_at = now
+         return [(FIRING, value)]
+      return []
+
+
+###########################################################
+# Class NotificationRule
+###########################################################
+class NotificationRule(object):
+
+   def __init__(self, config, clock):
+      self.name = config["name"]
+      self.messages = set(config["messages"]) if "messages" in config else None
+      self.message = config.get("message", self.name)
+      self.active = set()
+      self.timed = False
+
+   @staticmethod
+   def key(notification):
+      for k in ["referenceGUID", "instanceId"]:
+         if notification.get(k) is not None:
+            return notification[k]
+      return (notification.get("messageId"), notification.get("dateTime"))
+
+   def evaluate(self, patient_data):
+      history = patient_data.get("notificationHistory") or {}
+      current = {}
+      for n in history.get("activeNotifications") or []:
+         if self.messages is None or n.get("messageId") in self.messages or n.get("faultId") in self.messages:
+            current[self.key(n)] = n
+      # Fire only for notifications which were not active before
+      events = [ (FIRING, n) for k, n in current.items() if k not in self.active ]
+      self.active = set(current)
+      return events
+
+
+###########################################################
+# Compile a rule from its configuration
+###########################################################
+def compile_rule(config, clock=time.time):
+   if "name" not in config:
+      raise ValueError("rule without name: %s" % json.dumps(config))
+   if config.get("notifications"):
+      return NotificationRule(config, clock)
+   return ThresholdRule(config, clock)
+
+
+###########################################################
+# Load rules from JSON file
+###########################################################
+def load_rules(filename):
+   with open(filename, "r") as f:
+      return json.load(f)
+
+
+###########################################################
+# Class AlertEngine
+###########################################################
+class AlertEngine(object):
+
+   def __init__(self, rules, notify=None, clock=time.time):
+      self.__rules = [ compile_rule(r, clock) for r in rules ]
+      self.__notify = notify
+      self.__clock = clock
+      self.__last = None
+      self.__lock = threading.Lock()
+
+   ###########################################################
+   # Evaluate all rules on new data, returns list of events
+   ###########################################################
+   def evaluate(self, data):
+      with self.__lock:
+         self.__last = carelink_history.get_patient_data(data)
+         return self._evaluate(self.__rules, self.__last)
+
+   ###########################################################
+   # Evaluate the time dependent rules (age) on the last data,
+   # returns list of events
+   ###########################################################
+   def check_timed(self):
+      with self.__lock:
+         if self.__last is None:
+            return []
+         return self._evaluate([ r for r in self.__rules if r.timed ], self.__last)
+
+   def _evaluate(self, rules, patient_data):
+      now = datetime.fromtimestamp(self.__clock(), timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+      events = []
+      for rule in rules:
+         try:
+            results = rule.evaluate(patient_data)
+         except Exception as e:
+            log.error("ERROR: alert rule %s failed (%s)" % (rule.name, e))
+            continue
+         for state, value in results:
+            events.append({ "rule": rule.name, "state": state, "value": value, "message": rule.message, "time": now })
+      for event in events:
+         log.info("Alert %s: %s (%s)" % (event["state"], event["message"], event["value"]))
+         if self.__notify is not None:
+            self.__notify(event)
+      return events
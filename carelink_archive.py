@@ -0,0 +1,330 @@
+###############################################################################
+#
+#  Carelink archive
+#
+#  Description:
+#
+#    This module archives Carelink data snapshots compactly. Each snapshot
+#    is appended as one compact JSON line to a compressed stream (segment)
+#    in the archive directory. Segments are rotated by size and age.
+#
+#    Every snapshot is compressed separately (one gzip member or zstd frame
+#    per line, which together form a valid .jsonl.gz/.jsonl.zst file), so a
+#    reader can decompress any snapshot on its own. Next to each segment an
+#    index file holds one text line per snapshot:
+#
+#      <snapshot time (epoch seconds)> <offset> <length>
+#
+#    With the index a reader seeks directly to the snapshots of a time range
+#    without decompressing the rest of the archive. Snapshots without new
+#    data (same update time as the previous one) are not appended. A lost
+#    index file is rebuilt by scanning the compressed snapshots of the
+#    segment.
+#
+#    zstd compression requires the zstandard module, gzip is the default.
+#
+#    Usage:
+#
+#      archive = carelink_archive.ArchiveWriter("archive")
+#      archive.append(client.getRecentData())
+#
+#      reader = carelink_archive.ArchiveReader("archive")
+#      for ts, data in reader.read(start=time.time()-86400):
+#         print(ts, data["patientData"]["lastSG"])
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#    19/10/2026 - Rebuild missing segment index instead of truncating
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import os
+import time
+import json
+import gzip
+import zlib
+import bisect
+import logging as log
+from datetime import datetime
+try:
+   import zstandard
+except ImportError:
+   zstandard = None
+
+
+# Compression
+GZIP = "gzip"
+ZSTD = "zstd"
+EXTENSIONS = { GZIP: ".jsonl.gz", ZSTD: ".jsonl.zst" }
+GZIP_LEVEL = 9
+ZSTD_LEVEL = 10
+
+# Rotation defaults
+MAX_SIZE = 64 * 1024 * 1024
+MAX_AGE  = 24 * 3600
+
+# File names
+SEGMENT_PREFIX = "carelink-"
+INDEX_SUFFIX   = ".idx"
+
+# Read size when scanning a segment
+SCAN_CHUNK = 64 * 1024
+
+
+###########################################################
+# Get the time of a snapshot (last update from the pump,
+# None if unknown)
+###########################################################
+def snapshot_time(data):
+   for source in [data, (data or {}).get("patientData")]:
+      try:
+         return int(source["lastConduitUpdateServerTime"] / 1000)
+      except (KeyError, TypeError):
+         pass
+   return None
+
+
+def compress(line, compression):
+   if compression == ZSTD:
+      return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(line)
+   return gzip.compress(line, compresslevel=GZIP_LEVEL)
+
+
+def decompress(block, compression):
+   if compression == ZSTD:
+      return zstandard.ZstdDecompressor().decompress(block)
+   return gzip.decompress(block)
+
+
+def decompressor(compression):
+   if compression == ZSTD:
+      return zstandard.ZstdDecompressor().decompressobj()
+   return zlib.decompressobj(wbits=31)
+
+
+###########################################################
+# Get compression of a segment from its file name
+###########################################################
+def segment_compression(filename):
+   for compression, ext in EXTENSIONS.items():
+      if filename.endswith(ext):
+         return compression
+   return None
+
+
+###########################################################
+# Read segment index: list of (time, offset, length)
+###########################################################
+def read_index(filename):
+   entries = []
+   try:
+      with open(filename, "r") as f:
+         for line in f:
+            try:
+               ts, offset, length = [ int(v) for v in line.split() ]
+            except ValueError:
+               # Incomplete last line (interrupted write)
+               break
+            entries.append((ts, offset, length))
+   except FileNotFoundError:
+      pass
+   return entries
+
+
+###########################################################
+# Scan segment for its snapshots (one compressed member or
+# frame each)
+# Returns (list of (time, offset, length), bytes scanned),
+# the scan stops at the first incomplete or invalid snapshot
+###########################################################
+def scan_segment(filename, compression):
+   entries = []
+   offset = 0
+   with open(filename, "rb") as f:
+      while True:
+         f.seek(offset)
+         d = decompressor(compression)
+         line = b""
+         length = 0
+         try:
+            while not d.eof:
+               chunk = f.read(SCAN_CHUNK)
+               if not chunk:
+                  return entries, offset
+               line += d.decompress(chunk)
+               length += len(chunk) - len(d.unused_data)
+            data = json.loads(line)
+         except Exception as e:
+            # zlib.error, zstandard.ZstdError, ValueError (JSON) or
+            # AttributeError (zstandard version without eof)
+            log.debug("archive: scan of %s stopped at %d (%s)" % (filename, offset, e))
+            return entries, offset
+         ts = snapshot_time(data)
+         if ts is None:
+            ts = entries[-1][0] if entries else int(os.path.getmtime(filename))
+         entries.append((ts, offset, length))
+         offset += length
+
+
+###########################################################
+# Write segment index (atomically)
+###########################################################
+def write_index(filename, entries):
+   tmp = filename + ".tmp"
+   with open(tmp, "w") as f:
+      for entry in entries:
+         f.write("%d %d %d\n" % entry)
+      f.flush()
+      os.fsync(f.fileno())
+   os.replace(tmp, filename)
+
+
+###########################################################
+# Class ArchiveWriter
+###########################################################
+class ArchiveWriter(object):
+
+   def __init__(self, directory, compression=GZIP, max_size=MAX_SIZE, max_age=MAX_AGE, clock=time.time):
+      if compression not in EXTENSIONS:
+         raise ValueError("unknown compression %s" % compression)
+      if compression == ZSTD and zstandard is None:
+         raise Exception("ERROR: zstd compression requires the zstandard module")
+      self.directory = directory
+      self.compression = compression
+      self.max_size = max_size
+      self.max_age = max_age
+      self.__clock = clock
+      self.__segment = None
+      self.__created = None
+      self.__size = 0
+      self.__last_time = None
+      os.makedirs(directory, exist_ok=True)
+      self._resume()
+
+   ###########################################################
+   # Continue the latest segment of the archive
+   ###########################################################
+   def _resume(self):
+      ext = EXTENSIONS[self.compression]
+      segments = sorted(f for f in os.listdir(self.directory) if f.startswith(SEGMENT_PREFIX) and f.endswith(ext))
+      if not segments:
+         return
+      self.__segment = os.path.join(self.directory, segments[-1])
+      try:
+         self.__created = datetime.strptime(segments[-1][len(SEGMENT_PREFIX):-len(ext)], "%Y%m%d_%H%M%S").timestamp()
+      except ValueError:
+         self.__created = os.path.getmtime(self.__segment)
+      entries = read_index(self.__segment + INDEX_SUFFIX)
+      size = os.path.getsize(self.__segment)
+      if not entries and size > 0:
+         # Index lost: rebuild it from the snapshots in the segment
+         entries, scanned = scan_segment(self.__segment, self.compression)
+         if entries:
+            write_index(self.__segment + INDEX_SUFFIX, entries)
+            log.warning("WARNING: rebuilt index of archive segment %s (%d snapshots)" % (self.__segment, len(entries)))
+         if scanned < size:
+            # Not fully readable: leave it alone, continue in a new segment
+            log.warning("WARNING: archive segment %s is not fully readable, starting new segment" % self.__segment)
+            self.__segment = None
+            self.__last_time = entries[-1][0] if entries else None
+            return
+      self.__size = entries[-1][1] + entries[-1][2] if entries else 0
+      self.__last_time = entries[-1][0] if entries else None
+      # Drop data which is not in the index (interrupted write)
+      if entries and size > self.__size:
+         log.warning("WARNING: truncating incomplete archive segment %s" % self.__segment)
+         os.truncate(self.__segment, self.__size)
+
+   def _rotate(self, now):
+      # Segment names must be unique and sort by time
+      created = int(now)
+      while True:
+         name = SEGMENT_PREFIX + datetime.fromtimestamp(created).strftime("%Y%m%d_%H%M%S") + EXTENSIONS[self.compression]
+         if not os.path.exists(os.path.join(self.directory, name)):
+            break
+         created += 1
+      self.__segment = os.path.join(self.directory, name)
+      self.__created = now
+      self.__size = 0
+      log.debug("archive: new segment %s" % name)
+
+   ###########################################################
+   # Append snapshot
+   # Returns False if it has no new data
+   ###########################################################
+   def append(self, data):
+      now = self.__clock()
+      ts = snapshot_time(data)
+      if ts is not None and ts == self.__last_time:
+         return False
+      if ts is None:
+         ts = int(now)
+
+      if self.__segment is None or self.__size >= self.max_size or now - self.__created >= self.max_age:
+         self._rotate(now)
+      block = compress(json.dumps(data, separators=(",",":")).encode() + b"\n", self.compression)
+      with open(self.__segment, "ab") as f:
+         f.write(block)
+         f.flush()
+         os.fsync(f.fileno())
+      # Index line last: a snapshot is archived once it is indexed
+      with open(self.__segment + INDEX_SUFFIX, "a") as f:
+         f.write("%d %d %d\n" % (ts, self.__size, len(block)))
+      self.__size += len(block)
+      self.__last_time = ts
+      return True
+
+
+###########################################################
+# Class ArchiveReader
+###########################################################
+class ArchiveReader(object):
+
+   def __init__(self, directory):
+      self.directory = directory
+      # Index of all segments, sorted by time:
+      # (time, segment file, offset, length)
+      self.entries = []
+      for name in sorted(os.listdir(directory)):
+         if not name.startswith(SEGMENT_PREFIX) or segment_compression(name) is None:
+            continue
+         segment = os.path.join(directory, name)
+         self.entries += [ (ts, segment, offset, length) for ts, offset, length in read_index(segment + INDEX_SUFFIX) ]
+      self.entries.sort(key=lambda e: e[0])
+      self.__times = [ e[0] for e in self.entries ]
+
+   def __len__(self):
+      return len(self.entries)
+
+   def _load(self, entry):
+      ts, segment, offset, length = entry
+      with open(segment, "rb") as f:
+         f.seek(offset)
+         block = f.read(length)
+      return json.loads(decompress(block, segment_compression(segment)))
+
+   ###########################################################
+   # Iterate over (time, snapshot) in the time range
+   ###########################################################
+   def read(self, start=None, end=None):
+      first = 0 if start is None else bisect.bisect_left(self.__times, start)
+      last = len(self.entries) if end is None else bisect.bisect_right(self.__times, end)
+      for entry in self.entries[first:last]:
+         yield entry[0], self._load(entry)
+
+   ###########################################################
+   # Get latest snapshot at or before the given time
+   # Returns (time, snapshot) or (None, None)
+   ###########################################################
+   def at(self, ts):
+      i = bisect.bisect_right(self.__times, ts)
+      if i == 0:
+         return None, None
+      return self.entries[i-1][0], self._load(self.entries[i-1])
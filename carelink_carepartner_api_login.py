@@ -22,6 +22,9 @@
 #
 #    28/12/2023 - Initial version
 #    19/11/2024 - Update discovery_url
+#    19/10/2026 - Capture login redirect with response interceptor and timeout
+#    19/10/2026 - Generate key pair and CSR during the login steps, step timing
+#    19/10/2026 - Fail right away on login redirect without code
 #
 #
 #  Dependencies:
@@ -41,10 +44,12 @@ import os
 import random
 import re
 import string
+import threading
+import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor
 from http.client import HTTPConnection
 import secrets
-from time import sleep
 import requests
 
 import curlify
@@ -91,6 +96,22 @@ def create_csr(keypair, cn, ou, dc, o):
 	csr = OpenSSL.crypto.dump_certificate_request(OpenSSL.crypto.FILETYPE_PEM, req)
 	return csr
 
+def generate_csr(cn, ou, dc, o):
+	start = time.monotonic()
+	keypair = OpenSSL.crypto.PKey()
+
+	# ignoring sso_config['mag']['mobile_sdk']['client_cert_rsa_keybits'], due to the app clamps the minimum size:
+	#    if (i < 2048) 
+	#       i = 2048;
+	keypair.generate_key(OpenSSL.crypto.TYPE_RSA, rsa_keysize)
+	csr = create_csr(keypair, cn, ou, dc, o)
+	return reformat_csr(csr), time.monotonic() - start
+
+def print_step_time(step, start):
+	now = time.monotonic()
+	print(f"{step}: {now - start:.2f}s")
+	return now
+
 def reformat_csr(csr):
 	# remove footer & header, re-encode with url safe base64
 	csr = csr.decode()
@@ -102,24 +123,43 @@ def reformat_csr(csr):
 	csr = base64.urlsafe_b64encode(csr_raw).decode()
 	return csr
 
-def do_captcha(url, redirect_url):
+def do_captcha(url, redirect_url, timeout=None):
 	print("opening Firefox instance...")
 	print("Warning: you may need to close Firefox if it's already running or nothing happens!")
-	driver = webdriver.Firefox()
-	driver.get(url)
-
-	while True:
-		for request in driver.requests:  
-			if request.response:  
-				if request.response.status_code == 302:
-					if "location" in request.response.headers:
-						location = request.response.headers["location"]
-						if redirect_url in location:
-							code = re.search(r"code=(.*)&", location).group(1)
-							state = re.search(r"state=(.*)", location).group(1)
-							driver.quit()
-							return (code, state)
-		sleep(0.1)
+	captured = {}
+	redirected = threading.Event()
+
+	# called by selenium-wire (in its proxy thread) for each response,
+	# the first redirect to the app's redirect url ends the login
+	def interceptor(request, response):
+		if redirected.is_set() or response.status_code != 302:
+			return
+		location = response.headers.get("location")
+		if location is None or redirect_url not in location:
+			return
+		code = re.search(r"code=(.*)&", location)
+		state = re.search(r"state=(.*)", location)
+		if code is None or state is None:
+			# e.g. error=access_denied, raised in do_captcha (not in this thread)
+			error = re.search(r"error=([^&]*)", location)
+			captured["error"] = f"login failed: {error.group(1) if error else 'no code in redirect'}"
+		else:
+			captured["code"] = code.group(1)
+			captured["state"] = state.group(1)
+		redirected.set()
+
+	# keep only a few captured requests, they are not scanned anymore
+	driver = webdriver.Firefox(seleniumwire_options={"request_storage": "memory", "request_storage_max_size": 100})
+	driver.response_interceptor = interceptor
+	try:
+		driver.get(url)
+		if not redirected.wait(timeout):
+			raise Exception(f"login not completed within {timeout}s")
+	finally:
+		driver.quit()
+	if "error" in captured:
+		raise Exception(captured["error"])
+	return (captured["code"], captured["state"])
 
 def resolve_endpoint_config(discovery_url, is_us_region=False):
 	discover_resp = json.loads(requests.get(discovery_url).text)
@@ -145,6 +185,17 @@ def write_datafile(obj, filename):
 
 def do_login(endpoint_config):
 	sso_config, api_base_url = endpoint_config
+	login_start = step_start = time.monotonic()
+
+	# the key pair and CSR for the registration (step 4) are generated
+	# in the background while the network and captcha steps run
+	register_device_id = random_device_id()
+	android_model = random_android_model()
+	android_model_safe = re.sub(r"[^a-zA-Z0-9]", "", android_model)
+	keygen = ThreadPoolExecutor(max_workers=1)
+	csr_future = keygen.submit(generate_csr, "socialLogin", register_device_id, android_model_safe, sso_config["oauth"]["client"]["organization"])
+	keygen.shutdown(wait=False)
+
 	# step 1 initialize
 	data = {
 		'client_id': sso_config['oauth']['client']['client_ids'][0]['client_id'],
@@ -156,6 +207,7 @@ def do_login(endpoint_config):
 	client_init_url = api_base_url + sso_config["mag"]["system_endpoints"]["client_credential_init_endpoint_path"]
 	client_init_req = requests.post(client_init_url, data=data, headers=headers)
 	client_init_response = json.loads(client_init_req.text)
+	step_start = print_step_time("step 1 initialize", step_start)
 
 	# step 2 authorize
 	client_code_verifier = base64.urlsafe_b64encode(os.urandom(40)).decode('utf-8')
@@ -178,25 +230,19 @@ def do_login(endpoint_config):
 	authorize_url = api_base_url + sso_config["oauth"]["system_endpoints"]["authorization_endpoint_path"]
 	providers = json.loads(requests.get(authorize_url, params=auth_params).text) # this will redirect
 	captcha_url = providers["providers"][0]["provider"]["auth_url"]
+	step_start = print_step_time("step 2 authorize", step_start)
 
 	# step 3 captcha login and consent
 	print(f"captcha url: {captcha_url}")
-	captcha_code, captcha_sso_state = do_captcha(captcha_url, sso_config["oauth"]["client"]["client_ids"][0]['redirect_uri'])
+	captcha_code, captcha_sso_state = do_captcha(captcha_url, sso_config["oauth"]["client"]["client_ids"][0]['redirect_uri'], captcha_timeout)
 	print(f"sso state after captcha: {captcha_sso_state}")
+	step_start = print_step_time("step 3 captcha login", step_start)
 
 	# step 4 registraton
-	register_device_id = random_device_id()
 	client_auth_str = f"{client_init_response['client_id']}:{client_init_response['client_secret']}"
-
-	android_model = random_android_model()
-	android_model_safe = re.sub(r"[^a-zA-Z0-9]", "", android_model)
-	keypair = OpenSSL.crypto.PKey()
-
-	# ignoring sso_config['mag']['mobile_sdk']['client_cert_rsa_keybits'], due to the app clamps the minimum size:
-	#    if (i < 2048) 
-	#       i = 2048;
-	keypair.generate_key(OpenSSL.crypto.TYPE_RSA, rsa_keysize)
-	csr = create_csr(keypair, "socialLogin", register_device_id, android_model_safe, sso_config["oauth"]["client"]["organization"])
+	csr, keygen_time = csr_future.result()
+	print(f"key pair and csr: {keygen_time:.2f}s (in background)")
+	step_start = print_step_time("waiting for key pair and csr", step_start)
 
 	reg_headers = {
 		'device-name': base64.b64encode(android_model.encode()).decode(),
@@ -208,12 +254,12 @@ def do_login(endpoint_config):
 		'device-id': base64.b64encode(register_device_id.encode()).decode(),
 		"redirect-uri": sso_config["oauth"]["client"]["client_ids"][0]['redirect_uri']
 	}
-	csr = reformat_csr(csr)
 	reg_url = api_base_url + sso_config["mag"]["system_endpoints"]["device_register_endpoint_path"]
 	reg_req = requests.post(reg_url, headers=reg_headers, data=csr)
 	if reg_req.status_code != 200:
 		print(f"\n\n{curlify.to_curl(reg_req.request)}")
 		raise Exception(f'Could not register: {json.loads(reg_req.text)["error_description"]}')
+	step_start = print_step_time("step 4 registration", step_start)
 
 	# TODO: step 5 token
 	token_req_url = api_base_url + sso_config["oauth"]["system_endpoints"]["token_endpoint_path"]
@@ -231,6 +277,8 @@ def do_login(endpoint_config):
 	
 	token_data = json.loads(token_req.text)
 	print(f"got token data from server")
+	step_start = print_step_time("step 5 token", step_start)
+	print_step_time("login total", login_start)
 
 	token_data["client_id"] = token_req_data["client_id"]
 	token_data["client_secret"] = token_req_data["client_secret"]
@@ -262,6 +310,7 @@ is_debug = False
 logindata_file = 'logindata.json'
 discovery_url = 'https://clcloud.minimed.eu/connect/carepartner/v11/discover/android/3.2'
 rsa_keysize = 2048
+captcha_timeout = 600
 
 def main(is_us_region):
 	if is_debug:
@@ -279,6 +328,8 @@ def main(is_us_region):
 # Parse command line
 parser = argparse.ArgumentParser()
 parser.add_argument('--us', help='Specify US region', default=False, action='store_true')
+parser.add_argument('--timeout', type=int, help=f'Seconds to complete the login in the browser (default: {captcha_timeout})', default=captcha_timeout)
 args = parser.parse_args()
+captcha_timeout = args.timeout
 
 main(args.us)
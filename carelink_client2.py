@@ -16,8 +16,16 @@
 #    28/12/2023 - Initial version
 #    11/04/2024 - Check for valid data in API response in _get_data()
 #    19/11/2024 - Update CARELINK_CONFIG_URL
+#    19/10/2026 - Add pluggable HTTP client (record/replay support)
+#    19/10/2026 - Add refreshToken() and getTokenExpiry() (fleet scheduling)
+#    19/10/2026 - Add warm start from session state file
+#    19/10/2026 - Parallel (speculative) requests in cold start init
+#    19/10/2026 - Correct token validity for local clock skew (server Date)
+#    19/10/2026 - Add config cache shared by client instances (batch mode)
+#    19/10/2026 - Don't write token file when replaying recorded responses
+#    19/10/2026 - Cache only valid discovery and SSO config
 #
-#  Copyright 2023-2024, Ondrej Wisniewski 
+#  Copyright 2023-2026, Ondrej Wisniewski 
 #
 ###############################################################################
 
@@ -48,8 +56,11 @@ import requests
 import time
 import base64
 import os
+import threading
 import logging as log
 from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
 
  
 # Version string
@@ -57,6 +68,9 @@ VERSION = "1.2"
 
 # Constants
 DEFAULT_FILENAME="logindata.json"
+STATE_VERSION = 1
+STATE_MAX_AGE = 24 * 3600
+CLOCK_SKEW_LOG = 10
 CARELINK_CONFIG_URL = "https://clcloud.minimed.eu/connect/carepartner/v11/discover/android/3.2"
 AUTH_ERROR_CODES = [401,403]
 COMMON_HEADERS = {
@@ -70,22 +84,60 @@ FORMAT = '[%(asctime)s:%(levelname)s] %(message)s'
 log.basicConfig(format=FORMAT, datefmt='%Y-%m-%d %H:%M:%S', level=log.INFO)
 
 
+###########################################################
+# Class ConfigCache
+#
+# Discovery and SSO config shared by many client instances
+# (thread safe, each entry is fetched only once)
+###########################################################
+class ConfigCache(object):
+
+   def __init__(self):
+      self.__entries = {}
+      self.__keyLocks = {}
+      self.__lock = threading.Lock()
+      # Clock skew estimated by the last client
+      self.clockSkew = None
+
+   def get(self, key, fetch):
+      with self.__lock:
+         if key in self.__entries:
+            return self.__entries[key]
+         keyLock = self.__keyLocks.setdefault(key, threading.Lock())
+      with keyLock:
+         with self.__lock:
+            if key in self.__entries:
+               return self.__entries[key]
+         value = fetch()
+         with self.__lock:
+            self.__entries[key] = value
+      return value
+
+
 ###########################################################
 # Class CareLinkClient
 ###########################################################
 class CareLinkClient(object):
    
-   def __init__(self, tokenFile=DEFAULT_FILENAME):
+   def __init__(self, tokenFile=DEFAULT_FILENAME, httpClient=None, stateFile=None, configCache=None):
       
       self.__version = VERSION
       
+      # HTTP client (requests module or any object providing
+      # get() and post(), e.g. carelink_replay.ReplaySession)
+      self.__httpClient = requests if httpClient is None else httpClient
+      # Recorded responses (replay) have redacted tokens
+      self.__recorded = getattr(httpClient, "recorded", False)
+      
       # Authorization
       self.__tokenFile = tokenFile
       self.__tokenData = None
       self.__accessTokenPayload = None
       
-      # API config
+      # API config (configCache: ConfigCache shared with other
+      # client instances, optional)
       self.__config = None
+      self.__configCache = configCache
       
       # User info
       self.__username = None
@@ -96,6 +148,15 @@ class CareLinkClient(object):
       # API status
       self.__last_api_status = None
       
+      # Clock skew (server time - local time), estimated from the
+      # Date header of the API responses (None = not yet known)
+      self.__clockSkew = None
+      
+      # Session state (config, user, patient) for warm start,
+      # revalidated by the first data request
+      self.__stateFile = stateFile
+      self.__stateValidated = True
+      
    ###########################################################
    # Class internal functions
    ###########################################################
@@ -126,17 +187,144 @@ class CareLinkClient(object):
    ###########################################################
    def _write_token_file(self, obj, filename):
       log.info("_write_token_file()")
+      if self.__recorded:
+         # Don't overwrite the real tokens with redacted ones
+         log.debug("   replay, token file not written")
+         return
       with open(filename, 'w') as f:
          json.dump(obj, f, indent=4)
 
+   ###########################################################
+   # Read session state file (None if missing, outdated or 
+   # not matching the account of the token)
+   ###########################################################
+   def _read_state_file(self, filename, username, country):
+      log.info("_read_state_file()")
+      try:
+         with open(filename, "r") as f:
+            state = json.load(f)
+      except (OSError, json.JSONDecodeError):
+         log.debug("   no valid state file found")
+         return None
+      try:
+         if state["version"] != STATE_VERSION or state["discovery_url"] != CARELINK_CONFIG_URL:
+            log.debug("   state file version mismatch")
+            return None
+         if state["username"] != username or state["country"] != country:
+            log.debug("   state file belongs to other account")
+            return None
+         if time.time() - state["saved"] > STATE_MAX_AGE:
+            log.debug("   state file too old")
+            return None
+         if any(key not in state["config"] for key in ["baseUrlCareLink", "baseUrlCumulus", "token_url"]) or "role" not in state["user"]:
+            raise KeyError("config")
+      except (KeyError, TypeError):
+         log.debug("   state file incomplete")
+         return None
+      return state
+
+   ###########################################################
+   # Write session state file (atomically)
+   ###########################################################
+   def _write_state_file(self, filename):
+      log.info("_write_state_file()")
+      state = {
+         "version":       STATE_VERSION,
+         "saved":         int(time.time()),
+         "discovery_url": CARELINK_CONFIG_URL,
+         "username":      self.__username,
+         "country":       self.__country,
+         "config":        self.__config,
+         "user":          self.__user,
+         "patient":       self.__patient,
+         }
+      try:
+         tmp = filename + ".tmp"
+         with open(tmp, "w") as f:
+            json.dump(state, f, indent=4)
+         os.replace(tmp, filename)
+      except OSError as e:
+         log.error("ERROR: failed to write state file %s (%s)" % (filename, e))
+
+   ###########################################################
+   # Send request to Carelink API (or SSO server) and update
+   # clock skew from the response
+   ###########################################################
+   def _send(self, method, url, **kwargs):
+      if method == "POST":
+         resp = self.__httpClient.post(url=url, **kwargs)
+      else:
+         resp = self.__httpClient.get(url=url, **kwargs)
+      self._update_clock_skew(resp)
+      return resp
+
+   ###########################################################
+   # Update clock skew from the Date header of a response
+   ###########################################################
+   def _update_clock_skew(self, resp):
+      if self.__recorded:
+         # Date of recording time, not of the server clock now
+         return
+      try:
+         server_time = parsedate_to_datetime(resp.headers["Date"]).timestamp()
+      except (KeyError, TypeError, ValueError, AttributeError):
+         return
+      # Date header has 1s resolution, assume the middle of it
+      skew = server_time + 0.5 - time.time()
+      if self.__clockSkew is None or abs(skew - self.__clockSkew) >= CLOCK_SKEW_LOG:
+         if abs(skew) >= CLOCK_SKEW_LOG:
+            log.info("   clock skew %+ds (server time - local time)" % skew)
+      self.__clockSkew = skew
+      if self.__configCache is not None:
+         self.__configCache.clockSkew = skew
+
+   ###########################################################
+   # Get clock skew (own estimate or the one of the shared
+   # config cache, None if not yet known)
+   ###########################################################
+   def _clock_skew(self):
+      if self.__clockSkew is None and self.__configCache is not None:
+         return self.__configCache.clockSkew
+      return self.__clockSkew
+
+   ###########################################################
+   # Get current time on server clock (best estimate)
+   ###########################################################
+   def _server_time(self):
+      return time.time() + (self._clock_skew() or 0)
+
+   ###########################################################
+   # Get entry from the shared config cache (or fetch it)
+   ###########################################################
+   def _cached(self, key, fetch):
+      if self.__configCache is None:
+         return fetch()
+      return self.__configCache.get(key, fetch)
+
    ###########################################################
    # Get Carelink API config
    ###########################################################
    def _get_config(self, discovery_url, country):
       log.info("_get_config()")
-      resp = requests.get(discovery_url)
-      log.debug("   status: %d" % resp.status_code)
-      data = resp.json()
+      config = self._get_discovery(discovery_url, country)
+      return self._get_sso_config(config)
+
+   ###########################################################
+   # Get Carelink API base urls from discovery
+   ###########################################################
+   def _get_discovery(self, discovery_url, country):
+      # Only a valid config is cached (an exception
+      # raised by fetch() is not)
+      def fetch():
+         resp = self._send("GET", discovery_url)
+         log.debug("   status: %d" % resp.status_code)
+         if resp.status_code != 200:
+            raise Exception("ERROR: failed to get discovery config (response code %d)" % resp.status_code)
+         data = resp.json()
+         if not isinstance(data, dict) or "supportedCountries" not in data or "CP" not in data:
+            raise Exception("ERROR: invalid discovery config")
+         return data
+      data = self._cached(("discovery", discovery_url), fetch)
       region = None
       config = None
 
@@ -152,30 +340,44 @@ class CareLinkClient(object):
       
       for c in data["CP"]:
          if c["region"] == region:
-            config = c
+            config = dict(c)
             break
       if config is None:
          raise Exception("ERROR: failed to get config base urls for region %s" % region)
+      return config
 
-      resp = requests.get(config["SSOConfiguration"])
-      log.debug("   status: %d" % resp.status_code)
-      sso_config = resp.json()
-      sso_base_url = f"https://{sso_config['server']['hostname']}:{sso_config['server']['port']}/{sso_config['server']['prefix']}"
-      token_url = sso_base_url + sso_config["oauth"]["system_endpoints"]["token_endpoint_path"]
-      c["token_url"] = token_url
+   ###########################################################
+   # Get token url from SSO config
+   ###########################################################
+   def _get_sso_config(self, config):
+      def fetch():
+         resp = self._send("GET", config["SSOConfiguration"])
+         log.debug("   status: %d" % resp.status_code)
+         if resp.status_code != 200:
+            raise Exception("ERROR: failed to get SSO config (response code %d)" % resp.status_code)
+         sso_config = resp.json()
+         sso_base_url = f"https://{sso_config['server']['hostname']}:{sso_config['server']['port']}/{sso_config['server']['prefix']}"
+         return sso_base_url + sso_config["oauth"]["system_endpoints"]["token_endpoint_path"]
+      config["token_url"] = self._cached(("sso", config["SSOConfiguration"]), fetch)
       return config
    
+   ###########################################################
+   # Send authorized GET request to Carelink API
+   # (thread safe, the common headers are not modified)
+   ###########################################################
+   def _api_get(self, url, token_data):
+      headers = dict(COMMON_HEADERS)
+      headers["mag-identifier"] = token_data["mag-identifier"]
+      headers["Authorization"] = "Bearer " + token_data["access_token"]
+      return self._send("GET", url, headers=headers)
+
    ###########################################################
    # Get user data
    ###########################################################
    def _get_user(self, config, token_data):
       log.info("_get_user()")
-      url = config["baseUrlCareLink"] + "/users/me"
-      headers = COMMON_HEADERS
-      headers["mag-identifier"] = token_data["mag-identifier"]
-      headers["Authorization"] = "Bearer " + token_data["access_token"]
       self.__last_api_status = None
-      resp = requests.get(url=url,headers=headers)
+      resp = self._api_get(config["baseUrlCareLink"] + "/users/me", token_data)
       self.__last_api_status = resp.status_code
       log.debug("   status: %d" % resp.status_code)
       try:
@@ -186,15 +388,19 @@ class CareLinkClient(object):
 
    ###########################################################
    # Get patient data
+   # (from the response of a speculative request, if given)
    ###########################################################
-   def _get_patient(self, config, token_data):
+   def _get_patient(self, config, token_data, speculative=None):
       log.info("_get_patient()")
-      url = config["baseUrlCareLink"] + "/links/patients"
-      headers = COMMON_HEADERS
-      headers["mag-identifier"] = token_data["mag-identifier"]
-      headers["Authorization"] = "Bearer " + token_data["access_token"]
       self.__last_api_status = None
-      resp = requests.get(url=url,headers=headers)
+      resp = None
+      if speculative is not None:
+         try:
+            resp = speculative.result()
+         except Exception as e:
+            log.debug("   speculative request failed (%s)" % e)
+      if resp is None:
+         resp = self._api_get(config["baseUrlCareLink"] + "/links/patients", token_data)
       self.__last_api_status = resp.status_code
       log.debug("   status: %d" % resp.status_code)
       try:
@@ -209,7 +415,7 @@ class CareLinkClient(object):
    def _get_data(self, config, token_data, username, role, patientid):
       log.info("_get_data()")
       url = config["baseUrlCumulus"] + "/display/message"
-      headers = COMMON_HEADERS
+      headers = dict(COMMON_HEADERS)
       headers["mag-identifier"] = token_data["mag-identifier"]
       headers["Authorization"] = "Bearer " + token_data["access_token"]
       data = {}
@@ -224,7 +430,7 @@ class CareLinkClient(object):
       #log.debug("data: %s" % json.dumps(data))
       
       self.__last_api_status = None
-      resp = requests.post(url=url,headers=headers,data=json.dumps(data))
+      resp = self._send("POST", url, headers=headers, data=json.dumps(data))
       self.__last_api_status = resp.status_code
       log.debug("   status: %d" % resp.status_code)
       try:
@@ -248,7 +454,7 @@ class CareLinkClient(object):
       headers = {
          "mag-identifier": token_data["mag-identifier"]
          }
-      resp = requests.post(url=token_url, headers=headers, data=data)
+      resp = self._send("POST", token_url, headers=headers, data=data)
       log.debug("   status: %d" % resp.status_code)
       if resp.status_code != 200:
          raise Exception("ERROR: failed to refresh token")
@@ -295,8 +501,8 @@ class CareLinkClient(object):
          log.info("   missing data in access token")
          return False
       
-      # Check expiration time stamp
-      tdiff = token_validto - time.time()
+      # Check expiration time stamp (on server clock)
+      tdiff = token_validto - self._server_time()
       if tdiff < 0:
          log.info("   access token has expired %ds ago" % abs(tdiff))
          return False
@@ -312,7 +518,7 @@ class CareLinkClient(object):
    ###########################################################
    # Init static data
    ###########################################################
-   def _init(self):
+   def _init(self, useState=True):
       self.__tokenData = self._read_token_file(self.__tokenFile)
       if self.__tokenData is None:
          return False
@@ -321,11 +527,52 @@ class CareLinkClient(object):
          return False
       try:
          self.__country = self.__accessTokenPayload["token_details"]["country"]
-         self.__config = self._get_config(CARELINK_CONFIG_URL, self.__country)
          self.__username = self.__accessTokenPayload["token_details"]["preferred_username"]
-         self.__user = self._get_user(self.__config, self.__tokenData)
-         if self.__user["role"] in ["CARE_PARTNER","CARE_PARTNER_OUS"]:
-            self.__patient = self._get_patient(self.__config, self.__tokenData)
+         
+         # Warm start: reuse saved session state without any request
+         # (only with valid access token, so the saved token URL is
+         # not needed before the state is revalidated)
+         tokenValid = self._is_token_valid(self.__accessTokenPayload)
+         if useState and self.__stateFile is not None and tokenValid:
+            state = self._read_state_file(self.__stateFile, self.__username, self.__country)
+            if state is not None:
+               self.__config = state["config"]
+               self.__user = state["user"]
+               self.__patient = state["patient"]
+               self.__stateValidated = False
+               return True
+         
+         # Cold start: after discovery, the SSO config, the user and
+         # (speculatively, with valid access token) the patient are
+         # requested in parallel, the patient response is discarded
+         # if the user is no care partner
+         log.info("_get_config()")
+         self.__config = self._get_discovery(CARELINK_CONFIG_URL, self.__country)
+         if self._clock_skew() is not None:
+            # Server time is known now: refresh an expired access token
+            # before using it, instead of after a failed request
+            tokenValid = self._is_token_valid(self.__accessTokenPayload)
+            if not tokenValid:
+               self._get_sso_config(self.__config)
+               self.__tokenData = self._do_refresh(self.__config, self.__tokenData)
+               self.__accessTokenPayload = self._get_access_token_payload(self.__tokenData)
+               self._write_token_file(self.__tokenData, self.__tokenFile)
+               tokenValid = self._is_token_valid(self.__accessTokenPayload)
+         with ThreadPoolExecutor(max_workers=2) as pool:
+            sso = None
+            if "token_url" not in self.__config:
+               sso = pool.submit(self._get_sso_config, self.__config)
+            patient = None
+            if tokenValid:
+               patient = pool.submit(self._api_get, self.__config["baseUrlCareLink"] + "/links/patients", self.__tokenData)
+            self.__user = self._get_user(self.__config, self.__tokenData)
+            if sso is not None:
+               sso.result()
+            if self.__user["role"] in ["CARE_PARTNER","CARE_PARTNER_OUS"]:
+               self.__patient = self._get_patient(self.__config, self.__tokenData, patient)
+         self.__stateValidated = True
+         if self.__stateFile is not None:
+            self._write_state_file(self.__stateFile)
       except Exception as e:
          log.error(e)
          if self.__last_api_status in AUTH_ERROR_CODES:
@@ -386,11 +633,18 @@ class CareLinkClient(object):
          patientId = None
       
       # Get data: first try
-      data = self._get_data(self.__config, 
-                            self.__tokenData, 
-                            self.__username,
-                            self.__user["role"],
-                            patientId)
+      try:
+         data = self._get_data(self.__config, 
+                               self.__tokenData, 
+                               self.__username,
+                               self.__user["role"],
+                               patientId)
+      except Exception as e:
+         if self.__stateValidated:
+            raise
+         # Saved session state may be outdated (revalidated below)
+         log.error(e)
+         data = None
       # Check API response
       if self.__last_api_status in AUTH_ERROR_CODES:
          # Try to refresh token
@@ -404,13 +658,56 @@ class CareLinkClient(object):
                                self.__username,
                                self.__user["role"],
                                patientId)
-         # Check API response
-         if self.__last_api_status in AUTH_ERROR_CODES:
+         # Check API response (with saved session state, the
+         # state may be the cause: revalidated below)
+         if self.__last_api_status in AUTH_ERROR_CODES and self.__stateValidated:
             # Failed permanently
             log.error("ERROR: unable to get data")
             return None
+      
+      # Revalidate session state from warm start
+      if not self.__stateValidated:
+         if self.__last_api_status == 200 and data is not None:
+            self.__stateValidated = True
+         else:
+            log.info("   saved session state not valid, reinitializing")
+            if not self._init(useState=False):
+               return None
+            patientId = self.__patient["username"] if self.__patient is not None else None
+            data = self._get_data(self.__config, 
+                                  self.__tokenData, 
+                                  self.__username,
+                                  self.__user["role"],
+                                  patientId)
+            if self.__last_api_status in AUTH_ERROR_CODES:
+               # Failed permanently
+               log.error("ERROR: unable to get data")
+               return None
       return data
 
+   ###########################################################
+   # Refresh access token (e.g. ahead of expiration)
+   ###########################################################
+   def refreshToken(self):
+      try:
+         self.__tokenData = self._do_refresh(self.__config, self.__tokenData)
+         self.__accessTokenPayload = self._get_access_token_payload(self.__tokenData)
+         self._write_token_file(self.__tokenData, self.__tokenFile)
+      except Exception as e:
+         log.error(e)
+         return False
+      return True
+
+   ###########################################################
+   # Get access token expiration time stamp (on local clock,
+   # corrected by the estimated clock skew)
+   ###########################################################
+   def getTokenExpiry(self):
+      try:
+         return self.__accessTokenPayload["exp"] - (self._clock_skew() or 0)
+      except (KeyError, TypeError):
+         return None
+
    ###########################################################
    # Get last API response code
    ###########################################################
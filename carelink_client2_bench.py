@@ -0,0 +1,400 @@
+###############################################################################
+#
+#  Carelink Client 2 recovery benchmark
+#
+#  Description:
+#
+#    This program measures how the Carelink Client 2 library and the proxy
+#    recover from authorization and server faults. It runs the client
+#    against a local stand-in of the Carelink Cloud (no network access)
+#    which can script faults like expired or revoked access tokens, rotated
+#    refresh tokens, 401 storms and 5xx bursts, and a skewed local clock.
+#
+#    The polling policy of carelink_client2_proxy.py (client rebuild on
+#    authorization errors, 60s back off on connection errors, waiting for a
+#    new token when login fails) is simulated on a virtual clock, so hours
+#    of operation take only milliseconds.
+#
+#    For each scenario the following figures are reported:
+#    - time to recover: from the first failed upstream call to the next
+#      successful data download
+#    - wasted calls: failed upstream calls plus repeated init calls
+#    - refreshes: token refresh calls
+#    - staleness: from the last good data before the fault to the first
+#      good data after it
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#    19/10/2026 - Add server Date header, token expiration and clock skew scenarios
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import carelink_client2
+import carelink_replay
+import argparse
+import base64
+import json
+import os
+import tempfile
+import time
+import logging as log
+from http import HTTPStatus
+from email.utils import formatdate
+from urllib.parse import urlsplit
+
+VERSION = "1.0"
+
+# Proxy polling policy (see carelink_client2_proxy.py)
+UPDATE_INTERVAL = 300
+RETRY_INTERVAL  = 120
+ERROR_INTERVAL  = 60
+
+# Stand-in endpoints
+SSO_CONFIG_URL  = "https://standin.sso/config"
+CARELINK_URL    = "https://standin.carelink/api/carepartner/v2"
+CUMULUS_URL     = "https://standin.cumulus/connect/carepartner/v6"
+TOKEN_PATH      = "/oauth/v2/token"
+
+# Benchmark defaults
+DEFAULT_HORIZON  = 4 * 3600
+DEFAULT_FAULT_AT = 1000
+DEFAULT_LATENCY  = 0.3
+TOKEN_LIFETIME   = 3600
+
+
+###########################################################
+# Class VirtualClock
+#
+# Server clock of the stand-in. The client uses the local
+# clock, offset is the time the local clock is behind.
+###########################################################
+class VirtualClock(object):
+
+   def __init__(self, offset=0):
+      self.__now = time.time() + offset
+
+   def time(self):
+      return self.__now
+
+   def sleep(self, seconds):
+      self.__now += max(0, seconds)
+
+
+###########################################################
+# Create an unsigned JSON web token
+###########################################################
+def make_jwt(payload):
+   b64 = lambda obj: base64.urlsafe_b64encode(json.dumps(obj).encode()).decode().rstrip("=")
+   return b64({"alg": "none"}) + "." + b64(payload) + ".standin"
+
+
+###########################################################
+# Class StandInSession
+#
+# Local stand-in for the Carelink Cloud, usable as
+# httpClient of carelink_client2.CareLinkClient
+###########################################################
+class StandInSession(object):
+
+   def __init__(self, clock, latency=DEFAULT_LATENCY, role="PATIENT"):
+      self.__clock = clock
+      self.__latency = latency
+      self.__role = role
+
+      # Auth state
+      self.__serial = 0
+      self.__access_tokens = {}
+      self.__refresh_token = None
+
+      # Scheduled faults: [at, kind, count]
+      self.__schedule = []
+      self.__api_401 = 0
+      self.__api_5xx = 0
+      self.__token_5xx = 0
+
+      # Call log: (time, endpoint, status)
+      self.calls = []
+
+   ###########################################################
+   # Issue a new token pair (e.g. for the initial token file)
+   ###########################################################
+   def issue_tokens(self, lifetime=TOKEN_LIFETIME):
+      self.__serial += 1
+      exp = int(self.__clock.time()) + lifetime
+      access_token = make_jwt({
+         "exp": exp,
+         "jti": self.__serial,
+         "token_details": { "country": "IT", "preferred_username": "standin" },
+         })
+      if lifetime > 0:
+         self.__access_tokens[access_token] = exp
+      self.__refresh_token = "refresh-%d" % self.__serial
+      return { "access_token":   access_token,
+               "refresh_token":  self.__refresh_token,
+               "scope":          "standin",
+               "client_id":      "standin",
+               "client_secret":  "standin",
+               "mag-identifier": "standin" }
+
+   ###########################################################
+   # Schedule a fault at a given (virtual) time
+   #   revoke:   access tokens become invalid
+   #   rotate:   access and refresh tokens become invalid
+   #   401:      next <count> API calls fail with 401
+   #   5xx:      next <count> API calls fail with 503
+   #   token5xx: next <count> token refresh calls fail with 503
+   ###########################################################
+   def schedule(self, at, kind, count=1):
+      self.__schedule.append([at, kind, count])
+
+   def _apply_faults(self):
+      for fault in [f for f in self.__schedule if f[0] <= self.__clock.time()]:
+         self.__schedule.remove(fault)
+         kind, count = fault[1], fault[2]
+         if kind in ["revoke", "rotate"]:
+            self.__access_tokens.clear()
+         if kind == "rotate":
+            self.__refresh_token = None
+         if kind == "401":
+            self.__api_401 += count
+         if kind == "5xx":
+            self.__api_5xx += count
+         if kind == "token5xx":
+            self.__token_5xx += count
+
+   ###########################################################
+   # Request handlers
+   ###########################################################
+   def _discovery(self, headers, data):
+      return HTTPStatus.OK, {
+         "supportedCountries": [ {"IT": {"region": "EU"}} ],
+         "CP": [ { "region": "EU",
+                   "SSOConfiguration": SSO_CONFIG_URL,
+                   "baseUrlCareLink":  CARELINK_URL,
+                   "baseUrlCumulus":   CUMULUS_URL } ] }
+
+   def _sso_config(self, headers, data):
+      return HTTPStatus.OK, {
+         "server": { "hostname": "standin.sso", "port": 443, "prefix": "auth" },
+         "oauth":  { "system_endpoints": { "token_endpoint_path": TOKEN_PATH } } }
+
+   def _token(self, headers, data):
+      if self.__token_5xx > 0:
+         self.__token_5xx -= 1
+         return HTTPStatus.SERVICE_UNAVAILABLE, None
+      if self.__refresh_token is None or data["refresh_token"] != self.__refresh_token:
+         return HTTPStatus.BAD_REQUEST, { "error": "invalid_grant" }
+      tokens = self.issue_tokens()
+      return HTTPStatus.OK, { "access_token": tokens["access_token"], "refresh_token": tokens["refresh_token"] }
+
+   def _authorized(self, headers):
+      if self.__api_5xx > 0:
+         self.__api_5xx -= 1
+         return HTTPStatus.SERVICE_UNAVAILABLE
+      if self.__api_401 > 0:
+         self.__api_401 -= 1
+         return HTTPStatus.UNAUTHORIZED
+      exp = self.__access_tokens.get(headers.get("Authorization", "")[len("Bearer "):])
+      if exp is None or exp <= self.__clock.time():
+         return HTTPStatus.UNAUTHORIZED
+      return HTTPStatus.OK
+
+   def _user(self, headers, data):
+      status = self._authorized(headers)
+      if status != HTTPStatus.OK:
+         return status, None
+      return status, { "role": self.__role, "firstName": "Stand", "lastName": "In" }
+
+   def _patients(self, headers, data):
+      status = self._authorized(headers)
+      if status != HTTPStatus.OK:
+         return status, None
+      return status, [ { "username": "patient", "firstName": "Pat", "lastName": "Ient" } ]
+
+   def _data(self, headers, data):
+      status = self._authorized(headers)
+      if status != HTTPStatus.OK:
+         return status, None
+      now_ms = int(self.__clock.time() * 1000)
+      return status, { "lastConduitUpdateServerTime": now_ms,
+                       "patientData": { "lastConduitUpdateServerTime": now_ms, "sgs": [] } }
+
+   def _route(self, method, url):
+      path = urlsplit(url).path
+      routes = {
+         ("GET",  carelink_client2.CARELINK_CONFIG_URL): ("discovery", self._discovery),
+         ("GET",  SSO_CONFIG_URL):                       ("sso_config", self._sso_config),
+         ("GET",  CARELINK_URL + "/users/me"):           ("users_me", self._user),
+         ("GET",  CARELINK_URL + "/links/patients"):     ("patients", self._patients),
+         ("POST", CUMULUS_URL + "/display/message"):     ("data", self._data),
+         }
+      if method == "POST" and path.endswith(TOKEN_PATH):
+         return "token", self._token
+      return routes[(method, url)]
+
+   def get(self, url, headers=None, **kwargs):
+      return self.request("GET", url, headers=headers, **kwargs)
+
+   def post(self, url, headers=None, data=None, **kwargs):
+      return self.request("POST", url, headers=headers, data=data, **kwargs)
+
+   def request(self, method, url, headers=None, data=None, **kwargs):
+      self.__clock.sleep(self.__latency)
+      self._apply_faults()
+      endpoint, handler = self._route(method, url)
+      status, body = handler(dict(headers or {}), data)
+      self.calls.append((self.__clock.time(), endpoint, int(status)))
+      return carelink_replay.make_response(method, url, int(status), {"Date": formatdate(self.__clock.time(), usegmt=True)},
+                                           None if body is None else json.dumps(body), self.__latency)
+
+
+###########################################################
+# Simulate the polling policy of the proxy
+###########################################################
+def run_proxy_policy(standin, clock, tokenfile, horizon):
+   end = clock.time() + horizon
+   while clock.time() < end:
+      client = carelink_client2.CareLinkClient(tokenFile=tokenfile, httpClient=standin)
+      if client.init():
+         while clock.time() < end:
+            try:
+               recentData = client.getRecentData()
+               if recentData != None and client.getLastResponseCode() == HTTPStatus.OK:
+                  pass
+               elif client.getLastResponseCode() in [HTTPStatus.FORBIDDEN, HTTPStatus.UNAUTHORIZED]:
+                  break
+               else:
+                  clock.sleep(ERROR_INTERVAL)
+                  continue
+            except Exception as e:
+               clock.sleep(ERROR_INTERVAL)
+               continue
+            try:
+               nextReading = int(recentData["lastConduitUpdateServerTime"]/1000) + UPDATE_INTERVAL
+               tmoSeconds  = int(nextReading - clock.time())
+               if tmoSeconds < 0:
+                  tmoSeconds = RETRY_INTERVAL
+            except KeyError:
+               tmoSeconds = RETRY_INTERVAL
+            clock.sleep(tmoSeconds+10)
+         else:
+            return True
+      # The proxy now waits for a new token, which
+      # requires manual intervention
+      return False
+   return True
+
+
+###########################################################
+# Evaluate the call log of a scenario run
+###########################################################
+def evaluate(name, calls, start, end, recovered):
+   good = [ t for t,e,s in calls if e == "data" and s == HTTPStatus.OK ]
+   failed = [ t for t,e,s in calls if s >= 400 ]
+   init_calls = [ e for t,e,s in calls if e in ["discovery", "sso_config", "users_me", "patients"] ]
+   # One call per init endpoint is necessary, any repetition is wasted
+   first_init = len(set(init_calls))
+
+   result = { "scenario":        name,
+              "calls":           len(calls),
+              "failed_calls":    len(failed),
+              "wasted_calls":    len(failed) + len(init_calls) - first_init,
+              "refreshes":       len([ e for t,e,s in calls if e == "token" ]),
+              "data_ok":         len(good),
+              "recovered":       recovered,
+              "time_to_recover": None,
+              "staleness":       None }
+   if failed:
+      first_failure = failed[0]
+      before = [ t for t in good if t < first_failure ]
+      after  = [ t for t in good if t > first_failure ]
+      last_good = before[-1] if before else start
+      if after:
+         result["time_to_recover"] = round(after[0] - first_failure, 1)
+         result["staleness"] = round(after[0] - last_good, 1)
+      else:
+         result["recovered"] = False
+         result["staleness"] = round(end - last_good, 1)
+   return result
+
+
+###########################################################
+# Scenarios: (name, initial token lifetime,
+#             local clock behind by, [(kind, count)])
+###########################################################
+SCENARIOS = [
+   ("baseline",          TOKEN_LIFETIME, 0,       []),
+   ("expired_token",     -60,            0,       []),
+   ("revoked_token",     TOKEN_LIFETIME, 0,       [("revoke", 1)]),
+   ("rotated_refresh",   TOKEN_LIFETIME, 0,       [("rotate", 1)]),
+   ("401_storm",         TOKEN_LIFETIME, 0,       [("401", 6)]),
+   ("5xx_burst",         TOKEN_LIFETIME, 0,       [("5xx", 5)]),
+   ("token_5xx",         TOKEN_LIFETIME, 0,       [("revoke", 1), ("token5xx", 3)]),
+   ("clock_behind",      300,            7200,    []),
+   ("clock_days_behind", 300,            2*86400, []),
+   ("clock_ahead",       TOKEN_LIFETIME, -7200,   []),
+   ]
+
+
+###########################################################
+# Run a single scenario
+###########################################################
+def run_scenario(name, lifetime, offset, faults, horizon, fault_at, latency, workdir):
+   clock = VirtualClock(offset)
+   standin = StandInSession(clock, latency=latency)
+   tokenfile = os.path.join(workdir, name + ".json")
+   with open(tokenfile, "w") as f:
+      json.dump(standin.issue_tokens(lifetime=lifetime), f)
+
+   start = clock.time()
+   for kind, count in faults:
+      standin.schedule(start + fault_at, kind, count)
+   recovered = run_proxy_policy(standin, clock, tokenfile, horizon)
+   return evaluate(name, standin.calls, start, start + horizon, recovered)
+
+
+###########################################################
+# Print results table
+###########################################################
+def print_results(results):
+   fmt = "%-18s %6s %7s %7s %9s %7s %10s %10s %10s"
+   print(fmt % ("scenario", "calls", "failed", "wasted", "refreshes", "data", "recovered", "ttr[s]", "stale[s]"))
+   for r in results:
+      print(fmt % (r["scenario"], r["calls"], r["failed_calls"], r["wasted_calls"], r["refreshes"], r["data_ok"],
+                   "yes" if r["recovered"] else "NO",
+                   "-" if r["time_to_recover"] is None else r["time_to_recover"],
+                   "-" if r["staleness"] is None else r["staleness"]))
+
+
+# Parse command line
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument('--scenario', '-s', type=str, action='append', help='Run only this scenario (default: all)', choices=[s[0] for s in SCENARIOS])
+   parser.add_argument('--horizon',        type=int, help='Simulated run time in seconds (default: %d)' % DEFAULT_HORIZON, default=DEFAULT_HORIZON)
+   parser.add_argument('--fault-at',       type=int, help='Fault injection time in seconds (default: %d)' % DEFAULT_FAULT_AT, default=DEFAULT_FAULT_AT)
+   parser.add_argument('--latency',        type=float, help='Upstream latency in seconds (default: %.1f)' % DEFAULT_LATENCY, default=DEFAULT_LATENCY)
+   parser.add_argument('--json',           help='Print results in json format', action='store_true')
+   parser.add_argument('--verbose',  '-v', help='Verbose mode', action='store_true')
+   args = parser.parse_args()
+
+   # Silence client logging unless requested
+   log.getLogger().setLevel(log.INFO if args.verbose else log.CRITICAL)
+
+   results = []
+   with tempfile.TemporaryDirectory() as workdir:
+      for name, lifetime, offset, faults in SCENARIOS:
+         if args.scenario and name not in args.scenario:
+            continue
+         results.append(run_scenario(name, lifetime, offset, faults, args.horizon, args.fault_at, args.latency, workdir))
+
+   if args.json:
+      print(json.dumps(results, indent=3))
+   else:
+      print_results(results)
@@ -7,6 +7,17 @@
 #    This is the command line interface of the Carelink Client. It is used
 #    to download a patients recent pump and sensor data from the Carelink 
 #    Cloud. The data is saved to a JSON file.
+#
+#    In batch mode (--batch) the data of many accounts (token files) is
+#    downloaded concurrently by a bounded pool of workers, which share the
+#    discovery and SSO config. One result line (JSON) with timing is printed
+#    per account.
+#
+#    With --archive the data is appended to a compressed archive (see
+#    carelink_archive) instead of being saved to one JSON file per download.
+#
+#    With --series the sensor glucose readings are merged into a binary
+#    glucose series file (see carelink_series).
 #  
 #  Author:
 #
@@ -15,19 +26,35 @@
 #  Changelog:
 #
 #    31/12/2023 - Initial version
+#    19/10/2026 - Add record and replay of HTTP exchanges
+#    19/10/2026 - Add session state file (warm start)
+#    19/10/2026 - Add batch mode for many accounts
+#    19/10/2026 - Add compressed archive output
+#    19/10/2026 - Add binary glucose series output
 #
-#  Copyright 2023, Ondrej Wisniewski 
+#  Copyright 2023-2026, Ondrej Wisniewski 
 #
 ###############################################################################
 
 import carelink_client2
+import carelink_replay
+import carelink_archive
+import carelink_series
+import carelink_history
 import argparse
 import time
 import json
 import datetime
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 VERSION = "1.0"
 
+# Batch mode defaults
+BATCH_WORKERS = 8
+
 
 def writeJson(jsonobj, name):
    filename = name + "-" + datetime.datetime.now().strftime("%Y%m%d_%H%M%S") + ".json"
@@ -42,12 +69,121 @@ def writeJson(jsonobj, name):
       return True
 
 
+# Get token files from list of files and directories
+# (each file only once)
+def getTokenFiles(paths):
+   tokenFiles = []
+   for path in paths:
+      if os.path.isdir(path):
+         tokenFiles += sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith(".json"))
+      else:
+         tokenFiles.append(path)
+   unique = {}
+   for tokenFile in tokenFiles:
+      unique.setdefault(os.path.realpath(tokenFile), tokenFile)
+   return list(unique.values())
+
+
+# Get unique account names for token files: file name without
+# extension, prefixed with the directory name where file names
+# are the same (e.g. <account>/logindata.json), numbered if
+# still not unique. The names are used for the output files.
+def getAccountNames(tokenFiles):
+   def stem(tokenFile):
+      return os.path.splitext(os.path.basename(tokenFile))[0]
+   def dirStem(tokenFile):
+      parent = os.path.basename(os.path.dirname(os.path.realpath(tokenFile)))
+      return parent + "-" + stem(tokenFile)
+   stems = [ stem(f) for f in tokenFiles ]
+   names = [ dirStem(f) if stems.count(s) > 1 else s for f, s in zip(tokenFiles, stems) ]
+   unique = []
+   counts = {}
+   for name in names:
+      if names.count(name) > 1:
+         counts[name] = counts.get(name, 0) + 1
+         name = "%s-%d" % (name, counts[name])
+      unique.append(name)
+   return dict(zip(tokenFiles, unique))
+
+
+# Create archive writer from command line options
+def openArchive(directory):
+   return carelink_archive.ArchiveWriter(directory, compression=args.compression,
+                                         max_size=args.rotate_size * 1024 * 1024,
+                                         max_age=args.rotate_hours * 3600)
+
+
+# Download the data of one account (batch mode)
+def fetchAccount(tokenFile, account, configCache, httpClient, save):
+   result = { "account": account, "tokenfile": tokenFile, "ok": False, "status": None }
+   start = time.monotonic()
+   try:
+      client = carelink_client2.CareLinkClient(tokenFile=tokenFile, httpClient=httpClient, configCache=configCache)
+      ok = client.init()
+      result["init_time"] = round(time.monotonic() - start, 3)
+      if not ok:
+         result["error"] = "failed to initialize client"
+      else:
+         recentData = client.getRecentData()
+         result["data_time"] = round(time.monotonic() - start - result["init_time"], 3)
+         if recentData != None and client.getLastResponseCode() == 200:
+            result["ok"] = True
+            if args.series:
+               os.makedirs(args.series, exist_ok=True)
+               result["readings"] = carelink_series.merge(os.path.join(args.series, account + ".sgs"),
+                                                          carelink_history.iter_sgs(recentData))
+            if args.archive:
+               result["archived"] = openArchive(os.path.join(args.archive, account)).append(recentData)
+            elif save:
+               result["ok"] = writeJson(recentData, "data-" + account)
+         else:
+            result["error"] = "failed to get data"
+      result["status"] = client.getLastResponseCode()
+   except Exception as e:
+      result["error"] = str(e)
+   result["time"] = round(time.monotonic() - start, 3)
+   return result
+
+
+# Download the data of all accounts with a bounded pool of workers
+def runBatch(tokenFiles, workers, httpClient, save):
+   configCache = carelink_client2.ConfigCache()
+   outputLock = threading.Lock()
+   results = []
+   start = time.monotonic()
+   accounts = getAccountNames(tokenFiles)
+
+   def worker(tokenFile):
+      result = fetchAccount(tokenFile, accounts[tokenFile], configCache, httpClient, save)
+      with outputLock:
+         results.append(result)
+         print(json.dumps(result), flush=True)
+
+   with ThreadPoolExecutor(max_workers=workers) as pool:
+      list(pool.map(worker, tokenFiles))
+
+   failed = len([ r for r in results if not r["ok"] ])
+   print("Batch done: %d accounts, %d failed, %.1fs (%d workers)" %
+         (len(results), failed, time.monotonic() - start, workers), file=sys.stderr)
+   return failed == 0
+
+
 # Parse command line 
 parser = argparse.ArgumentParser()
 parser.add_argument('--repeat',   '-r', type=int, help='Repeat request times', required=False)
 parser.add_argument('--wait',     '-w', type=int, help='Wait minutes between repeated calls', required=False)
 parser.add_argument('--data',     '-d', help='Save recent data', action='store_true')
 parser.add_argument('--verbose',  '-v', help='Verbose mode', action='store_true')
+parser.add_argument('--record',         type=str, help='Record HTTP exchanges (tokens redacted) to fixture file', required=False)
+parser.add_argument('--replay',         type=str, help='Replay HTTP exchanges from fixture file instead of using the network', required=False)
+parser.add_argument('--statefile',      type=str, help='Save session state to this file and reuse it on the next start', required=False)
+parser.add_argument('--batch',    '-b', type=str, nargs='+', help='Batch mode: download data of all accounts in these token files or directories', required=False)
+parser.add_argument('--workers',        type=int, help='Number of concurrent downloads in batch mode (default: %d)' % BATCH_WORKERS, default=BATCH_WORKERS)
+parser.add_argument('--archive',        type=str, help='Append data to compressed archive in this directory (one subdirectory per account in batch mode)', required=False)
+parser.add_argument('--compression',    type=str, help='Archive compression (default: gzip)', choices=list(carelink_archive.EXTENSIONS), default=carelink_archive.GZIP)
+parser.add_argument('--rotate-size',    type=int, help='Start new archive segment after this size in MB (default: %d)' % (carelink_archive.MAX_SIZE // (1024*1024)), default=carelink_archive.MAX_SIZE // (1024*1024))
+parser.add_argument('--rotate-hours',   type=int, help='Start new archive segment after this time in hours (default: %d)' % (carelink_archive.MAX_AGE // 3600), default=carelink_archive.MAX_AGE // 3600)
+parser.add_argument('--series',         type=str, help='Merge sensor glucose readings into binary series file (directory with one file per account in batch mode)', required=False)
 args = parser.parse_args()
 
 # Get parameters from CLI
@@ -61,8 +197,24 @@ verbose  = args.verbose
 #print("data     = " + str(data))
 #print("verbose  = " + str(verbose))
 
+# Select HTTP transport
+if args.replay:
+   httpClient = carelink_replay.ReplaySession(args.replay)
+elif args.record:
+   httpClient = carelink_replay.RecordingSession(args.record)
+else:
+   httpClient = None
+
+# Batch mode
+if args.batch:
+   tokenFiles = getTokenFiles(args.batch)
+   if verbose:
+      print("Batch of %d accounts" % len(tokenFiles), file=sys.stderr)
+   sys.exit(0 if runBatch(tokenFiles, max(args.workers, 1), httpClient, data) else 1)
+
 # Create client instance
-client = carelink_client2.CareLinkClient()
+client = carelink_client2.CareLinkClient(httpClient=httpClient, stateFile=args.statefile)
+archive = openArchive(args.archive) if args.archive else None
 if verbose:
    print("Client created")
    
@@ -74,7 +226,17 @@ if client.init():
       try:
          recentData = client.getRecentData()
          if recentData != None and client.getLastResponseCode() == 200:
-            if(data):
+            if args.series:
+               count = carelink_series.merge(args.series, carelink_history.iter_sgs(recentData))
+               if verbose:
+                  print("Series file has %d readings" % count)
+            if archive is not None:
+               if archive.append(recentData):
+                  if verbose:
+                     print("Data archived successfully")
+               elif verbose:
+                  print("No new data, not archived")
+            elif(data):
                if writeJson(recentData, "data"):
                   if verbose:
                      print("Data saved successfully")
@@ -11,6 +11,13 @@
 #    Send a GET request to the following URI: 
 #      http://<serveraddr>:8081/carelink/          # all Carelink data
 #      http://<serveraddr>:8081/carelink/nohistory # no history data
+#      http://<serveraddr>:8081/carelink/?fields=  # selected fields only
+#      http://<serveraddr>:8081/carelink/history?from=&to=&fields=&type=
+#                                                &resolution=&points=&format=
+#                                                  # stored history data
+#      http://<serveraddr>:8081/carelink/stats     # glucose statistics
+#      http://<serveraddr>:8081/carelink/agp?days=&bucket=&utcoffset=
+#                                                  # ambulatory glucose profile
 #  
 #  Author:
 #
@@ -28,22 +35,57 @@
 #    03/01/2024 - Porting to Carelink Client 2
 #    11/04/2024 - Handle reconnection in case of network error
 #    17/01/2025 - Adapt get_essential_data() to new data format
+#    19/10/2026 - Encode data once per update, add asyncio HTTP server mode
+#    19/10/2026 - HTTP/1.1 persistent connections
+#    19/10/2026 - Add multi-process HTTP workers using shared memory
+#    19/10/2026 - Add local snapshot feed (memory mapped file)
+#    19/10/2026 - Add history store and range query API
+#    19/10/2026 - Add history rollups and downsampling
+#    19/10/2026 - Add glucose statistics endpoint
+#    19/10/2026 - Add ambulatory glucose profile endpoint
+#    19/10/2026 - Add field projection (fields parameter)
+#    19/10/2026 - Add Nightscout uploader
+#    19/10/2026 - Pass new data to sinks (Nightscout, webhooks) via queues
+#    19/10/2026 - Add alert rules engine
+#    19/10/2026 - Add session state file (warm start)
+#    19/10/2026 - Serve saved snapshot (marked stale) after restart
+#    19/10/2026 - Add binary format of history endpoint
+#    19/10/2026 - Check age alerts periodically, retry alert webhooks
+#    19/10/2026 - Fork HTTP worker processes before starting threads
 #
-#  Copyright 2021-2025, Ondrej Wisniewski
+#  Copyright 2021-2026, Ondrej Wisniewski
 #
 ###############################################################################
 
 import carelink_client2
+import carelink_shm
+import carelink_history
+import carelink_series
+import carelink_stats
+import carelink_nightscout
+import carelink_sinks
+import carelink_alerts
+try:
+   import carelink_agp
+except ImportError:
+   # NumPy not installed
+   carelink_agp = None
 import argparse
 import time
 import json
 import sys
 import signal
 import threading 
+import asyncio
+import socket
+import multiprocessing
+import resource
+import functools
+import os
 import logging as log
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from http import HTTPStatus
-from urllib.parse import parse_qs
+from urllib.parse import parse_qs, urlsplit
 
 
 VERSION = "1.2"
@@ -58,6 +100,23 @@ PORT     = 8081
 GUIURL   = ""
 APIURL   = "carelink"
 OPT_NOHISTORY = "nohistory"
+OPT_HISTORY   = "history"
+OPT_STATS     = "stats"
+OPT_AGP       = "agp"
+
+# HTTP/1.1 persistent connection settings
+KEEPALIVE_TIMEOUT = 15
+MAX_REQUESTS      = 1000
+
+# asyncio HTTP server settings
+MAX_HEADER_SIZE   = 16384
+LISTEN_BACKLOG    = 1024
+MAX_NOFILE        = 65536
+
+# Multi-process HTTP workers settings
+SHM_NAME          = "carelink2-proxy-%d.snap"
+STATUS_DOC        = "#status"
+SAVED_DOC         = "#saved"
 
 UPDATE_INTERVAL = 300
 RETRY_INTERVAL  = 120
@@ -76,13 +135,53 @@ g_status = STATUS_INIT
 recentData = None
 verbose = False
 
+# Latest data snapshot: (version, data, {route: encoded json})
+# This tuple is never modified, only replaced as a whole, so
+# the HTTP servers can read it without locking
+g_snapshot = (0, None, {})
+
+# Shared memory region with the encoded snapshot
+# (multi-process mode: written by the poller, read by the HTTP workers)
+g_region = None
+
+# Notifier for local feed subscribers
+g_notifier = None
+
+# History store
+g_history = None
+HISTORY_DEFAULT_RANGE = 24 * 3600
+
+# Glucose statistics (rolling windows)
+g_stats = carelink_stats.StatsTracker()
+
+# Cached ambulatory glucose profiles: (snapshot version, {params: encoded json})
+g_agp_cache = (None, {})
+
+# Cached field projections: (snapshot version, {route: decoded data}, 
+#                            {(route, fields): encoded json})
+g_projection_cache = (None, {}, {})
+MAX_PROJECTIONS = 256
+
+# Consumers of new data (each with its own queue and worker thread)
+g_sinks = carelink_sinks.SinkPipeline()
+
+# Alert engine and consumers of alert events
+g_alerts = None
+g_alert_sinks = carelink_sinks.SinkPipeline()
+ALERT_CHECK_INTERVAL = 60
+ALERT_QUEUE_SIZE     = 256
+ALERT_RETRIES        = 5
+
 
 #################################################
 # The signal handler for the TERM signal
 #################################################
 def on_sigterm(signum, frame):
-   # TODO: cleanup (if any)
    log.debug("Exiting in sigterm")
+   if g_notifier is not None:
+      g_notifier.close()
+   if g_region is not None:
+      g_region.close()
    sys.exit()
 
 
@@ -141,11 +240,318 @@ def webgui(status,action=None,country=""):
    return html
 
 
+#################################################
+# Publish new Carelink data to the HTTP servers
+#################################################
+def publish_snapshot(data, saved=None):
+   global g_snapshot
+   # Encode the responses once per update instead of once per request
+   docs = {
+      APIURL:                   json.dumps(data).encode(),
+      APIURL+'/'+OPT_NOHISTORY: json.dumps(get_essential_data(data)).encode(),
+      APIURL+'/'+OPT_STATS:     json.dumps(g_stats.get_stats()).encode(),
+   }
+   if saved is not None:
+      # Data loaded from snapshot file (time saved)
+      docs[SAVED_DOC] = str(saved).encode()
+   g_snapshot = (g_snapshot[0]+1, data, docs)
+   publish_region()
+
+
+#################################################
+# Publish snapshot and status to shared memory
+#################################################
+def publish_region():
+   if g_region is not None:
+      seq = g_region.publish(dict(g_snapshot[2], **{STATUS_DOC: g_status.encode()}))
+      if g_notifier is not None and seq is not None:
+         g_notifier.notify(seq)
+
+
+#################################################
+# Add new data to the history store
+#################################################
+def update_history(data):
+   if g_history is not None:
+      try:
+         g_history.add_data(data)
+      except Exception as e:
+         log.error("ERROR: failed to update history (%s)" % e)
+
+
+#################################################
+# Add new readings to the glucose statistics
+#################################################
+def update_stats(data):
+   try:
+      g_stats.add_data(data)
+   except Exception as e:
+      log.error("ERROR: failed to update statistics (%s)" % e)
+
+
+#################################################
+# Alert check thread: evaluate the age rules also
+# when no new data is received (e.g. polls fail)
+#################################################
+def alerts_thread():
+   while True:
+      time.sleep(ALERT_CHECK_INTERVAL)
+      try:
+         g_alerts.check_timed()
+      except Exception as e:
+         log.error("ERROR: failed to check alerts (%s)" % e)
+
+
+#################################################
+# Load glucose statistics from the history store
+#################################################
+def load_stats():
+   first, last = g_history.time_range()
+   if last is not None:
+      rows = g_history.query("sgs", last - g_stats.span, last + 1)
+      count = g_stats.add_readings(carelink_history.Reading(*r) for r in rows)
+      log.debug("Loaded %d readings from history into statistics" % count)
+
+
+#################################################
+# Set proxy status (shown in web GUI)
+#################################################
+def set_status(status):
+   global g_status
+   g_status = status
+   publish_region()
+
+
+#################################################
+# Get latest snapshot (in HTTP worker processes
+# it is refreshed from the shared memory region)
+#################################################
+def current_snapshot():
+   global g_snapshot, g_status
+   if g_region is not None and not g_region.writer:
+      seq, docs = g_region.read(g_snapshot[0])
+      if docs is not None:
+         g_status = bytes(docs.pop(STATUS_DOC)).decode()
+         g_snapshot = (seq, None, docs)
+   return g_snapshot
+
+
+#################################################
+# Handle history range query
+#################################################
+def handle_history(query):
+   params = parse_qs(query)
+   try:
+      end = carelink_history.parse_time(params["to"][0]) if "to" in params else int(time.time())
+      start = carelink_history.parse_time(params["from"][0]) if "from" in params else end - HISTORY_DEFAULT_RANGE
+      table = params.get("type", ["sgs"])[0]
+      fields = params["fields"][0].split(",") if "fields" in params else None
+      fmt = params.get("format", ["json"])[0]
+      if fmt not in ["json", "binary"]:
+         raise ValueError("format must be json or binary")
+      if fmt == "binary":
+         # Sensor glucose readings in binary series format
+         if table != "sgs" or fields is not None or "resolution" in params or "points" in params:
+            raise ValueError("format binary is only supported for type sgs, without fields, resolution and points")
+         readings = [ carelink_history.Reading(*r) for r in g_history.query("sgs", start, end) ]
+         return HTTPStatus.OK, "application/octet-stream", carelink_series.encode(readings)
+      if "resolution" in params:
+         # Precomputed rollups of sensor glucose readings
+         resolution = params["resolution"][0]
+         if table != "sgs" or resolution not in carelink_history.ROLLUPS:
+            raise ValueError("resolution must be one of %s (type sgs)" % ",".join(carelink_history.ROLLUPS))
+         response = g_history.query_json("sgs_" + resolution, start, end, fields)
+      elif "points" in params:
+         # Downsampled sensor glucose readings
+         if table != "sgs":
+            raise ValueError("points is only supported for type sgs")
+         response = g_history.downsample_json(start, end, int(params["points"][0]), fields)
+      else:
+         response = g_history.query_json(table, start, end, fields)
+   except ValueError as e:
+      return HTTPStatus.BAD_REQUEST, "application/json", json.dumps({"error": str(e)}).encode()
+   return HTTPStatus.OK, "application/json", response
+
+
+#################################################
+# Handle ambulatory glucose profile request
+# (results are cached until the next data update)
+#################################################
+def handle_agp(snapshot, query):
+   global g_agp_cache
+   if carelink_agp is None:
+      return HTTPStatus.NOT_IMPLEMENTED, "application/json", json.dumps({"error": "numpy is required"}).encode()
+   params = parse_qs(query)
+   try:
+      days = int(params.get("days", [carelink_agp.DAYS])[0])
+      bucket = int(params.get("bucket", [carelink_agp.BUCKET])[0])
+      utc_offset = int(params.get("utcoffset", [0])[0])
+      if days < 1 or bucket < 60 or carelink_agp.SECONDS_PER_DAY % bucket:
+         raise ValueError("days must be positive, bucket a divisor of one day (at least 60 seconds)")
+   except ValueError as e:
+      return HTTPStatus.BAD_REQUEST, "application/json", json.dumps({"error": str(e)}).encode()
+   
+   key = (days, bucket, utc_offset)
+   version, cache = g_agp_cache
+   if version == snapshot[0] and key in cache:
+      return HTTPStatus.OK, "application/json", cache[key]
+   
+   if g_history is not None:
+      series = carelink_agp.series_from_history(g_history, days=days)
+   elif snapshot[1] is not None:
+      series = carelink_agp.series_from_data(snapshot[1])
+   else:
+      # HTTP worker process: decode the published data
+      series = carelink_agp.series_from_data(json.loads(bytes(snapshot[2][APIURL])))
+   response = json.dumps(carelink_agp.agp(*series, days=days, bucket=bucket, utc_offset=utc_offset)).encode()
+   
+   # Replace the cache as a whole (no locking needed)
+   cache = dict(cache) if version == snapshot[0] else {}
+   cache[key] = response
+   g_agp_cache = (snapshot[0], cache)
+   return HTTPStatus.OK, "application/json", response
+
+
+#################################################
+# Compile a set of field paths (e.g. "patientData.lastSG.sg")
+# into a projection function. Paths through lists apply
+# to every list element.
+#################################################
+@functools.lru_cache(maxsize=MAX_PROJECTIONS)
+def compile_projection(fields):
+   # Build tree of the requested paths (None = whole value)
+   tree = {}
+   for field in fields:
+      node = tree
+      parts = field.split(".")
+      for part in parts[:-1]:
+         node = node.setdefault(part, {})
+         if node is None:
+            break
+      else:
+         node[parts[-1]] = None
+   
+   def build(tree):
+      items = [ (key, None if sub is None else build(sub)) for key, sub in tree.items() ]
+      def project(obj):
+         if isinstance(obj, list):
+            return [ project(o) for o in obj ]
+         if not isinstance(obj, dict):
+            return obj
+         return { key: obj[key] if sub is None else sub(obj[key]) for key, sub in items if key in obj }
+      return project
+   return build(tree)
+
+
+#################################################
+# Handle field projection request
+# (results are cached until the next data update)
+#################################################
+def handle_projection(snapshot, route, query):
+   global g_projection_cache
+   fields = tuple(sorted(set( f for f in ",".join(parse_qs(query).get("fields", [])).split(",") if f )))
+   if not fields:
+      return HTTPStatus.OK, "application/json", snapshot[2][route]
+   
+   version, decoded, cache = g_projection_cache
+   if version != snapshot[0]:
+      version, decoded, cache = snapshot[0], {}, {}
+   
+   key = (route, fields)
+   if key in cache:
+      return HTTPStatus.OK, "application/json", cache[key]
+   
+   # Decode the published document once per data update
+   if route not in decoded:
+      decoded = dict(decoded)
+      decoded[route] = json.loads(bytes(snapshot[2][route]))
+   response = json.dumps(compile_projection(fields)(decoded[route])).encode()
+   
+   # Replace the cache as a whole (no locking needed)
+   if len(cache) < MAX_PROJECTIONS:
+      cache = dict(cache)
+      cache[key] = response
+   g_projection_cache = (version, decoded, cache)
+   return HTTPStatus.OK, "application/json", response
+
+
+#################################################
+# Check if the saved snapshot is being served
+#################################################
+def serving_saved():
+   return SAVED_DOC in g_snapshot[2]
+
+
+#################################################
+# Extra response headers of a snapshot
+# (staleness indicator for saved data)
+#################################################
+def snapshot_headers(snapshot):
+   if SAVED_DOC not in snapshot[2]:
+      return []
+   saved = int(bytes(snapshot[2][SAVED_DOC]))
+   return [ ("X-Carelink-Stale", "true"),
+            ("X-Carelink-Saved", time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(saved))),
+            ("Age", str(max(0, int(time.time()) - saved))) ]
+
+
+#################################################
+# Handle GET request (common to all HTTP servers)
+# Returns: status code, content type, body (bytes,
+#          or iterator of bytes for streamed body),
+#          extra headers [(name, value)]
+#################################################
+def handle_get(path):
+   snapshot = current_snapshot()
+   status_code, content_type, response = route_request(snapshot, path)
+   return status_code, content_type, response, snapshot_headers(snapshot)
+
+
+#################################################
+# Route GET request to its handler
+#################################################
+def route_request(snapshot, path):
+   url = urlsplit(path)
+   route = url.path.strip("/")
+   
+   # Check request path
+   if route in snapshot[2] and not route.startswith("#"):
+      if "fields=" in url.query:
+         # Get selected fields of latest Carelink data
+         return handle_projection(snapshot, route, url.query)
+      # Get latest Carelink data (complete or without history)
+      return HTTPStatus.OK, "application/json", snapshot[2][route]
+   elif route == APIURL+'/'+OPT_HISTORY and g_history is not None:
+      # Get stored history data in time range
+      return handle_history(url.query)
+   elif route == APIURL+'/'+OPT_AGP:
+      # Get ambulatory glucose profile
+      return handle_agp(snapshot, url.query)
+   elif path == "/":
+      # Show web GUI
+      if g_status == STATUS_NEED_TKN:
+         response = webgui(status=g_status, action=GUIURL)
+      else:
+         response = webgui(status=g_status)
+      return HTTPStatus.OK, "text/html", bytes(response, "utf-8")
+   else:
+      return HTTPStatus.NOT_FOUND, "text/html", b""
+
+
 #################################################
 # HTTP server methods
 #################################################
 class MyServer(BaseHTTPRequestHandler):
    
+   # Keep client connections open between requests,
+   # close them when idle for KEEPALIVE_TIMEOUT seconds
+   protocol_version = "HTTP/1.1"
+   timeout = KEEPALIVE_TIMEOUT
+   
+   def setup(self):
+      BaseHTTPRequestHandler.setup(self)
+      self.requests_served = 0
+   
    def log_message(self, format, *args):
       #Disable logging
       pass
@@ -154,45 +560,49 @@ class MyServer(BaseHTTPRequestHandler):
       # Security checks (if any)
       # TODO
       log.debug("received client GET request from %s" % (self.address_string()))
-      #print(self.path)
       
-      # Check request path
-      if self.path.strip("/") == APIURL:
-         # Get latest Carelink data (complete)
-         response = json.dumps(recentData)
-         status_code = HTTPStatus.OK
-         content_type = "application/json"
-         #print("All data requested")
-      elif self.path.strip("/") == APIURL+'/'+OPT_NOHISTORY:
-         # Get latest Carelink data without history
-         response = json.dumps(get_essential_data(recentData))
-         status_code = HTTPStatus.OK
-         content_type = "application/json"
-         #print("Only essential data requested")
-      elif self.path == "/":
-         # Show web GUI
-         if g_status == STATUS_NEED_TKN:
-            response = webgui(status=g_status, action=GUIURL)
-         else:
-            response = webgui(status=g_status)
-         status_code = HTTPStatus.OK
-         content_type = "text/html"
-         #print("Setup web page requested")
-      else:
-         response = ""
-         status_code = HTTPStatus.NOT_FOUND
-         content_type = "text/html"
-         #print("page not found")
+      status_code, content_type, response, extra_headers = handle_get(self.path)
+      
+      # Limit requests per connection
+      self.requests_served += 1
+      if self.requests_served >= MAX_REQUESTS:
+         self.close_connection = True
+      
+      # Streamed responses are sent in chunks (HTTP/1.1) 
+      # or terminated by closing the connection (HTTP/1.0)
+      streamed = not isinstance(response, (bytes, memoryview))
+      chunked = streamed and self.request_version == "HTTP/1.1"
+      if streamed and not chunked:
+         self.close_connection = True
       
       # Send response
       self.send_response(status_code)
       self.send_header("Content-type", content_type)
+      if chunked:
+         self.send_header("Transfer-Encoding", "chunked")
+      elif not streamed:
+         self.send_header("Content-Length", str(len(response)))
       self.send_header("Access-Control-Allow-Origin", "*")
+      for name, value in extra_headers:
+         self.send_header(name, value)
+      if self.close_connection:
+         self.send_header("Connection", "close")
+      else:
+         self.send_header("Keep-Alive", "timeout=%d, max=%d" % (self.timeout, MAX_REQUESTS - self.requests_served))
       self.end_headers()
       try:
-         self.wfile.write(bytes(response, "utf-8"))
-      except BrokenPipeError:
-         pass
+         if not streamed:
+            self.wfile.write(response)
+         else:
+            for chunk in response:
+               self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+            if chunked:
+               self.wfile.write(b"0\r\n\r\n")
+      except (BrokenPipeError, ConnectionResetError):
+         self.close_connection = True
+      except Exception as e:
+         log.error(e)
+         self.close_connection = True
 
    '''
    def do_POST(self):
@@ -234,38 +644,205 @@ class MyServer(BaseHTTPRequestHandler):
          pass
    '''
 
+#################################################
+# Threading HTTP server sharing its port with
+# other processes (SO_REUSEPORT)
+#################################################
+class ReusePortHTTPServer(ThreadingHTTPServer):
+   
+   def server_bind(self):
+      self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+      ThreadingHTTPServer.server_bind(self)
+
+
 #################################################
 # Web server thread
 #################################################
-def webserver_thread():
+def webserver_thread(reuse_port=False):
    # Init web server
-   webserver = ThreadingHTTPServer((HOSTNAME, PORT), MyServer)
+   webserver = (ReusePortHTTPServer if reuse_port else ThreadingHTTPServer)((HOSTNAME, PORT), MyServer)
    log.debug("HTTP server started at http://%s:%s" % (HOSTNAME, PORT))
 
    # Start server loop
    webserver.serve_forever()
 
 
+#################################################
+# asyncio HTTP server: handle one client 
+# connection (HTTP/1.1 with keep-alive)
+#################################################
+async def aio_handle_connection(reader, writer):
+   requests_served = 0
+   try:
+      while True:
+         # Read request head, close idle connections
+         try:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), KEEPALIVE_TIMEOUT)
+         except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            break
+         lines = head.decode("latin-1").split("\r\n")
+         try:
+            method, path, version = lines[0].split(" ")
+         except ValueError:
+            break
+         headers = {}
+         for line in lines[1:]:
+            if ":" in line:
+               name, value = line.split(":", 1)
+               headers[name.strip().lower()] = value.strip()
+         
+         # Discard request body (if any)
+         length = int(headers.get("content-length", 0))
+         if length > 0:
+            await reader.readexactly(length)
+         
+         # Keep connection alive by default for HTTP/1.1 only
+         connection = headers.get("connection", "").lower()
+         keep_alive = (version == "HTTP/1.1" and connection != "close") or connection == "keep-alive"
+         
+         # Limit requests per connection
+         requests_served += 1
+         if requests_served >= MAX_REQUESTS:
+            keep_alive = False
+         
+         if method in ["GET", "HEAD"]:
+            status_code, content_type, response, extra_headers = handle_get(path)
+         else:
+            status_code, content_type, response, extra_headers = HTTPStatus.NOT_IMPLEMENTED, "text/html", b"", []
+         
+         # Streamed responses are sent in chunks (HTTP/1.1) 
+         # or terminated by closing the connection (HTTP/1.0)
+         streamed = not isinstance(response, (bytes, memoryview))
+         chunked = streamed and version == "HTTP/1.1"
+         if streamed and not chunked:
+            keep_alive = False
+         
+         # Send response
+         head = [ "HTTP/1.1 %d %s" % (status_code, status_code.phrase),
+                  "Content-type: %s" % content_type ]
+         if chunked:
+            head.append("Transfer-Encoding: chunked")
+         elif not streamed:
+            head.append("Content-Length: %d" % len(response))
+         head.append("Access-Control-Allow-Origin: *")
+         head.extend([ "%s: %s" % h for h in extra_headers ])
+         if keep_alive:
+            head.append("Connection: keep-alive")
+            head.append("Keep-Alive: timeout=%d, max=%d" % (KEEPALIVE_TIMEOUT, MAX_REQUESTS - requests_served))
+         else:
+            head.append("Connection: close")
+         writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+         if method == "HEAD":
+            pass
+         elif not streamed:
+            writer.write(response)
+         else:
+            # Let other connections proceed between chunks
+            for chunk in response:
+               writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk) if chunked else chunk)
+               await writer.drain()
+            if chunked:
+               writer.write(b"0\r\n\r\n")
+         await writer.drain()
+         if not keep_alive:
+            break
+   except (ConnectionError, ValueError):
+      pass
+   except Exception as e:
+      log.error(e)
+   finally:
+      writer.close()
+
+
+#################################################
+# asyncio HTTP server thread
+#################################################
+def aio_webserver_thread(reuse_port=False):
+   async def serve():
+      server = await asyncio.start_server(aio_handle_connection, HOSTNAME, PORT, 
+                                          limit=MAX_HEADER_SIZE, backlog=LISTEN_BACKLOG, reuse_address=True,
+                                          reuse_port=reuse_port)
+      log.debug("asyncio HTTP server started at http://%s:%s" % (HOSTNAME, PORT))
+      async with server:
+         await server.serve_forever()
+   
+   # Allow one file descriptor per client connection (as far
+   # as the hard limit and the OS allow)
+   soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+   limit = MAX_NOFILE if hard == resource.RLIM_INFINITY else min(hard, MAX_NOFILE)
+   if soft != resource.RLIM_INFINITY and soft < limit:
+      try:
+         resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard))
+      except (ValueError, OSError) as e:
+         log.warning("WARNING: failed to raise open file limit to %d (%s)" % (limit, e))
+   
+   asyncio.run(serve())
+
+
 #################################################
 # Start web server as asynchronous thread
 #################################################
-def start_webserver():
-   t = threading.Thread(target=webserver_thread, args=())
+def start_webserver(use_asyncio=False):
+   t = threading.Thread(target=aio_webserver_thread if use_asyncio else webserver_thread, args=())
    t.daemon = True
    t.start()
 
 
+#################################################
+# HTTP worker process: serve the snapshots 
+# published by the poller via shared memory
+#################################################
+def worker_process(use_asyncio, region_path):
+   global g_region, g_snapshot, g_history
+   g_region = carelink_shm.SnapshotRegion(region_path)
+   g_snapshot = (0, None, {})
+   if g_history is not None:
+      # Don't share database connections with the poller process
+      g_history = carelink_history.HistoryStore(g_history.filename, readonly=True)
+   if use_asyncio:
+      aio_webserver_thread(reuse_port=True)
+   else:
+      webserver_thread(reuse_port=True)
+
+
+#################################################
+# Start HTTP worker processes
+#################################################
+def start_workers(count, use_asyncio=False):
+   ctx = multiprocessing.get_context("fork")
+   for i in range(count):
+      p = ctx.Process(target=worker_process, args=(use_asyncio, g_region.path))
+      p.daemon = True
+      p.start()
+   log.debug("Started %d HTTP worker processes" % count)
+
+
 # Parse command line 
 parser = argparse.ArgumentParser()
 parser.add_argument('--tokenfile','-t', type=str, help='File containing auth tokens (default: %s)' % TOKENFILE, required=False)
+parser.add_argument('--statefile','-s', type=str, help='Save session state to this file and reuse it on restart', required=False)
 parser.add_argument('--wait',     '-w', type=int, help='Wait seconds between repeated calls (default 300)', required=False)
 parser.add_argument('--verbose',  '-v', help='Verbose mode', action='store_true')
+parser.add_argument('--asyncio',  '-a', help='Serve HTTP clients from a single asyncio event loop (for many concurrent clients)', action='store_true')
+parser.add_argument('--keepalive-timeout', type=int, help='Close idle client connections after seconds (default %d)' % KEEPALIVE_TIMEOUT, required=False)
+parser.add_argument('--max-requests',      type=int, help='Max requests per client connection (default %d)' % MAX_REQUESTS, required=False)
+parser.add_argument('--workers',           type=int, help='Serve HTTP clients from this number of worker processes (default: serve from main process)', required=False)
+parser.add_argument('--feed',              type=str, help='Publish data for local consumers to this memory mapped file (notifications via <file>.sock)', required=False)
+parser.add_argument('--history',           type=str, help='Store history data in this database file and serve it at /%s/%s' % (APIURL, OPT_HISTORY), required=False)
+parser.add_argument('--nightscout',        type=str, help='Upload new data to this Nightscout URL (API secret in NIGHTSCOUT_API_SECRET or token in NIGHTSCOUT_TOKEN environment variable)', required=False)
+parser.add_argument('--snapshot',          type=str, help='Save the latest data to this file and serve it (marked stale) right after a restart', required=False)
+parser.add_argument('--webhook',           type=str, help='POST new data to this URL (can be repeated)', action='append', default=[])
+parser.add_argument('--alerts',            type=str, help='Evaluate the alert rules in this JSON file on each update', required=False)
+parser.add_argument('--alert-webhook',     type=str, help='POST alert events to this URL (can be repeated)', action='append', default=[])
 args = parser.parse_args()
 
 # Get parameters from CLI
 tokenfile = TOKENFILE if args.tokenfile == None else args.tokenfile
 wait      = UPDATE_INTERVAL if args.wait == None else args.wait
 verbose   = args.verbose
+KEEPALIVE_TIMEOUT = KEEPALIVE_TIMEOUT if args.keepalive_timeout == None else args.keepalive_timeout
+MAX_REQUESTS      = MAX_REQUESTS if args.max_requests == None else args.max_requests
+MyServer.timeout  = KEEPALIVE_TIMEOUT
 
 # Logging config (verbose)
 if verbose:
@@ -277,18 +854,73 @@ log.info("Starting Carelink Client Proxy (version %s)" % VERSION)
 signal.signal(signal.SIGTERM, on_sigterm)
 signal.signal(signal.SIGINT, on_sigterm)
 
-# Start web server
-start_webserver()
+# Open history store
+if args.history:
+   g_history = carelink_history.HistoryStore(args.history)
+   load_stats()
+
+# Create shared memory region for the local feed and/or the worker
+# processes (the local feed is used for these if enabled)
+if args.feed:
+   g_region = carelink_shm.SnapshotRegion(args.feed, create=True)
+elif args.workers:
+   g_region = carelink_shm.SnapshotRegion(carelink_shm.default_path(SHM_NAME % PORT), create=True)
+
+# Start HTTP worker processes (forked before any thread is started,
+# so they don't inherit locks held by other threads)
+if args.workers:
+   start_workers(args.workers, use_asyncio=args.asyncio)
+
+# Init sinks (new data contains the last 24h, so
+# only the latest one needs to be passed on)
+if args.nightscout:
+   uploader = carelink_nightscout.NightscoutUploader(args.nightscout, 
+                                                     api_secret=os.environ.get("NIGHTSCOUT_API_SECRET"),
+                                                     token=os.environ.get("NIGHTSCOUT_TOKEN"))
+   g_sinks.add(carelink_sinks.NightscoutSink(uploader), policy=carelink_sinks.COALESCE_LATEST)
+for url in args.webhook:
+   g_sinks.add(carelink_sinks.WebhookSink(url), policy=carelink_sinks.COALESCE_LATEST)
+if args.snapshot:
+   g_sinks.add(carelink_sinks.SnapshotFileSink(args.snapshot), policy=carelink_sinks.COALESCE_LATEST)
+
+# Init alert engine (alert events are not coalesced, failed
+# webhook requests are retried and a full queue blocks the
+# publisher before the oldest event is dropped)
+if args.alerts:
+   g_alerts = carelink_alerts.AlertEngine(carelink_alerts.load_rules(args.alerts), notify=g_alert_sinks.publish)
+   for url in args.alert_webhook:
+      g_alert_sinks.add(carelink_sinks.WebhookSink(url, retries=ALERT_RETRIES), maxsize=ALERT_QUEUE_SIZE, policy=carelink_sinks.BLOCK)
+   t = threading.Thread(target=alerts_thread, args=())
+   t.daemon = True
+   t.start()
+
+# Start local feed notifications
+if args.feed:
+   g_notifier = carelink_shm.SnapshotNotifier(args.feed + ".sock", g_region)
+
+# Load last known data (before the client is initialized)
+savedData, savedTime = (None, None)
+if args.snapshot:
+   savedData, savedTime = carelink_sinks.load_snapshot(args.snapshot)
+   if savedData is not None:
+      log.info("Serving saved data from %s" % time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(savedTime)))
+      update_stats(savedData)
+
+# Start web server (the poller publishes snapshots to shared
+# memory for the worker processes)
+publish_snapshot(savedData, savedTime)
+if not args.workers:
+   start_webserver(use_asyncio=args.asyncio)
 
 # Main process loop
 while True:
    # Init Carelink client
-   client = carelink_client2.CareLinkClient(tokenFile=tokenfile)
-   g_status = STATUS_DO_LOGIN
+   client = carelink_client2.CareLinkClient(tokenFile=tokenfile, stateFile=args.statefile)
+   set_status(STATUS_DO_LOGIN)
    
    # Login to Carelink server
    if client.init():
-      g_status = STATUS_LOGIN_OK
+      set_status(STATUS_LOGIN_OK)
 
       # Infinite loop requesting Carelink data periodically
       i = 0
@@ -298,8 +930,20 @@ while True:
 
          try:
             recentData = client.getRecentData()
-            if recentData != None and client.getLastResponseCode() == HTTPStatus.OK:
+            dataOk = recentData != None and client.getLastResponseCode() == HTTPStatus.OK
+            if dataOk:
+               # Evaluate alerts first, for lowest latency
+               if g_alerts is not None:
+                  g_alerts.evaluate(recentData)
+               # Update history and statistics before publishing the new snapshot
+               update_history(recentData)
+               update_stats(recentData)
+            # Keep serving saved data until new data is received
+            if dataOk or not serving_saved():
+               publish_snapshot(recentData)
+            if dataOk:
                log.debug("New data received")
+               g_sinks.publish(recentData)
             elif client.getLastResponseCode() == HTTPStatus.FORBIDDEN or client.getLastResponseCode() == HTTPStatus.UNAUTHORIZED:
                # Authorization error occured
                log.error("ERROR: failed to get data (Authotization error, response code %d)" % client.getLastResponseCode())
@@ -312,6 +956,8 @@ while True:
          except Exception as e:
             log.error(e)
             recentData = None
+            if not serving_saved():
+               publish_snapshot(recentData)
             time.sleep(60)
             continue
             
@@ -332,7 +978,7 @@ while True:
    # Wait for new token
    # FIXME
    log.info(STATUS_NEED_TKN)
-   g_status = STATUS_NEED_TKN
+   set_status(STATUS_NEED_TKN)
    wait_for_params = True
    while wait_for_params:
       time.sleep(0.1)
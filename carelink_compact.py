@@ -0,0 +1,192 @@
+###############################################################################
+#
+#  Carelink snapshot compaction
+#
+#  Description:
+#
+#    This program compacts the data files saved by carelink_client2_cli.py
+#    (data-YYYYmmdd_HHMMSS.json) into one history database (see
+#    carelink_history). Every data file repeats the last 24h of sensor
+#    glucose readings and markers, the database keeps each of them only
+#    once, indexed by its timestamp.
+#
+#    The files are parsed in parallel by a pool of processes. Each process
+#    handles chunks of consecutive files and removes the duplicates within
+#    a chunk before passing the records back, the remaining duplicates are
+#    removed when the records are added to the database.
+#
+#    The names, sizes and modification times of the compacted files are
+#    kept in the database, so a rerun only processes new (or changed)
+#    files. Files which can't be parsed (e.g. still being written) are
+#    retried on the next run.
+#
+#    With --series the readings of the database are also exported to a
+#    binary glucose series file (see carelink_series).
+#
+#    Usage:
+#
+#      python carelink_compact.py --history history.db /path/to/data/files
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#    19/10/2026 - Add binary series export
+#    19/10/2026 - Skip data files with unexpected content
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import carelink_history
+import carelink_series
+import argparse
+import fnmatch
+import json
+import os
+import re
+import sqlite3
+import time
+import logging as log
+from concurrent.futures import ProcessPoolExecutor
+
+VERSION = "1.0"
+
+# Default file name pattern (as saved by carelink_client2_cli.py)
+DEFAULT_PATTERN = re.compile(r"^data-\d{8}_\d{6}\.json$")
+
+# Files per chunk (passed to a worker process at once)
+CHUNK_FILES = 64
+
+
+###########################################################
+# Find data files in directories: [(path, size, mtime)]
+###########################################################
+def find_files(directories, pattern=None):
+   files = []
+   for directory in directories:
+      for name in os.listdir(directory):
+         if pattern is None and not DEFAULT_PATTERN.match(name):
+            continue
+         if pattern is not None and not fnmatch.fnmatch(name, pattern):
+            continue
+         path = os.path.join(directory, name)
+         st = os.stat(path)
+         files.append((os.path.abspath(path), st.st_size, st.st_mtime))
+   # Names contain the download time: consecutive files overlap most
+   return sorted(files, key=lambda f: os.path.basename(f[0]))
+
+
+###########################################################
+# Merge a reading, keep the trend if any snapshot has it
+###########################################################
+def merge_reading(readings, r):
+   known = readings.get(r.timestamp)
+   if known is None or (known.trend is None and r.trend is not None):
+      readings[r.timestamp] = r
+
+
+###########################################################
+# Parse a chunk of data files (in a worker process)
+# Returns (readings, markers, done files, failed files, bytes)
+###########################################################
+def compact_chunk(files):
+   readings = {}
+   markers = {}
+   done, failed, size = [], [], 0
+   for path, fsize, mtime in files:
+      try:
+         with open(path, "rb") as f:
+            data = json.loads(f.read())
+         for r in carelink_history.iter_sgs(data):
+            merge_reading(readings, r)
+         for ts, mtype, marker in carelink_history.iter_markers(data):
+            key = (ts, mtype, carelink_history.marker_id(marker))
+            if key not in markers:
+               markers[key] = marker
+      except (OSError, ValueError, AttributeError, TypeError, KeyError) as e:
+         # Unreadable file or unexpected content (e.g. a JSON list)
+         failed.append((path, "%s: %s" % (type(e).__name__, e)))
+         continue
+      done.append((path, fsize, mtime))
+      size += fsize
+   return (list(readings.values()), [ (ts, mtype, m) for (ts, mtype, _), m in markers.items() ], done, failed, size)
+
+
+###########################################################
+# Class Compactor
+###########################################################
+class Compactor(object):
+
+   def __init__(self, filename):
+      self.store = carelink_history.HistoryStore(filename)
+      self.__db = sqlite3.connect(filename)
+      with self.__db:
+         self.__db.execute("CREATE TABLE IF NOT EXISTS compacted (filename TEXT PRIMARY KEY, size INTEGER, mtime REAL)")
+
+   ###########################################################
+   # Get the files which were not yet compacted (or changed)
+   ###########################################################
+   def new_files(self, files):
+      known = { f: (s, m) for f, s, m in self.__db.execute("SELECT filename, size, mtime FROM compacted") }
+      return [ f for f in files if known.get(f[0]) != (f[1], f[2]) ]
+
+   ###########################################################
+   # Compact files into the history database
+   # Returns statistics
+   ###########################################################
+   def run(self, files, workers=None, chunk_files=CHUNK_FILES):
+      start = time.monotonic()
+      stats = { "files": 0, "failed": 0, "bytes": 0, "readings": 0, "new_readings": 0, "markers": 0 }
+      chunks = [ files[i:i+chunk_files] for i in range(0, len(files), chunk_files) ]
+      with ProcessPoolExecutor(max_workers=workers) as pool:
+         for readings, markers, done, failed, size in pool.map(compact_chunk, chunks):
+            new = self.store.add_records(sorted(readings), sorted(markers, key=lambda m: (m[0], m[1] or "")))
+            # Mark files only after their records are stored
+            with self.__db:
+               self.__db.executemany("INSERT OR REPLACE INTO compacted VALUES (?,?,?)", done)
+            for path, error in failed:
+               log.error("ERROR: failed to parse %s (%s)" % (path, error))
+            stats["files"] += len(done)
+            stats["failed"] += len(failed)
+            stats["bytes"] += size
+            stats["readings"] += len(readings)
+            stats["new_readings"] += len(new)
+            stats["markers"] += len(markers)
+      stats["seconds"] = round(time.monotonic() - start, 3)
+      return stats
+
+
+# Parse command line
+if __name__ == "__main__":
+   parser = argparse.ArgumentParser()
+   parser.add_argument('directory',        type=str, nargs='+', help='Directory containing the data files')
+   parser.add_argument('--history',  '-o', type=str, help='History database file', required=True)
+   parser.add_argument('--pattern',  '-p', type=str, help='File name pattern (default: data-YYYYmmdd_HHMMSS.json)', required=False)
+   parser.add_argument('--workers',  '-w', type=int, help='Number of worker processes (default: number of CPUs)', required=False)
+   parser.add_argument('--series',   '-s', type=str, help='Export readings to binary series file', required=False)
+   parser.add_argument('--all',            help='Process all files, not only new ones', action='store_true')
+   parser.add_argument('--verbose',  '-v', help='Verbose mode', action='store_true')
+   args = parser.parse_args()
+
+   log.basicConfig(format='[%(asctime)s:%(levelname)s] %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+                   level=log.DEBUG if args.verbose else log.INFO)
+
+   compactor = Compactor(args.history)
+   files = find_files(args.directory, args.pattern)
+   todo = files if args.all else compactor.new_files(files)
+   print("Found %d files, %d to compact" % (len(files), len(todo)))
+
+   stats = compactor.run(todo, args.workers)
+   seconds = max(stats["seconds"], 1e-6)
+   print("Compacted %d files (%.1f MB) in %.1fs: %.0f files/s, %.1f MB/s" %
+         (stats["files"], stats["bytes"] / 1e6, stats["seconds"], stats["files"] / seconds, stats["bytes"] / 1e6 / seconds))
+   print("Readings: %d parsed, %d new; markers: %d; failed files: %d" %
+         (stats["readings"], stats["new_readings"], stats["markers"], stats["failed"]))
+
+   if args.series:
+      count = carelink_series.export_history(compactor.store, args.series)
+      print("Exported %d readings to %s" % (count, args.series))
@@ -0,0 +1,271 @@
+###############################################################################
+#
+#  Carelink fleet scheduler
+#
+#  Description:
+#
+#    This module schedules data polls and token refreshes of many
+#    CareLinkClient instances (accounts) so that they don't hit the
+#    Carelink Cloud in lock-step, e.g. after all of them have been started
+#    together or have recovered from an outage:
+#
+#    - each account gets a deterministic offset within the update interval
+#      (derived from its id), plus a small random jitter per cycle
+#    - failed polls are retried after the retry interval, also spread by
+#      the account offset
+#    - access tokens are refreshed ahead of expiration, spread over a
+#      refresh window
+#    - all requests to the same upstream host share a request-rate budget
+#      (token bucket), enforced by RateLimitedSession which is passed to
+#      the clients as HTTP client
+#
+#    Usage:
+#
+#      limiter = carelink_fleet.HostRateLimiter(rate=2.0)
+#      fleet = carelink_fleet.FleetScheduler(on_data=store_data)
+#      for tokenfile in tokenfiles:
+#         client = carelink_client2.CareLinkClient(tokenfile, httpClient=carelink_fleet.RateLimitedSession(limiter))
+#         fleet.add(tokenfile, client)
+#      fleet.run()
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import time
+import heapq
+import random
+import hashlib
+import threading
+import requests
+import logging as log
+from http import HTTPStatus
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Scheduling settings
+UPDATE_INTERVAL = 300
+RETRY_INTERVAL  = 120
+JITTER          = 0.05   # fraction of the interval
+REFRESH_MARGIN  = 600    # the client refreshes by itself within this margin
+REFRESH_WINDOW  = 1800   # scheduled refreshes are spread over this window
+MAX_WORKERS     = 8
+
+# Rate limiter settings (per upstream host)
+DEFAULT_RATE  = 2.0      # requests per second
+DEFAULT_BURST = 5
+
+# Job types
+POLL    = "poll"
+REFRESH = "refresh"
+INIT    = "init"
+
+
+###########################################################
+# Deterministic offset of an account within a period
+###########################################################
+def account_offset(account_id, period):
+   digest = hashlib.sha1(str(account_id).encode()).digest()
+   return int.from_bytes(digest[:8], "big") % max(int(period * 1000), 1) / 1000.0
+
+
+###########################################################
+# Class HostRateLimiter
+#
+# Token bucket per upstream host
+###########################################################
+class HostRateLimiter(object):
+
+   def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, clock=time.monotonic, sleep=time.sleep):
+      self.rate = rate
+      self.burst = burst
+      self.__clock = clock
+      self.__sleep = sleep
+      self.__buckets = {}
+      self.__lock = threading.Lock()
+
+   ###########################################################
+   # Wait until a request to host is within the budget
+   # Returns the waiting time
+   ###########################################################
+   def acquire(self, host):
+      waited = 0.0
+      while True:
+         with self.__lock:
+            now = self.__clock()
+            tokens, last = self.__buckets.get(host, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+               self.__buckets[host] = (tokens - 1, now)
+               return waited
+            self.__buckets[host] = (tokens, now)
+            delay = (1 - tokens) / self.rate
+         self.__sleep(delay)
+         waited += delay
+
+
+###########################################################
+# Class RateLimitedSession
+#
+# HTTP client which applies the request-rate budget of a
+# HostRateLimiter (shared by all clients of a fleet)
+###########################################################
+class RateLimitedSession(object):
+
+   def __init__(self, limiter, session=None):
+      self.__limiter = limiter
+      self.__session = requests.Session() if session is None else session
+
+   # Cookie jar of the underlying session (used by client 1)
+   @property
+   def cookies(self):
+      return self.__session.cookies
+
+   def get(self, url, **kwargs):
+      return self.request("GET", url, **kwargs)
+
+   def post(self, url, **kwargs):
+      return self.request("POST", url, **kwargs)
+
+   def request(self, method, url, **kwargs):
+      self.__limiter.acquire(urlsplit(url).hostname)
+      return self.__session.request(method, url, **kwargs)
+
+
+###########################################################
+# Class FleetScheduler
+###########################################################
+class FleetScheduler(object):
+
+   def __init__(self, on_data=None, interval=UPDATE_INTERVAL, retry_interval=RETRY_INTERVAL, jitter=JITTER,
+                max_workers=MAX_WORKERS, seed=None, clock=time.time, sleep=time.sleep):
+      self.interval = interval
+      self.retry_interval = retry_interval
+      self.jitter = jitter
+      self.__on_data = on_data
+      self.__max_workers = max_workers
+      self.__rng = random.Random(seed)
+      self.__clock = clock
+      self.__sleep = sleep
+      self.__clients = {}
+      self.__account_locks = {}
+      self.__refresh_pending = set()
+      self.__jobs = []
+      self.__lock = threading.Lock()
+      self.__stop = threading.Event()
+
+   def _jitter(self, period):
+      return self.__rng.uniform(-self.jitter, self.jitter) * period
+
+   ###########################################################
+   # Time of the next poll of an account after now: its slot
+   # in the update interval (or retry interval after a failure)
+   ###########################################################
+   def next_poll(self, account_id, now=None, failed=False):
+      now = self.__clock() if now is None else now
+      period = self.retry_interval if failed else self.interval
+      offset = account_offset(account_id, period)
+      slot = (now // period) * period + offset
+      while slot <= now:
+         slot += period
+      return max(now, slot + self._jitter(period))
+
+   ###########################################################
+   # Time of the token refresh of an account, spread over
+   # the refresh window before the client's own refresh margin
+   ###########################################################
+   def refresh_time(self, account_id, expiry, now=None):
+      now = self.__clock() if now is None else now
+      latest = expiry - REFRESH_MARGIN
+      at = latest - account_offset(account_id, REFRESH_WINDOW)
+      if at <= now:
+         # Too late to spread: refresh soon, with jitter
+         at = now + abs(self._jitter(self.retry_interval))
+      return min(at, max(now, latest))
+
+   ###########################################################
+   # Add an account (client instance) to the fleet
+   ###########################################################
+   def add(self, account_id, client):
+      self.__clients[account_id] = client
+      self.__account_locks[account_id] = threading.Lock()
+      # Spread the initial logins over the retry interval
+      self._schedule(self.__clock() + account_offset(account_id, self.retry_interval), INIT, account_id)
+
+   def _schedule(self, at, kind, account_id):
+      with self.__lock:
+         heapq.heappush(self.__jobs, (at, kind, account_id))
+
+   ###########################################################
+   # Run one job, schedule the follow up jobs
+   ###########################################################
+   def _run_job(self, kind, account_id):
+      # Clients are not thread safe, run one job per account at a time
+      with self.__account_locks[account_id]:
+         self._do_job(kind, account_id)
+
+   def _do_job(self, kind, account_id):
+      client = self.__clients[account_id]
+      try:
+         if kind == INIT:
+            if not client.init():
+               self._schedule(self.next_poll(account_id, failed=True), INIT, account_id)
+               return
+            kind = POLL
+         if kind == REFRESH:
+            self.__refresh_pending.discard(account_id)
+            ok = client.refreshToken()
+            if not ok:
+               self.__refresh_pending.add(account_id)
+               self._schedule(self.next_poll(account_id, failed=True), REFRESH, account_id)
+            else:
+               self._schedule_refresh(account_id, client)
+            return
+
+         data = client.getRecentData()
+         ok = data is not None and client.getLastResponseCode() == HTTPStatus.OK
+         if ok and self.__on_data is not None:
+            self.__on_data(account_id, data)
+      except Exception as e:
+         log.error("ERROR: account %s: %s" % (account_id, e))
+         ok = False
+      self._schedule(self.next_poll(account_id, failed=not ok), POLL, account_id)
+      if ok and account_id not in self.__refresh_pending:
+         self._schedule_refresh(account_id, client)
+
+   def _schedule_refresh(self, account_id, client):
+      expiry = client.getTokenExpiry()
+      if expiry is not None:
+         self.__refresh_pending.add(account_id)
+         self._schedule(self.refresh_time(account_id, expiry), REFRESH, account_id)
+
+   ###########################################################
+   # Run the scheduler until stop() is called
+   ###########################################################
+   def run(self):
+      with ThreadPoolExecutor(max_workers=self.__max_workers) as pool:
+         while not self.__stop.is_set():
+            with self.__lock:
+               due = self.__jobs[0][0] if self.__jobs else None
+               if due is not None and due <= self.__clock():
+                  at, kind, account_id = heapq.heappop(self.__jobs)
+               else:
+                  kind = None
+            if kind is not None:
+               log.debug("fleet: %s %s" % (kind, account_id))
+               pool.submit(self._run_job, kind, account_id)
+               continue
+            wait = 1.0 if due is None else min(1.0, due - self.__clock())
+            self.__sleep(max(wait, 0))
+
+   def stop(self):
+      self.__stop.set()
@@ -0,0 +1,399 @@
+###############################################################################
+#
+#  Carelink history store
+#
+#  Description:
+#
+#    This module implements a persistent local store for the history data
+#    contained in the Carelink data (sensor glucose readings and markers).
+#    Every downloaded data set repeats the last 24h, so the store keeps each
+#    reading only once, indexed by its timestamp.
+#
+#    The store is an SQLite database. The tables are clustered by timestamp,
+#    so range queries only read the matching rows. Queries return iterators
+#    which fetch the rows in chunks, so even long ranges never have to be
+#    held in memory as a whole.
+#
+#    For long range charts the store maintains rollups of the sensor glucose
+#    readings (15 min, 1 hour and 1 day buckets in UTC with count, min, max,
+#    mean and percentiles). They are updated incrementally: each new reading
+#    only recomputes the buckets it falls into. Arbitrary ranges can also be
+#    downsampled with the Largest-Triangle-Three-Buckets (LTTB) algorithm,
+#    which keeps the visual shape of the curve.
+#
+#    Usage:
+#
+#      store = carelink_history.HistoryStore("history.db")
+#      store.add_data(recentData)
+#      for row in store.query("sgs", start, end, ["timestamp","sg"]):
+#         print(row)
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#    19/10/2026 - Add incremental rollups and LTTB downsampling
+#    19/10/2026 - Keep markers of same type and time (schema version 2)
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import json
+import sqlite3
+import hashlib
+import threading
+import logging as log
+from collections import namedtuple
+from datetime import datetime, timezone
+
+
+# Database schema version
+SCHEMA_VERSION = 2
+
+# Marker fields which change between snapshots (not part of the marker id)
+VOLATILE_MARKER_FIELDS = ["index", "relativeOffset"]
+
+# Rollup resolutions: name -> bucket size in seconds
+ROLLUPS = { "15m": 900, "1h": 3600, "1d": 86400 }
+ROLLUP_FIELDS = ["timestamp", "count", "min", "max", "mean", "p5", "p25", "p50", "p75", "p95"]
+ROLLUP_PERCENTILES = [5, 25, 50, 75, 95]
+
+# Tables and their fields (the first one is the timestamp)
+FIELDS = {
+   "sgs":     ["timestamp", "sg", "trend", "sensorState"],
+   "markers": ["timestamp", "type", "data"],
+   }
+FIELDS.update({ "sgs_" + r: ROLLUP_FIELDS for r in ROLLUPS })
+
+# Fields containing raw JSON text
+JSON_FIELDS = ["data"]
+
+# Rows fetched from the database at once
+CHUNK_ROWS = 500
+
+# Sensor glucose reading
+Reading = namedtuple("Reading", ["timestamp", "sg", "trend", "sensorState"])
+
+
+###########################################################
+# Convert time value (epoch seconds or ISO 8601 string)
+# to epoch seconds
+###########################################################
+def parse_time(value):
+   if isinstance(value, (int, float)):
+      return int(value)
+   try:
+      return int(float(value))
+   except ValueError:
+      pass
+   # ISO 8601, with "Z" for UTC (not supported by older Python versions)
+   dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+   if dt.tzinfo is None:
+      dt = dt.replace(tzinfo=timezone.utc)
+   return int(dt.timestamp())
+
+
+###########################################################
+# Percentile of sorted values (linear interpolation)
+###########################################################
+def percentile(values, q):
+   pos = (len(values) - 1) * q / 100.0
+   lo = int(pos)
+   hi = min(lo + 1, len(values) - 1)
+   return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+###########################################################
+# Rollup of the sorted valid readings of a bucket
+###########################################################
+def rollup(bucket, values):
+   return ( [bucket, len(values), values[0], values[-1], round(sum(values) / len(values), 1)] +
+            [ round(percentile(values, q), 1) for q in ROLLUP_PERCENTILES ] )
+
+
+###########################################################
+# Downsample rows (timestamp, value, ...) to at most 
+# threshold rows with the Largest-Triangle-Three-Buckets
+# algorithm. Needs the row count in advance, but keeps
+# only two buckets in memory.
+###########################################################
+def lttb(rows, count, threshold):
+   rows = iter(rows)
+   if threshold >= count or threshold < 3:
+      yield from rows
+      return
+   
+   # Bucket k holds the rows [start(k), start(k+1)), without first and last row
+   buckets = threshold - 2
+   start = lambda k: (k * (count - 2)) // buckets + 1
+   take = lambda k: [ next(rows) for i in range(start(k+1) - start(k)) ]
+   
+   a = next(rows)
+   yield a
+   bucket = take(0)
+   for k in range(buckets):
+      following = take(k+1) if k+1 < buckets else [next(rows)]
+      avg_x = sum([ r[0] for r in following ]) / len(following)
+      avg_y = sum([ r[1] for r in following ]) / len(following)
+      # Select the row forming the largest triangle with the previously
+      # selected row and the average of the following bucket
+      best = max(bucket, key=lambda r: abs((a[0] - avg_x) * (r[1] - a[1]) - (a[0] - r[0]) * (avg_y - a[1])))
+      yield best
+      a = best
+      bucket = following
+   yield bucket[-1]
+
+
+###########################################################
+# Get patient data from Carelink data
+###########################################################
+def get_patient_data(data):
+   if data is None:
+      return {}
+   return data.get("patientData", data)
+
+
+###########################################################
+# Get timestamp of a history record (sg or marker)
+###########################################################
+def record_time(record):
+   for key in ["timestamp", "datetime", "dateTime"]:
+      if key in record and record[key]:
+         try:
+            return parse_time(record[key])
+         except (ValueError, TypeError):
+            return None
+   return None
+
+
+###########################################################
+# Get all sensor glucose readings from Carelink data
+###########################################################
+def iter_sgs(data):
+   patient_data = get_patient_data(data)
+   sgs = patient_data.get("sgs") or []
+   trend = patient_data.get("lastSGTrend")
+   for i, sg in enumerate(sgs):
+      ts = record_time(sg)
+      if ts is None:
+         continue
+      # The trend is only known for the latest reading
+      yield Reading(ts, sg.get("sg"), trend if i == len(sgs)-1 else None, sg.get("sensorState"))
+
+
+###########################################################
+# Get all markers from Carelink data: (timestamp, type, marker)
+###########################################################
+def iter_markers(data):
+   for marker in get_patient_data(data).get("markers") or []:
+      ts = record_time(marker)
+      if ts is None:
+         continue
+      yield ts, marker.get("type"), marker
+
+
+###########################################################
+# Get id of a marker (hash of its content), which tells
+# apart markers of the same type and time
+###########################################################
+def marker_id(marker):
+   stable = { k: v for k, v in marker.items() if k not in VOLATILE_MARKER_FIELDS }
+   return hashlib.sha1(json.dumps(stable, sort_keys=True, separators=(",",":")).encode()).hexdigest()[:16]
+
+
+###########################################################
+# Class HistoryStore
+###########################################################
+class HistoryStore(object):
+
+   def __init__(self, filename, readonly=False):
+      self.filename = filename
+      self.__readonly = readonly
+      # One connection per thread (poller writes, HTTP servers read)
+      self.__local = threading.local()
+      if not readonly:
+         self._create_schema()
+
+   ###########################################################
+   # Get database connection of current thread
+   ###########################################################
+   def _db(self):
+      db = getattr(self.__local, "db", None)
+      if db is None:
+         if self.__readonly:
+            db = sqlite3.connect("file:%s?mode=ro" % self.filename, uri=True)
+         else:
+            db = sqlite3.connect(self.filename)
+            # Readers do not block the writer and vice versa
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+         self.__local.db = db
+      return db
+
+   def _create_schema(self):
+      db = self._db()
+      with db:
+         # INTEGER PRIMARY KEY: rows are stored in timestamp order
+         db.execute("CREATE TABLE IF NOT EXISTS sgs (timestamp INTEGER PRIMARY KEY, sg INTEGER, trend TEXT, sensorState TEXT)")
+         db.execute("CREATE TABLE IF NOT EXISTS markers (timestamp INTEGER, type TEXT, id TEXT, data TEXT, PRIMARY KEY (timestamp, type, id)) WITHOUT ROWID")
+         db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+         db.execute("INSERT OR IGNORE INTO meta VALUES ('schema_version', ?)", (str(SCHEMA_VERSION),))
+         version = int(db.execute("SELECT value FROM meta WHERE key='schema_version'").fetchone()[0])
+         if version < 2:
+            self._migrate_markers(db)
+            db.execute("UPDATE meta SET value=? WHERE key='schema_version'", (str(SCHEMA_VERSION),))
+         for r in ROLLUPS:
+            db.execute("CREATE TABLE IF NOT EXISTS sgs_%s (timestamp INTEGER PRIMARY KEY, count INTEGER, min INTEGER, max INTEGER, "
+                       "mean REAL, p5 REAL, p25 REAL, p50 REAL, p75 REAL, p95 REAL)" % r)
+         
+         # Build rollups for data stored by previous versions
+         if db.execute("SELECT value FROM meta WHERE key='rollups'").fetchone() is None:
+            self._rebuild_rollups(db)
+            db.execute("INSERT INTO meta VALUES ('rollups', '1')")
+
+   ###########################################################
+   # Migrate markers table of schema version 1 (one marker
+   # per type and time) to the marker id key
+   ###########################################################
+   def _migrate_markers(self, db):
+      rows = db.execute("SELECT timestamp, type, data FROM markers").fetchall()
+      db.execute("DROP TABLE markers")
+      db.execute("CREATE TABLE markers (timestamp INTEGER, type TEXT, id TEXT, data TEXT, PRIMARY KEY (timestamp, type, id)) WITHOUT ROWID")
+      db.executemany("INSERT OR IGNORE INTO markers VALUES (?,?,?,?)",
+                     [ (ts, mtype, marker_id(json.loads(data)), data) for ts, mtype, data in rows ])
+      log.info("history: migrated %d markers to schema version %d" % (len(rows), SCHEMA_VERSION))
+
+   ###########################################################
+   # Rebuild all rollups from the stored readings
+   ###########################################################
+   def _rebuild_rollups(self, db):
+      for r, size in ROLLUPS.items():
+         db.execute("DELETE FROM sgs_%s" % r)
+         rows = []
+         bucket, values = None, []
+         for ts, sg in db.execute("SELECT timestamp, sg FROM sgs WHERE sg > 0 ORDER BY timestamp"):
+            if ts - ts % size != bucket:
+               if values:
+                  rows.append(rollup(bucket, sorted(values)))
+               bucket, values = ts - ts % size, []
+            values.append(sg)
+         if values:
+            rows.append(rollup(bucket, sorted(values)))
+         db.executemany("INSERT INTO sgs_%s VALUES (?,?,?,?,?,?,?,?,?,?)" % r, rows)
+
+   ###########################################################
+   # Update rollups of the buckets containing new readings
+   ###########################################################
+   def _update_rollups(self, db, readings):
+      for r, size in ROLLUPS.items():
+         for bucket in set([ x.timestamp - x.timestamp % size for x in readings ]):
+            values = [ v for v, in db.execute("SELECT sg FROM sgs WHERE timestamp >= ? AND timestamp < ? AND sg > 0 ORDER BY sg",
+                                              (bucket, bucket + size)) ]
+            if values:
+               db.execute("INSERT OR REPLACE INTO sgs_%s VALUES (?,?,?,?,?,?,?,?,?,?)" % r, rollup(bucket, values))
+            else:
+               db.execute("DELETE FROM sgs_%s WHERE timestamp = ?" % r, (bucket,))
+
+   ###########################################################
+   # Add history of Carelink data to the store
+   # Returns the sensor glucose readings which were new
+   ###########################################################
+   def add_data(self, data):
+      return self.add_records(list(iter_sgs(data)), list(iter_markers(data)))
+
+   def add_records(self, readings, markers=[]):
+      db = self._db()
+      new_readings = []
+      with db:
+         for r in readings:
+            cur = db.execute("INSERT OR IGNORE INTO sgs VALUES (?,?,?,?)", r)
+            if cur.rowcount > 0:
+               new_readings.append(r)
+            elif r.trend is not None:
+               db.execute("UPDATE sgs SET trend=? WHERE timestamp=?", (r.trend, r.timestamp))
+         db.executemany("INSERT OR IGNORE INTO markers VALUES (?,?,?,?)",
+                        [ (ts, mtype, marker_id(m), json.dumps(m, separators=(",",":"))) for ts, mtype, m in markers ])
+         self._update_rollups(db, new_readings)
+      if new_readings:
+         log.debug("history: %d new readings" % len(new_readings))
+      return new_readings
+
+   ###########################################################
+   # Check requested fields of a table (all if none given)
+   ###########################################################
+   def check_fields(self, table, fields=None):
+      if table not in FIELDS:
+         raise ValueError("unknown history table %s" % table)
+      fields = FIELDS[table] if not fields else fields
+      for f in fields:
+         if f not in FIELDS[table]:
+            raise ValueError("unknown field %s" % f)
+      return fields
+
+   ###########################################################
+   # Query records of a table in time range [start, end)
+   # Returns an iterator of tuples with the requested fields
+   ###########################################################
+   def query(self, table, start, end, fields=None):
+      fields = self.check_fields(table, fields)
+      return self._fetch(table, start, end, fields)
+
+   def _fetch(self, table, start, end, fields):
+      cur = self._db().execute("SELECT %s FROM %s WHERE timestamp >= ? AND timestamp < ? ORDER BY timestamp" %
+                               (",".join(fields), table), (start, end))
+      while True:
+         rows = cur.fetchmany(CHUNK_ROWS)
+         if not rows:
+            break
+         for row in rows:
+            yield row
+
+   ###########################################################
+   # Query records and encode them as JSON array in chunks
+   # (raw JSON fields are passed through without re-encoding)
+   ###########################################################
+   def query_json(self, table, start, end, fields=None):
+      fields = self.check_fields(table, fields)
+      return self._encode_json(self._fetch(table, start, end, fields), fields)
+
+   def _encode_json(self, rows, fields):
+      encoders = [ (lambda v: "null" if v is None else v) if f in JSON_FIELDS else json.dumps for f in fields ]
+      keys = [ json.dumps(f) + ":" for f in fields ]
+      sep = "["
+      chunk = []
+      for row in rows:
+         chunk.append(sep + "{" + ",".join([ k + e(v) for k,e,v in zip(keys, encoders, row) ]) + "}")
+         sep = ","
+         if len(chunk) == CHUNK_ROWS:
+            yield "".join(chunk).encode()
+            chunk = []
+      chunk.append("[]" if sep == "[" else "]")
+      yield "".join(chunk).encode()
+
+   ###########################################################
+   # Query sensor glucose readings in time range [start, end)
+   # downsampled to at most <points> readings (LTTB), encoded
+   # as JSON array in chunks
+   ###########################################################
+   def downsample_json(self, start, end, points, fields=None):
+      fields = self.check_fields("sgs", fields)
+      # Downsampling needs timestamp and value first
+      columns = ["timestamp", "sg"] + fields
+      db = self._db()
+      count = db.execute("SELECT COUNT(*) FROM sgs WHERE timestamp >= ? AND timestamp < ? AND sg > 0", (start, end)).fetchone()[0]
+      cur = db.execute("SELECT %s FROM sgs WHERE timestamp >= ? AND timestamp < ? AND sg > 0 ORDER BY timestamp" %
+                       ",".join(columns), (start, end))
+      rows = ( row[2:] for row in lttb(cur, count, points) )
+      return self._encode_json(rows, fields)
+
+   ###########################################################
+   # Get time range of a table: (first, last) or (None, None)
+   ###########################################################
+   def time_range(self, table="sgs"):
+      if table not in FIELDS:
+         raise ValueError("unknown history table %s" % table)
+      return self._db().execute("SELECT MIN(timestamp), MAX(timestamp) FROM %s" % table).fetchone()
@@ -0,0 +1,375 @@
+###############################################################################
+#
+#  Carelink Nightscout uploader
+#
+#  Description:
+#
+#    This module uploads Carelink data to a Nightscout site:
+#
+#    - sensor glucose readings (sgs)  -> entries
+#    - markers (insulin, meal, BG)    -> treatments
+#    - pump status                    -> devicestatus
+#
+#    For each collection the uploader keeps the keys (time, for treatments
+#    also type and amount) of the records it has uploaded within the data
+#    window (DATA_WINDOW, the Carelink data covers 24h), so only records
+#    which are not in Nightscout yet are uploaded, also when they arrive
+#    late. The keys are initialized from the records of this uploader
+#    (device/enteredBy) in Nightscout, records of other uploaders don't
+#    matter. Uploads are bulk POSTs of up to MAX_BATCH records. Requests
+#    use one pooled HTTP session and failed requests are retried with
+#    exponential backoff.
+#
+#    Usage:
+#
+#      uploader = carelink_nightscout.NightscoutUploader("https://my.nightscout.site", api_secret="...")
+#      uploader.upload(client.getRecentData())
+#
+#    For testing, StandInNightscout can be passed as HTTP client. It keeps
+#    the uploaded records in memory and can inject server errors.
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#    19/10/2026 - Dedupe by record keys of this uploader, not by newest time
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import time
+import json
+import random
+import hashlib
+import requests
+import carelink_history
+import carelink_replay
+import logging as log
+from datetime import datetime, timezone
+from urllib.parse import urlsplit, parse_qs, urlencode
+
+
+# Nightscout API
+ENTRIES_URL      = "/api/v1/entries.json"
+SGV_URL          = "/api/v1/entries/sgv.json"
+TREATMENTS_URL   = "/api/v1/treatments.json"
+DEVICESTATUS_URL = "/api/v1/devicestatus.json"
+
+COLLECTIONS = ["entries", "treatments", "devicestatus"]
+UPLOAD_URLS = { "entries": ENTRIES_URL, "treatments": TREATMENTS_URL, "devicestatus": DEVICESTATUS_URL }
+# Query of the uploaded records: (URL, uploader field, time field)
+QUERIES     = { "entries":      (SGV_URL, "device", "date"),
+                "treatments":   (TREATMENTS_URL, "enteredBy", "created_at"),
+                "devicestatus": (DEVICESTATUS_URL, "device", "created_at") }
+
+# Upload settings
+DEVICE       = "carelink-python-client"
+MAX_BATCH    = 500
+MAX_QUERY    = 2000
+DATA_WINDOW  = 26 * 3600
+TIMEOUT      = 30
+RETRIES      = 4
+BACKOFF      = 2.0
+BACKOFF_MAX  = 60.0
+RETRY_CODES  = [429, 500, 502, 503, 504]
+
+# Carelink trend -> Nightscout direction
+DIRECTIONS = {
+   "UP_TRIPLE":   "TripleUp",
+   "UP_DOUBLE":   "DoubleUp",
+   "UP":          "SingleUp",
+   "NONE":        "Flat",
+   "DOWN":        "SingleDown",
+   "DOWN_DOUBLE": "DoubleDown",
+   "DOWN_TRIPLE": "TripleDown",
+   }
+
+
+###########################################################
+# Convert epoch seconds to ISO 8601 string (UTC)
+###########################################################
+def iso_time(ts):
+   return datetime.fromtimestamp(ts, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+###########################################################
+# Get a marker field (in the marker itself or in its data
+# values, depending on the data format version)
+###########################################################
+def marker_field(marker, key):
+   values = (marker.get("data") or {}).get("dataValues") or {}
+   for source in [marker, values]:
+      if source.get(key) not in [None, ""]:
+         return source[key]
+   return None
+
+
+###########################################################
+# Get the first numeric marker field of the given keys
+###########################################################
+def marker_value(marker, *keys):
+   for key in keys:
+      try:
+         return float(marker_field(marker, key))
+      except (TypeError, ValueError):
+         pass
+   return None
+
+
+###########################################################
+# Convert sensor glucose readings to Nightscout entries
+###########################################################
+def to_entries(data):
+   entries = []
+   for r in carelink_history.iter_sgs(data):
+      if not r.sg or r.sg <= 0:
+         continue
+      entry = { "type": "sgv", "sgv": r.sg, "date": r.timestamp * 1000, "dateString": iso_time(r.timestamp), "device": DEVICE }
+      if r.trend in DIRECTIONS:
+         entry["direction"] = DIRECTIONS[r.trend]
+      entries.append((r.timestamp, entry))
+   return entries
+
+
+###########################################################
+# Convert markers to Nightscout treatments
+###########################################################
+def to_treatments(data):
+   treatments = []
+   for ts, mtype, marker in carelink_history.iter_markers(data):
+      treatment = None
+      if mtype == "INSULIN":
+         amount = marker_value(marker, "deliveredFastAmount", "programmedFastAmount")
+         if amount:
+            automatic = marker_field(marker, "activationType") == "AUTOCORRECTION"
+            treatment = { "eventType": "Correction Bolus" if automatic else "Meal Bolus", "insulin": amount }
+      elif mtype == "MEAL":
+         amount = marker_value(marker, "amount")
+         if amount:
+            treatment = { "eventType": "Carb Correction", "carbs": amount }
+      elif mtype in ["BG_READING", "CALIBRATION"]:
+         value = marker_value(marker, "bgValue", "unitValue", "value")
+         if value:
+            treatment = { "eventType": "BG Check", "glucose": value, "glucoseType": "Finger", "units": "mg/dl" }
+      if treatment is not None:
+         treatment.update({ "created_at": iso_time(ts), "enteredBy": DEVICE })
+         treatments.append((ts, treatment))
+   return treatments
+
+
+###########################################################
+# Convert pump status to Nightscout devicestatus
+###########################################################
+def to_devicestatus(data):
+   patient_data = carelink_history.get_patient_data(data)
+   update_time = patient_data.get("lastConduitUpdateServerTime") or (data or {}).get("lastConduitUpdateServerTime")
+   if not update_time:
+      return []
+   ts = int(update_time / 1000)
+   active_insulin = patient_data.get("activeInsulin") or {}
+   status = {
+      "device":     DEVICE,
+      "created_at": iso_time(ts),
+      "pump": {
+         "clock":     iso_time(ts),
+         "reservoir": patient_data.get("reservoirRemainingUnits"),
+         "battery":   { "percent": patient_data.get("medicalDeviceBatteryLevelPercent") },
+         "iob":       { "iob": active_insulin.get("amount"), "timestamp": iso_time(ts) },
+         "status":    { "suspended": patient_data.get("medicalDeviceSuspended") },
+         },
+      "uploader": { "battery": patient_data.get("conduitBatteryLevel") },
+      "connect": {
+         "sensorState":          patient_data.get("sensorState"),
+         "systemStatusMessage":  patient_data.get("systemStatusMessage"),
+         "sensorDurationHours":  patient_data.get("sensorDurationHours"),
+         "pumpInRange":          patient_data.get("conduitMedicalDeviceInRange"),
+         "sensorInRange":        patient_data.get("conduitSensorInRange"),
+         },
+      }
+   return [(ts, status)]
+
+
+CONVERTERS = { "entries": to_entries, "treatments": to_treatments, "devicestatus": to_devicestatus }
+
+
+###########################################################
+# Get the time of a record returned by Nightscout
+###########################################################
+def ns_record_time(record):
+   if "date" in record:
+      return int(record["date"] / 1000)
+   try:
+      return carelink_history.parse_time(record["created_at"])
+   except (KeyError, TypeError, ValueError):
+      return None
+
+
+###########################################################
+# Get the key of a record (records with the same key are
+# the same record)
+###########################################################
+def record_key(collection, ts, record):
+   if collection == "treatments":
+      return (ts, record.get("eventType"), record.get("insulin"), record.get("carbs"), record.get("glucose"))
+   return (ts,)
+
+
+###########################################################
+# Class NightscoutUploader
+###########################################################
+class NightscoutUploader(object):
+
+   def __init__(self, url, api_secret=None, token=None, httpClient=None, sleep=time.sleep):
+      self.__url = url.rstrip("/")
+      self.__token = token
+      self.__headers = { "Content-Type": "application/json", "Accept": "application/json" }
+      if api_secret:
+         self.__headers["api-secret"] = hashlib.sha1(api_secret.encode()).hexdigest()
+      # One session, so the connection is reused between requests
+      self.__httpClient = requests.Session() if httpClient is None else httpClient
+      self.__sleep = sleep
+      # Keys of the uploaded records within the data window
+      # (None = not yet initialized from Nightscout)
+      self.uploaded = { c: None for c in COLLECTIONS }
+
+   ###########################################################
+   # Send request, retry with exponential backoff
+   ###########################################################
+   def _request(self, method, path, body=None):
+      url = self.__url + path
+      if self.__token:
+         url += ("&" if "?" in url else "?") + "token=" + self.__token
+      delay = 1.0
+      for attempt in range(RETRIES + 1):
+         try:
+            if method == "POST":
+               response = self.__httpClient.post(url, headers=self.__headers, data=json.dumps(body), timeout=TIMEOUT)
+            else:
+               response = self.__httpClient.get(url, headers=self.__headers, timeout=TIMEOUT)
+            if response.status_code not in RETRY_CODES:
+               return response
+            log.debug("nightscout: %s %s returned %d" % (method, path, response.status_code))
+         except (requests.ConnectionError, requests.Timeout) as e:
+            response = None
+            log.debug("nightscout: %s %s failed (%s)" % (method, path, e))
+         if attempt < RETRIES:
+            # Full jitter, so many uploaders don't retry in lockstep
+            self.__sleep(random.uniform(0, delay))
+            delay = min(delay * BACKOFF, BACKOFF_MAX)
+      return response
+
+   ###########################################################
+   # Initialize the keys of the uploaded records from the
+   # records of this uploader in Nightscout since the given
+   # time
+   ###########################################################
+   def _init_uploaded(self, collection, since):
+      path, device_field, time_field = QUERIES[collection]
+      query = { "find[%s]" % device_field: DEVICE,
+                "find[%s][$gte]" % time_field: since * 1000 if time_field == "date" else iso_time(since),
+                "count": MAX_QUERY }
+      response = self._request("GET", path + "?" + urlencode(query))
+      if response is None or response.status_code != 200:
+         raise Exception("unable to get uploaded %s from Nightscout (%s)" %
+                         (collection, "no response" if response is None else response.status_code))
+      uploaded = set()
+      for record in response.json():
+         ts = ns_record_time(record)
+         if ts is not None:
+            uploaded.add(record_key(collection, ts, record))
+      self.uploaded[collection] = uploaded
+      log.debug("nightscout: %d %s uploaded before" % (len(uploaded), collection))
+
+   ###########################################################
+   # Upload the records of one collection which were not
+   # uploaded yet
+   # Returns number of uploaded records
+   ###########################################################
+   def upload_collection(self, collection, records):
+      if not records:
+         return 0
+      newest = max(r[0] for r in records)
+      if self.uploaded[collection] is None:
+         self._init_uploaded(collection, newest - DATA_WINDOW)
+      uploaded = self.uploaded[collection]
+      records = sorted([ r for r in records if record_key(collection, r[0], r[1]) not in uploaded ], key=lambda r: r[0])
+      count = 0
+      for i in range(0, len(records), MAX_BATCH):
+         batch = records[i:i+MAX_BATCH]
+         response = self._request("POST", UPLOAD_URLS[collection], [ r[1] for r in batch ])
+         if response is None or response.status_code != 200:
+            raise Exception("failed to upload %s to Nightscout (%s)" %
+                            (collection, "no response" if response is None else response.status_code))
+         # Remember records only after a successful upload
+         uploaded.update(record_key(collection, ts, r) for ts, r in batch)
+         count += len(batch)
+      # Forget records which are out of the data window
+      cutoff = newest - DATA_WINDOW
+      self.uploaded[collection] = { k for k in uploaded if k[0] >= cutoff }
+      return count
+
+   ###########################################################
+   # Upload new records of all collections from Carelink data
+   # Returns {collection: number of uploaded records}
+   ###########################################################
+   def upload(self, data):
+      result = {}
+      for collection in COLLECTIONS:
+         try:
+            result[collection] = self.upload_collection(collection, CONVERTERS[collection](data))
+         except Exception as e:
+            log.error("ERROR: %s" % e)
+            result[collection] = None
+      log.debug("nightscout: uploaded %s" % result)
+      return result
+
+
+###########################################################
+# Class StandInNightscout
+#
+# In-memory Nightscout stand-in (HTTP client interface)
+###########################################################
+class StandInNightscout(object):
+
+   def __init__(self, error_rate=0.0, seed=None):
+      self.collections = { c: [] for c in COLLECTIONS }
+      self.requests = []
+      self.__error_rate = error_rate
+      self.__rng = random.Random(seed)
+
+   def get(self, url, **kwargs):
+      return self.request("GET", url, **kwargs)
+
+   def post(self, url, **kwargs):
+      return self.request("POST", url, **kwargs)
+
+   def request(self, method, url, data=None, **kwargs):
+      parts = urlsplit(url)
+      self.requests.append((method, parts.path))
+      if self.__rng.random() < self.__error_rate:
+         return carelink_replay.make_response(method, url, 503, {}, "")
+      collection = parts.path.split("/")[3].split(".")[0]
+      if collection not in self.collections:
+         return carelink_replay.make_response(method, url, 404, {}, "")
+      if method == "POST":
+         self.collections[collection].extend(json.loads(data))
+         return carelink_replay.make_response(method, url, 200, {"Content-Type": "application/json"}, data)
+      query = parse_qs(parts.query)
+      count = int(query.get("count", [10])[0])
+      records = self.collections[collection]
+      for key, values in query.items():
+         # Filters find[field] and find[field][$gte]
+         if not key.startswith("find["):
+            continue
+         field = key[5:].split("]")[0]
+         if key.endswith("[$gte]"):
+            since = int(values[0]) // 1000 if field == "date" else carelink_history.parse_time(values[0])
+            records = [ r for r in records if (ns_record_time(r) or 0) >= since ]
+         else:
+            records = [ r for r in records if r.get(field) == values[0] ]
+      records = sorted(records, key=ns_record_time, reverse=True)[:count]
+      return carelink_replay.make_response(method, url, 200, {"Content-Type": "application/json"}, json.dumps(records))
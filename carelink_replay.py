@@ -0,0 +1,320 @@
+###############################################################################
+#
+#  Carelink record and replay transport
+#
+#  Description:
+#
+#    This module provides drop-in replacements for the requests HTTP client
+#    used by the Carelink Client libraries (client 1 and client 2):
+#
+#    - RecordingSession forwards all requests to the real Carelink Cloud
+#      and captures every exchange to a JSON fixture file. Access tokens,
+#      refresh tokens, client secrets and auth cookies are redacted before
+#      anything is written to disk.
+#
+#    - ReplaySession serves the recorded exchanges back without any network
+#      access. It can optionally inject latency, timeouts and HTTP error
+#      codes, so that the clients can be profiled deterministically.
+#
+#    Usage:
+#
+#      session = carelink_replay.ReplaySession("fixture.json",
+#                   latency=carelink_replay.uniform_latency(0.05, 0.3),
+#                   error_rate=0.1, seed=1)
+#      client = carelink_client2.CareLinkClient(httpClient=session)
+#
+#    A recording is written to the fixture file when the session is closed
+#    (at the latest when the program exits). Clients don't write token
+#    files when replaying, as the replayed tokens are redacted.
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#    19/10/2026 - Save recording on close, redact "code" only in form data
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import json
+import time
+import atexit
+import random
+import threading
+import logging as log
+import requests
+from datetime import timedelta
+from requests.structures import CaseInsensitiveDict
+from urllib.parse import urlsplit
+
+
+# Fixture file format version
+FIXTURE_VERSION = 1
+
+# Redaction
+REDACTED = "REDACTED"
+SECRET_FIELDS  = ["access_token", "refresh_token", "client_secret", "id_token", "assertion", "code_verifier", "mag-identifier"]
+# OAuth authorization code, only a secret in request form data
+# (API payloads have unrelated "code" fields)
+SECRET_FORM_FIELDS = ["code"]
+SECRET_HEADERS = ["authorization", "client-authorization", "mag-identifier", "code-verifier", "id-token", "cookie", "set-cookie"]
+SECRET_COOKIES = ["auth_tmp_token"]
+
+# Transport headers which do not apply to the decoded body we store
+TRANSPORT_HEADERS = ["content-encoding", "content-length", "transfer-encoding", "connection"]
+
+
+###########################################################
+# Redact a single secret value
+###########################################################
+def redact_value(value):
+   # Keep header and payload of JSON web tokens (they carry
+   # the expiration time and user details the clients need),
+   # but drop the signature which makes them usable
+   if isinstance(value, str) and value.count(".") == 2:
+      parts = value.split(".")
+      return parts[0] + "." + parts[1] + "." + REDACTED
+   return REDACTED
+
+
+###########################################################
+# Redact secrets from a (nested) JSON object
+###########################################################
+def redact_json(obj, fields=SECRET_FIELDS):
+   if isinstance(obj, dict):
+      return { k: redact_value(v) if k in fields and v is not None else redact_json(v, fields) for k,v in obj.items() }
+   if isinstance(obj, list):
+      return [ redact_json(v, fields) for v in obj ]
+   return obj
+
+
+###########################################################
+# Redact secrets from HTTP headers
+###########################################################
+def redact_headers(headers):
+   if headers is None:
+      return {}
+   return { k: redact_value(v) if k.lower() in SECRET_HEADERS else v for k,v in headers.items() }
+
+
+###########################################################
+# Redact secrets from a response or request body
+# (a dict body is request form data)
+###########################################################
+def redact_body(body):
+   if body is None:
+      return None
+   if isinstance(body, bytes):
+      body = body.decode("utf-8", errors="replace")
+   if isinstance(body, dict):
+      return redact_json(body, SECRET_FIELDS + SECRET_FORM_FIELDS)
+   try:
+      return json.dumps(redact_json(json.loads(body)))
+   except (ValueError, TypeError):
+      return body
+
+
+###########################################################
+# Latency distributions for replay
+# (each returns a function rng -> seconds)
+###########################################################
+def fixed_latency(seconds):
+   return lambda rng: seconds
+
+def uniform_latency(low, high):
+   return lambda rng: rng.uniform(low, high)
+
+def lognormal_latency(median, sigma):
+   # Long tailed distribution as typically seen on mobile and cloud links
+   return lambda rng: median * rng.lognormvariate(0, sigma)
+
+def recorded_latency(scale=1.0):
+   # Marker: replay the latency measured during recording
+   return "recorded", scale
+
+
+###########################################################
+# Build a requests.Response without network access
+###########################################################
+def make_response(method, url, status, headers, body, elapsed=0.0):
+   resp = requests.Response()
+   resp.status_code = status
+   resp.headers = CaseInsensitiveDict(headers)
+   resp._content = b"" if body is None else body.encode("utf-8")
+   resp.encoding = "utf-8"
+   resp.url = url
+   resp.request = requests.Request(method, url).prepare()
+   resp.reason = "Replayed"
+   resp.elapsed = timedelta(seconds=elapsed)
+   return resp
+
+
+###########################################################
+# Class RecordingSession
+###########################################################
+class RecordingSession(object):
+
+   def __init__(self, filename, session=None):
+      self.__filename = filename
+      self.__session = requests.Session() if session is None else session
+      self.__exchanges = []
+      self.__lock = threading.Lock()
+      self.__saved = 0
+      atexit.register(self.close)
+
+   # Cookie jar of the underlying session (used by client 1)
+   @property
+   def cookies(self):
+      return self.__session.cookies
+
+   def get(self, url, **kwargs):
+      return self.request("GET", url, **kwargs)
+
+   def post(self, url, **kwargs):
+      return self.request("POST", url, **kwargs)
+
+   def request(self, method, url, **kwargs):
+      start = time.monotonic()
+      resp = self.__session.request(method, url, **kwargs)
+      elapsed = time.monotonic() - start
+      exchange = {
+         "method":   method,
+         "url":      url.split("?")[0],
+         "params":   kwargs.get("params"),
+         "request":  { "headers": redact_headers(kwargs.get("headers")),
+                       "body":    redact_body(kwargs.get("data")) },
+         "status":   resp.status_code,
+         "headers":  redact_headers({ k: v for k,v in resp.headers.items() if k.lower() not in TRANSPORT_HEADERS }),
+         "cookies":  { c.name: redact_value(c.value) if c.name in SECRET_COOKIES else c.value for c in resp.cookies },
+         "body":     redact_body(resp.content),
+         "elapsed":  round(elapsed, 4),
+         }
+      with self.__lock:
+         self.__exchanges.append(exchange)
+      return resp
+
+   ###########################################################
+   # Write all exchanges recorded so far to the fixture file
+   ###########################################################
+   def save(self):
+      with self.__lock:
+         if self.__saved == len(self.__exchanges):
+            return
+         with open(self.__filename, 'w') as f:
+            json.dump({"version": FIXTURE_VERSION, "exchanges": self.__exchanges}, f, indent=1)
+         self.__saved = len(self.__exchanges)
+
+   def close(self):
+      self.save()
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+
+###########################################################
+# Class ReplaySession
+###########################################################
+class ReplaySession(object):
+
+   # Responses are recorded: redacted tokens and the Date
+   # headers of the recording time
+   recorded = True
+
+   def __init__(self, filename, latency=None, timeout_rate=0.0, timeout_after=0.0,
+                error_rate=0.0, error_codes=(500,502,503), seed=None, sleep=time.sleep):
+
+      # Recorded exchanges, grouped by method and URL
+      self.__queues = {}
+      self.__pos = {}
+      for e in self._read_fixture(filename):
+         self.__queues.setdefault((e["method"], e["url"]), []).append(e)
+
+      # Fault injection
+      self.__latency = latency
+      self.__timeout_rate = timeout_rate
+      self.__timeout_after = timeout_after
+      self.__error_rate = error_rate
+      self.__error_codes = list(error_codes)
+      self.__rng = random.Random(seed)
+      self.__sleep = sleep
+      self.__lock = threading.Lock()
+
+      # Statistics
+      self.stats = { "requests": 0, "timeouts": 0, "errors": 0, "latency": 0.0 }
+
+      # Cookie jar (used by client 1)
+      self.cookies = requests.cookies.RequestsCookieJar()
+
+   ###########################################################
+   # Read fixture file
+   ###########################################################
+   def _read_fixture(self, filename):
+      with open(filename, "r") as f:
+         fixture = json.load(f)
+      if fixture.get("version") != FIXTURE_VERSION:
+         raise Exception("ERROR: unsupported fixture version %s in %s" % (fixture.get("version"), filename))
+      return fixture["exchanges"]
+
+   ###########################################################
+   # Get next recorded exchange for a request
+   # (the last one is repeated when the queue is exhausted)
+   ###########################################################
+   def _next_exchange(self, method, url):
+      key = (method, url.split("?")[0])
+      if key not in self.__queues:
+         raise requests.exceptions.ConnectionError("no recorded exchange for %s %s" % key)
+      queue = self.__queues[key]
+      pos = self.__pos.get(key, 0)
+      self.__pos[key] = pos + 1
+      return queue[min(pos, len(queue)-1)]
+
+   def get(self, url, **kwargs):
+      return self.request("GET", url, **kwargs)
+
+   def post(self, url, **kwargs):
+      return self.request("POST", url, **kwargs)
+
+   def request(self, method, url, **kwargs):
+      with self.__lock:
+         exchange = self._next_exchange(method, url)
+         self.stats["requests"] += 1
+
+         # Draw all random decisions under the lock to keep
+         # replays deterministic for a given seed
+         if self.__latency is None:
+            delay = 0.0
+         elif isinstance(self.__latency, tuple) and self.__latency[0] == "recorded":
+            delay = exchange.get("elapsed", 0.0) * self.__latency[1]
+         else:
+            delay = self.__latency(self.__rng)
+         timeout = self.__rng.random() < self.__timeout_rate
+         error = not timeout and self.__rng.random() < self.__error_rate
+         error_code = self.__rng.choice(self.__error_codes) if error else None
+
+      if timeout:
+         self.__sleep(self.__timeout_after)
+         with self.__lock:
+            self.stats["timeouts"] += 1
+         log.debug("   replay: injected timeout for %s %s" % (method, url))
+         raise requests.exceptions.Timeout("injected timeout for %s %s" % (method, url))
+
+      self.__sleep(delay)
+      with self.__lock:
+         self.stats["latency"] += delay
+
+      if error:
+         with self.__lock:
+            self.stats["errors"] += 1
+         log.debug("   replay: injected status %d for %s %s" % (error_code, method, url))
+         return make_response(method, url, error_code, {}, "", delay)
+
+      for name,value in exchange.get("cookies", {}).items():
+         self.cookies.set(name, value, domain=urlsplit(url).hostname)
+      return make_response(method, url, exchange["status"], exchange["headers"], exchange["body"], delay)
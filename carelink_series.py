@@ -0,0 +1,376 @@
+###############################################################################
+#
+#  Carelink binary glucose series
+#
+#  Description:
+#
+#    This module implements a compact binary file format for sensor glucose
+#    series (timestamp, value, trend, sensor state), which can be memory
+#    mapped and read without parsing or copying.
+#
+#    File format (version 1, all integers little endian):
+#
+#      Header (64 bytes)
+#        offset  size  field
+#          0      4    magic "CLSG"
+#          4      2    format version (1)
+#          6      2    record size (8)
+#          8      8    record count
+#         16      4    index interval (records per index entry)
+#         20      4    index entry count
+#         24      8    index offset (bytes from start of file)
+#         32      8    string table offset
+#         40      4    string table length
+#         44     20    reserved (0)
+#
+#      Records (record count * 8 bytes, sorted by timestamp, unique)
+#          0      4    timestamp (uint32, epoch seconds UTC)
+#          4      2    sensor glucose (uint16, mg/dL, 0 = no reading)
+#          6      1    trend (uint8, string code)
+#          7      1    sensor state (uint8, string code)
+#
+#      Sparse time index (index entry count * 4 bytes)
+#        timestamp (uint32) of every index interval'th record, a reader
+#        finds the block of a time with it and searches only that block
+#
+#      String table (string table length bytes)
+#        JSON list of the trend and sensor state strings, string code n
+#        is element n-1 of the list, code 0 means none
+#
+#    SeriesFile memory maps a file and returns the records of a time range
+#    as Reading tuples or, with NumPy, as array views of the mapped file.
+#
+#    merge() appends new readings without decoding the file when they are
+#    all newer than the last record (the usual case for periodic downloads):
+#    the existing records and index are copied as they are. Otherwise the
+#    readings are merged and re-encoded. Either way the new file is written
+#    next to the old one and replaces it atomically, so an interrupted merge
+#    leaves the old file intact.
+#
+#    Usage:
+#
+#      carelink_series.write("history.sgs", carelink_history.iter_sgs(recentData))
+#      with carelink_series.SeriesFile("history.sgs") as series:
+#         timestamps, values = series.series(start, end)
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#    19/10/2026 - Append new readings without decoding, read sg 0 as None
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import os
+import json
+import mmap
+import struct
+import bisect
+import carelink_history
+try:
+   import numpy as np
+except ImportError:
+   np = None
+
+
+# File format
+MAGIC          = b"CLSG"
+VERSION        = 1
+HEADER         = struct.Struct("<4sHHQIIQQI20x")
+RECORD         = struct.Struct("<IHBB")
+INDEX_ENTRY    = struct.Struct("<I")
+INDEX_INTERVAL = 256
+MAX_STRINGS    = 255
+
+# Record layout as NumPy dtype
+DTYPE = None if np is None else np.dtype([("timestamp", "<u4"), ("sg", "<u2"), ("trend", "u1"), ("sensorState", "u1")])
+
+
+###########################################################
+# Sort readings by timestamp, keep one reading per
+# timestamp (the trend is taken from any duplicate)
+###########################################################
+def merge_readings(*sources):
+   readings = {}
+   for source in sources:
+      for r in source:
+         known = readings.get(r.timestamp)
+         if known is None:
+            readings[r.timestamp] = r
+         elif known.trend is None and r.trend is not None:
+            readings[r.timestamp] = known._replace(trend=r.trend)
+   return [ readings[ts] for ts in sorted(readings) ]
+
+
+###########################################################
+# Get function which maps strings to codes (new strings are
+# added to the list)
+###########################################################
+def string_coder(strings):
+   codes = { s: i+1 for i, s in enumerate(strings) }
+   def code(value):
+      if value is None:
+         return 0
+      if value not in codes:
+         if len(strings) >= MAX_STRINGS:
+            raise ValueError("too many different trend and sensor state values")
+         strings.append(value)
+         codes[value] = len(strings)
+      return codes[value]
+   return code
+
+
+###########################################################
+# Encode readings as records, first is the position of the
+# first reading in the file
+# Returns (records, index entries)
+###########################################################
+def encode_records(readings, code, first=0, index_interval=INDEX_INTERVAL):
+   records = bytearray(len(readings) * RECORD.size)
+   index = []
+   for i, r in enumerate(readings):
+      RECORD.pack_into(records, i * RECORD.size, r.timestamp, r.sg or 0, code(r.trend), code(r.sensorState))
+      if (first + i) % index_interval == 0:
+         index.append(INDEX_ENTRY.pack(r.timestamp))
+   return bytes(records), index
+
+
+def encode_header(count, index_interval, index_count, strings_length):
+   index_offset = HEADER.size + count * RECORD.size
+   strings_offset = index_offset + index_count * INDEX_ENTRY.size
+   return HEADER.pack(MAGIC, VERSION, RECORD.size, count, index_interval, index_count,
+                      index_offset, strings_offset, strings_length)
+
+
+###########################################################
+# Encode readings in the binary format
+###########################################################
+def encode(readings, index_interval=INDEX_INTERVAL):
+   readings = merge_readings(readings)
+   strings = []
+   records, index = encode_records(readings, string_coder(strings), 0, index_interval)
+   string_table = json.dumps(strings).encode()
+   header = encode_header(len(readings), index_interval, len(index), len(string_table))
+   return header + records + b"".join(index) + string_table
+
+
+###########################################################
+# Write file content atomically
+###########################################################
+def replace_file(filename, content):
+   tmp = filename + ".tmp"
+   with open(tmp, "wb") as f:
+      f.write(content)
+      f.flush()
+      os.fsync(f.fileno())
+   os.replace(tmp, filename)
+
+
+###########################################################
+# Write readings to file (atomically)
+###########################################################
+def write(filename, readings):
+   replace_file(filename, encode(readings))
+
+
+###########################################################
+# Append readings (sorted, unique) to file (atomically, the
+# existing records are copied without decoding them)
+# Returns number of readings in the file, or None if the
+# readings don't only add records after the last one
+###########################################################
+def append(filename, readings):
+   with SeriesFile(filename) as series:
+      first, last = series.time_range()
+      for r in readings:
+         if last is not None and r.timestamp <= last:
+            # Known readings are fine, unless they add a trend
+            known = series.get(r.timestamp)
+            if known is None or (known.trend is None and r.trend is not None):
+               return None
+      new = [ r for r in readings if last is None or r.timestamp > last ]
+      count, index_interval = series.count, series.index_interval
+      strings = series.strings[1:]
+   if not new:
+      return count
+
+   code = string_coder(strings)
+   records, index = encode_records(new, code, count, index_interval)
+   string_table = json.dumps(strings).encode()
+   with open(filename, "rb") as f:
+      (_, _, _, _, _, index_count, index_offset, strings_offset, _) = HEADER.unpack(f.read(HEADER.size))
+      old_records = f.read(index_offset - HEADER.size)
+      old_index = f.read(strings_offset - index_offset)
+   header = encode_header(count + len(new), index_interval, index_count + len(index), len(string_table))
+   replace_file(filename, header + old_records + records + old_index + b"".join(index) + string_table)
+   return count + len(new)
+
+
+###########################################################
+# Merge new readings into file (created if missing)
+# Returns number of readings in the file
+###########################################################
+def merge(filename, readings):
+   readings = merge_readings(readings)
+   if os.path.exists(filename):
+      count = append(filename, readings)
+      if count is not None:
+         return count
+      with SeriesFile(filename) as series:
+         readings = merge_readings(list(series.readings()), readings)
+   write(filename, readings)
+   return len(readings)
+
+
+###########################################################
+# Export readings of the history store to file
+###########################################################
+def export_history(store, filename, start=None, end=None):
+   first, last = store.time_range()
+   start = (first or 0) if start is None else start
+   end = (last or 0) + 1 if end is None else end
+   readings = [ carelink_history.Reading(*r) for r in store.query("sgs", start, end) ]
+   write(filename, readings)
+   return len(readings)
+
+
+###########################################################
+# Import readings from file into the history store
+# Returns the readings which were new
+###########################################################
+def import_history(store, filename):
+   with SeriesFile(filename) as series:
+      return store.add_records(list(series.readings()))
+
+
+###########################################################
+# Class SeriesFile
+#
+# Reader of a memory mapped series file (or of a bytes
+# buffer with the same content)
+###########################################################
+class SeriesFile(object):
+
+   def __init__(self, filename=None, buffer=None):
+      self.__file = None
+      if buffer is None:
+         self.__file = open(filename, "rb")
+         buffer = mmap.mmap(self.__file.fileno(), 0, access=mmap.ACCESS_READ)
+      self.__buffer = buffer
+
+      if len(buffer) < HEADER.size:
+         raise ValueError("series file too short")
+      (magic, version, record_size, self.count, self.index_interval, index_count,
+       index_offset, strings_offset, strings_length) = HEADER.unpack_from(buffer, 0)
+      if magic != MAGIC:
+         raise ValueError("not a series file")
+      if version != VERSION or record_size != RECORD.size:
+         raise ValueError("unsupported series file version %d" % version)
+      if (index_offset != HEADER.size + self.count * RECORD.size or
+          strings_offset != index_offset + index_count * INDEX_ENTRY.size or
+          len(buffer) < strings_offset + strings_length):
+         raise ValueError("corrupt series file")
+
+      # The sparse index and the string table are small, the
+      # records are read from the buffer when needed
+      self.__index = [ v for v, in INDEX_ENTRY.iter_unpack(buffer[index_offset:strings_offset]) ]
+      self.strings = [None] + json.loads(bytes(buffer[strings_offset:strings_offset+strings_length]))
+
+   def __len__(self):
+      return self.count
+
+   def __enter__(self):
+      return self
+
+   def __exit__(self, *args):
+      self.close()
+
+   def close(self):
+      if self.__file is not None:
+         try:
+            self.__buffer.close()
+         except BufferError:
+            # Array views still exist, the mapping is closed when they are released
+            pass
+         self.__file.close()
+         self.__file = None
+
+   def _timestamp(self, i):
+      return struct.unpack_from("<I", self.__buffer, HEADER.size + i * RECORD.size)[0]
+
+   ###########################################################
+   # Get position of the first record at or after ts
+   ###########################################################
+   def find(self, ts):
+      block = bisect.bisect_right(self.__index, ts) - 1
+      if block < 0:
+         return 0
+      lo = block * self.index_interval
+      hi = min(lo + self.index_interval, self.count)
+      while lo < hi:
+         mid = (lo + hi) // 2
+         if self._timestamp(mid) < ts:
+            lo = mid + 1
+         else:
+            hi = mid
+      return lo
+
+   def _range(self, start, end):
+      first = 0 if start is None else self.find(start)
+      last = self.count if end is None else self.find(end)
+      return first, max(first, last)
+
+   ###########################################################
+   # Get reading at time ts (None if there is none)
+   ###########################################################
+   def get(self, ts):
+      i = self.find(ts)
+      if i >= self.count or self._timestamp(i) != ts:
+         return None
+      ts, sg, trend, state = RECORD.unpack_from(self.__buffer, HEADER.size + i * RECORD.size)
+      return carelink_history.Reading(ts, sg or None, self.strings[trend], self.strings[state])
+
+   ###########################################################
+   # Get time range: (first, last) or (None, None)
+   ###########################################################
+   def time_range(self):
+      if self.count == 0:
+         return None, None
+      return self._timestamp(0), self._timestamp(self.count - 1)
+
+   ###########################################################
+   # Iterate over the readings in [start, end) (sg 0 is
+   # returned as None, no reading)
+   ###########################################################
+   def readings(self, start=None, end=None):
+      first, last = self._range(start, end)
+      with memoryview(self.__buffer) as view:
+         records = view[HEADER.size + first * RECORD.size:HEADER.size + last * RECORD.size]
+         for ts, sg, trend, state in RECORD.iter_unpack(records):
+            yield carelink_history.Reading(ts, sg or None, self.strings[trend], self.strings[state])
+         records.release()
+
+   ###########################################################
+   # Get the records in [start, end) as NumPy array view
+   # (fields timestamp, sg, trend and sensorState)
+   ###########################################################
+   def array(self, start=None, end=None):
+      if np is None:
+         raise Exception("ERROR: NumPy is required for array access")
+      first, last = self._range(start, end)
+      return np.frombuffer(self.__buffer, dtype=DTYPE, count=last - first, offset=HEADER.size + first * RECORD.size)
+
+   ###########################################################
+   # Get series (timestamps, values) of the valid readings in
+   # [start, end), e.g. for carelink_agp
+   ###########################################################
+   def series(self, start=None, end=None):
+      a = self.array(start, end)
+      if (a["sg"] == 0).any():
+         a = a[a["sg"] > 0]
+      return a["timestamp"], a["sg"]
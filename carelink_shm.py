@@ -0,0 +1,352 @@
+###############################################################################
+#
+#  Carelink shared memory snapshot region
+#
+#  Description:
+#
+#    This module implements a memory mapped region which holds the latest
+#    set of encoded Carelink documents (e.g. the JSON responses of the proxy).
+#    One process writes (publishes) new documents, any number of processes
+#    on the same host can read them concurrently without locks.
+#
+#    Consistency is ensured by a sequence lock: the writer makes the
+#    sequence number odd while it updates the region and even again when
+#    it is done. A reader retries if the sequence number was odd or changed
+#    during its read. A CRC32 of the payload protects readers on CPUs with
+#    weak memory ordering.
+#
+#    Region layout (little endian):
+#
+#      offset  size  field
+#      0       4     magic "CLSN"
+#      4       4     layout version
+#      8       8     sequence number
+#      16      8     payload length
+#      24      4     payload CRC32
+#      28      4     reserved
+#      32      8     capacity (max payload length)
+#      40      24    reserved
+#      64      ...   payload
+#
+#    Payload: u32 document count, then for each document:
+#      u16 name length, name (utf-8), u32 data length, data
+#
+#    Local consumers can be notified about new versions via a Unix domain
+#    socket: the publisher sends the new sequence number (u64 little endian)
+#    to all connected subscribers, and once right after they connect.
+#
+#    Consumer example:
+#
+#      feed = carelink_shm.SnapshotSubscriber("/run/carelink/feed.snap")
+#      while True:
+#         seq, docs = feed.wait()
+#         data = json.loads(bytes(docs["carelink/nohistory"]))
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#    19/10/2026 - Add zero copy views and Unix domain socket notifier
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import os
+import mmap
+import time
+import struct
+import zlib
+import socket
+import select
+import threading
+import tempfile
+import logging as log
+
+
+# Region format
+MAGIC          = b"CLSN"
+LAYOUT_VERSION = 1
+HEADER         = struct.Struct("<4sIQQII Q24x")
+HEADER_SIZE    = HEADER.size
+SEQ_OFFSET     = 8
+SEQ            = struct.Struct("<Q")
+DEFAULT_CAPACITY = 16 * 1024 * 1024
+
+# Reader settings
+READ_RETRIES = 100
+
+# Notifier settings
+NOTIFY_MSG = struct.Struct("<Q")
+NOTIFY_BACKLOG = 16
+
+
+###########################################################
+# Default region path (RAM backed if available)
+###########################################################
+def default_path(name):
+   shm_dir = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+   return os.path.join(shm_dir, name)
+
+
+###########################################################
+# Encode a set of documents {name: bytes} into a payload
+###########################################################
+def pack_documents(docs):
+   parts = [struct.pack("<I", len(docs))]
+   for name, data in docs.items():
+      bname = name.encode("utf-8")
+      parts.append(struct.pack("<H", len(bname)))
+      parts.append(bname)
+      parts.append(struct.pack("<I", len(data)))
+      parts.append(data)
+   return b"".join(parts)
+
+
+###########################################################
+# Decode a payload into a set of documents {name: bytes}
+# (the documents are views into the payload, not copies)
+###########################################################
+def unpack_documents(payload):
+   view = memoryview(payload)
+   docs = {}
+   count, = struct.unpack_from("<I", view, 0)
+   pos = 4
+   for i in range(count):
+      nlen, = struct.unpack_from("<H", view, pos)
+      pos += 2
+      name = bytes(view[pos:pos+nlen]).decode("utf-8")
+      pos += nlen
+      dlen, = struct.unpack_from("<I", view, pos)
+      pos += 4
+      docs[name] = view[pos:pos+dlen]
+      pos += dlen
+   return docs
+
+
+###########################################################
+# Class SnapshotRegion
+###########################################################
+class SnapshotRegion(object):
+
+   def __init__(self, path, create=False, capacity=DEFAULT_CAPACITY):
+      self.path = path
+      self.writer = create
+
+      if create:
+         # Sparse file, memory is only used for the actual payload
+         fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+         try:
+            os.ftruncate(fd, HEADER_SIZE + capacity)
+            self.__mm = mmap.mmap(fd, HEADER_SIZE + capacity)
+         finally:
+            os.close(fd)
+         HEADER.pack_into(self.__mm, 0, MAGIC, LAYOUT_VERSION, 0, 0, 0, 0, capacity)
+      else:
+         fd = os.open(path, os.O_RDONLY)
+         try:
+            self.__mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+         finally:
+            os.close(fd)
+         magic, version = struct.unpack_from("<4sI", self.__mm, 0)
+         if magic != MAGIC:
+            raise Exception("ERROR: %s is not a snapshot region" % path)
+         if version != LAYOUT_VERSION:
+            raise Exception("ERROR: snapshot region %s has version %d, expected version %d" % (path, version, LAYOUT_VERSION))
+
+      self.capacity = HEADER.unpack_from(self.__mm, 0)[6]
+
+   ###########################################################
+   # Current sequence number (0 = nothing published yet)
+   ###########################################################
+   def sequence(self):
+      return SEQ.unpack_from(self.__mm, SEQ_OFFSET)[0]
+
+   ###########################################################
+   # Publish a new set of documents (writer only)
+   ###########################################################
+   def publish(self, docs):
+      payload = pack_documents(docs)
+      if len(payload) > self.capacity:
+         log.error("ERROR: snapshot of %d bytes exceeds region capacity %d" % (len(payload), self.capacity))
+         return None
+      seq = self.sequence()
+      SEQ.pack_into(self.__mm, SEQ_OFFSET, seq + 1)
+      self.__mm[HEADER_SIZE:HEADER_SIZE+len(payload)] = payload
+      HEADER.pack_into(self.__mm, 0, MAGIC, LAYOUT_VERSION, seq + 1, len(payload), zlib.crc32(payload), 0, self.capacity)
+      SEQ.pack_into(self.__mm, SEQ_OFFSET, seq + 2)
+      return seq + 2
+
+   ###########################################################
+   # Read the latest set of documents
+   # Returns (seq, docs), docs is None if the sequence number
+   # is still last_seq or nothing has been published yet
+   ###########################################################
+   def read(self, last_seq=None):
+      for i in range(READ_RETRIES):
+         seq = self.sequence()
+         if seq & 1:
+            # Write in progress
+            time.sleep(0)
+            continue
+         if seq == last_seq or seq == 0:
+            return seq, None
+         _, _, _, length, crc, _, _ = HEADER.unpack_from(self.__mm, 0)
+         # One copy per published version
+         payload = self.__mm[HEADER_SIZE:HEADER_SIZE+length]
+         if self.sequence() == seq and zlib.crc32(payload) == crc:
+            return seq, unpack_documents(payload)
+      log.error("ERROR: unable to read consistent snapshot from %s" % self.path)
+      return last_seq, None
+
+   ###########################################################
+   # Get the latest set of documents without copying
+   # Returns (seq, docs) with docs as views into the mapping.
+   # The views are only valid as long as changed(seq) is False,
+   # so check it after processing them.
+   ###########################################################
+   def view(self):
+      for i in range(READ_RETRIES):
+         seq = self.sequence()
+         if seq & 1:
+            time.sleep(0)
+            continue
+         if seq == 0:
+            return seq, None
+         _, _, _, length, crc, _, _ = HEADER.unpack_from(self.__mm, 0)
+         payload = memoryview(self.__mm)[HEADER_SIZE:HEADER_SIZE+length]
+         if self.sequence() == seq:
+            return seq, unpack_documents(payload)
+      return None, None
+
+   ###########################################################
+   # Check if the region has changed since sequence number seq
+   ###########################################################
+   def changed(self, seq):
+      return self.sequence() != seq
+
+   ###########################################################
+   # Close region (the writer also removes the file)
+   ###########################################################
+   def close(self):
+      self.__mm.close()
+      if self.writer:
+         try:
+            os.unlink(self.path)
+         except OSError:
+            pass
+
+
+###########################################################
+# Class SnapshotNotifier
+#
+# Notifies local subscribers about new versions via a 
+# Unix domain socket
+###########################################################
+class SnapshotNotifier(object):
+
+   def __init__(self, path, region):
+      self.path = path
+      self.__region = region
+      self.__clients = []
+      self.__lock = threading.Lock()
+
+      if os.path.exists(path):
+         os.unlink(path)
+      self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.__sock.bind(path)
+      self.__sock.listen(NOTIFY_BACKLOG)
+
+      t = threading.Thread(target=self._accept_thread, args=())
+      t.daemon = True
+      t.start()
+
+   ###########################################################
+   # Accept new subscribers
+   ###########################################################
+   def _accept_thread(self):
+      while True:
+         try:
+            conn, addr = self.__sock.accept()
+         except OSError:
+            break
+         conn.setblocking(False)
+         with self.__lock:
+            # Tell new subscriber about the current version
+            if self._send(conn, self.__region.sequence()):
+               self.__clients.append(conn)
+
+   def _send(self, conn, seq):
+      try:
+         conn.send(NOTIFY_MSG.pack(seq))
+         return True
+      except OSError:
+         # Subscriber gone or not reading anymore
+         conn.close()
+         return False
+
+   ###########################################################
+   # Notify all subscribers about a new version
+   ###########################################################
+   def notify(self, seq):
+      with self.__lock:
+         self.__clients = [ c for c in self.__clients if self._send(c, seq) ]
+
+   ###########################################################
+   # Stop notifier and remove socket
+   ###########################################################
+   def close(self):
+      self.__sock.close()
+      with self.__lock:
+         for c in self.__clients:
+            c.close()
+         self.__clients = []
+      try:
+         os.unlink(self.path)
+      except OSError:
+         pass
+
+
+###########################################################
+# Class SnapshotSubscriber
+#
+# Waits for new versions of a snapshot region
+###########################################################
+class SnapshotSubscriber(object):
+
+   def __init__(self, path, socket_path=None):
+      self.region = SnapshotRegion(path)
+      self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+      self.__sock.connect(path + ".sock" if socket_path is None else socket_path)
+      self.__seq = None
+      self.__buf = b""
+
+   ###########################################################
+   # Wait for a version newer than the last one returned
+   # Returns (seq, docs) with docs as views into the mapping
+   # (see SnapshotRegion.view()), or (None, None) on timeout
+   ###########################################################
+   def wait(self, timeout=None):
+      deadline = None if timeout is None else time.monotonic() + timeout
+      while True:
+         # Skip notifications which are already outdated
+         latest = self.region.sequence()
+         if latest != self.__seq and latest != 0 and not latest & 1:
+            seq, docs = self.region.view()
+            if docs is not None:
+               self.__seq = seq
+               return seq, docs
+         remaining = None if deadline is None else deadline - time.monotonic()
+         if remaining is not None and remaining <= 0:
+            return None, None
+         ready, _, _ = select.select([self.__sock], [], [], remaining)
+         if ready:
+            data = self.__sock.recv(4096)
+            if not data:
+               raise ConnectionError("snapshot publisher has gone away")
+
+   def close(self):
+      self.__sock.close()
@@ -0,0 +1,296 @@
+###############################################################################
+#
+#  Carelink sinks
+#
+#  Description:
+#
+#    This module distributes new Carelink data to consumers (sinks) like
+#    Nightscout, webhooks or archives without letting a slow consumer delay
+#    the polling of the Carelink Cloud.
+#
+#    Each sink gets its own bounded queue, drained by its own worker thread.
+#    When a queue is full, its overflow policy decides what happens:
+#
+#    - drop-oldest:     the oldest queued item is dropped
+#    - coalesce-latest: queued items are replaced by the new one (for sinks
+#                       which only need the latest state)
+#    - block:           the publisher waits for free space, at most
+#                       BLOCK_TIMEOUT seconds, then the oldest item is dropped
+#
+#    SnapshotFileSink saves the latest data compactly (gzip compressed JSON)
+#    and atomically to a file, from which it can be loaded with
+#    load_snapshot() (e.g. to serve it right after a restart).
+#
+#    Usage:
+#
+#      class PrintSink(carelink_sinks.Sink):
+#         def send(self, data):
+#            print(data["patientData"]["lastSG"])
+#
+#      sinks = carelink_sinks.SinkPipeline()
+#      sinks.add(PrintSink("print"), policy=carelink_sinks.COALESCE_LATEST)
+#      sinks.publish(client.getRecentData())
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#    19/10/2026 - Add snapshot file sink
+#    19/10/2026 - Retry failed webhook requests (optional)
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import os
+import time
+import json
+import gzip
+import threading
+import requests
+import logging as log
+from collections import deque
+
+
+# Overflow policies
+DROP_OLDEST     = "drop-oldest"
+COALESCE_LATEST = "coalesce-latest"
+BLOCK           = "block"
+POLICIES = [DROP_OLDEST, COALESCE_LATEST, BLOCK]
+
+# Queue settings
+DEFAULT_QUEUE_SIZE = 16
+BLOCK_TIMEOUT      = 5.0
+
+# Webhook settings
+WEBHOOK_TIMEOUT     = 10
+WEBHOOK_RETRY_DELAY = 2.0   # doubled with each retry
+
+# Snapshot file format version
+SNAPSHOT_VERSION = 1
+
+
+###########################################################
+# Save data to snapshot file (atomically)
+###########################################################
+def save_snapshot(filename, data, saved=None):
+   snapshot = { "version": SNAPSHOT_VERSION, "saved": int(time.time()) if saved is None else saved, "data": data }
+   tmp = filename + ".tmp"
+   with gzip.open(tmp, "wb", compresslevel=6) as f:
+      f.write(json.dumps(snapshot, separators=(",",":")).encode())
+   with open(tmp, "rb") as f:
+      os.fsync(f.fileno())
+   os.replace(tmp, filename)
+
+
+###########################################################
+# Load data from snapshot file
+# Returns (data, time saved) or (None, None)
+###########################################################
+def load_snapshot(filename):
+   try:
+      with gzip.open(filename, "rb") as f:
+         snapshot = json.loads(f.read())
+      if snapshot["version"] != SNAPSHOT_VERSION:
+         raise ValueError("version %s" % snapshot["version"])
+      return snapshot["data"], snapshot["saved"]
+   except FileNotFoundError:
+      return None, None
+   except (OSError, ValueError, KeyError, TypeError) as e:
+      log.error("ERROR: failed to load snapshot file %s (%s)" % (filename, e))
+      return None, None
+
+
+###########################################################
+# Class Sink
+#
+# Base class of all sinks
+###########################################################
+class Sink(object):
+
+   def __init__(self, name):
+      self.name = name
+
+   ###########################################################
+   # Process one item (called from the sink's worker thread)
+   ###########################################################
+   def send(self, item):
+      raise NotImplementedError
+
+   def close(self):
+      pass
+
+
+###########################################################
+# Class NightscoutSink
+#
+# Uploads new data to Nightscout (see carelink_nightscout)
+###########################################################
+class NightscoutSink(Sink):
+
+   def __init__(self, uploader, name="nightscout"):
+      Sink.__init__(self, name)
+      self.__uploader = uploader
+
+   def send(self, data):
+      self.__uploader.upload(data)
+
+
+###########################################################
+# Class WebhookSink
+#
+# POSTs each item as JSON to a URL, failed requests (connection
+# errors, status 429 and 5xx) are retried up to retries times
+###########################################################
+class WebhookSink(Sink):
+
+   def __init__(self, url, name=None, httpClient=None, retries=0, retry_delay=WEBHOOK_RETRY_DELAY, sleep=time.sleep):
+      Sink.__init__(self, url if name is None else name)
+      self.__url = url
+      self.__httpClient = requests.Session() if httpClient is None else httpClient
+      self.__retries = retries
+      self.__retry_delay = retry_delay
+      self.__sleep = sleep
+
+   def send(self, item):
+      body = json.dumps(item)
+      delay = self.__retry_delay
+      for attempt in range(self.__retries + 1):
+         if attempt > 0:
+            log.warning("WARNING: webhook %s failed, retry %d of %d" % (self.__url, attempt, self.__retries))
+            self.__sleep(delay)
+            delay *= 2
+         try:
+            response = self.__httpClient.post(self.__url, data=body,
+                                              headers={"Content-Type": "application/json"}, timeout=WEBHOOK_TIMEOUT)
+         except requests.exceptions.RequestException as e:
+            error = e
+            continue
+         if response.status_code < 300:
+            return
+         error = "webhook %s returned %d" % (self.__url, response.status_code)
+         if response.status_code != 429 and response.status_code < 500:
+            break
+      raise Exception(error)
+
+
+###########################################################
+# Class SnapshotFileSink
+#
+# Saves the latest data to a snapshot file
+###########################################################
+class SnapshotFileSink(Sink):
+
+   def __init__(self, filename, name=None):
+      Sink.__init__(self, filename if name is None else name)
+      self.__filename = filename
+
+   def send(self, data):
+      save_snapshot(self.__filename, data)
+
+
+###########################################################
+# Class SinkWorker
+#
+# Bounded queue of one sink and its worker thread
+###########################################################
+class SinkWorker(object):
+
+   def __init__(self, sink, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST, block_timeout=BLOCK_TIMEOUT):
+      if policy not in POLICIES:
+         raise ValueError("unknown overflow policy %s" % policy)
+      self.sink = sink
+      self.maxsize = maxsize
+      self.policy = policy
+      self.block_timeout = block_timeout
+      self.__queue = deque()
+      self.__cond = threading.Condition()
+      self.__closed = False
+      self.stats = { "queued": 0, "sent": 0, "errors": 0, "dropped": 0, "coalesced": 0, "blocked": 0.0 }
+
+      self.__thread = threading.Thread(target=self._worker_thread, args=())
+      self.__thread.daemon = True
+      self.__thread.start()
+
+   ###########################################################
+   # Queue an item according to the overflow policy
+   ###########################################################
+   def put(self, item):
+      with self.__cond:
+         if self.policy == COALESCE_LATEST and self.__queue:
+            self.stats["coalesced"] += len(self.__queue)
+            self.__queue.clear()
+         elif self.policy == BLOCK and len(self.__queue) >= self.maxsize:
+            start = time.monotonic()
+            self.__cond.wait_for(lambda: len(self.__queue) < self.maxsize or self.__closed, self.block_timeout)
+            self.stats["blocked"] += time.monotonic() - start
+         if len(self.__queue) >= self.maxsize:
+            self.__queue.popleft()
+            self.stats["dropped"] += 1
+            log.warning("WARNING: sink %s is too slow, dropped oldest item" % self.sink.name)
+         self.__queue.append(item)
+         self.stats["queued"] += 1
+         self.__cond.notify_all()
+
+   ###########################################################
+   # Worker thread: pass queued items to the sink
+   ###########################################################
+   def _worker_thread(self):
+      while True:
+         with self.__cond:
+            self.__cond.wait_for(lambda: self.__queue or self.__closed)
+            if not self.__queue:
+               break
+            item = self.__queue.popleft()
+            # Wake up blocked publisher
+            self.__cond.notify_all()
+         try:
+            self.sink.send(item)
+            self.stats["sent"] += 1
+         except Exception as e:
+            self.stats["errors"] += 1
+            log.error("ERROR: sink %s failed (%s)" % (self.sink.name, e))
+
+   def pending(self):
+      with self.__cond:
+         return len(self.__queue)
+
+   ###########################################################
+   # Stop worker after the queued items are processed
+   ###########################################################
+   def close(self, timeout=None):
+      with self.__cond:
+         self.__closed = True
+         self.__cond.notify_all()
+      self.__thread.join(timeout)
+      self.sink.close()
+
+
+###########################################################
+# Class SinkPipeline
+#
+# Fans out each published item to all sinks
+###########################################################
+class SinkPipeline(object):
+
+   def __init__(self):
+      self.__workers = []
+
+   def add(self, sink, maxsize=DEFAULT_QUEUE_SIZE, policy=DROP_OLDEST, block_timeout=BLOCK_TIMEOUT):
+      worker = SinkWorker(sink, maxsize, policy, block_timeout)
+      self.__workers.append(worker)
+      return worker
+
+   def publish(self, item):
+      for worker in self.__workers:
+         worker.put(item)
+
+   def stats(self):
+      return { w.sink.name: dict(w.stats, pending=w.pending(), policy=w.policy) for w in self.__workers }
+
+   def close(self, timeout=None):
+      for worker in self.__workers:
+         worker.close(timeout)
@@ -0,0 +1,195 @@
+###############################################################################
+#
+#  Carelink glucose statistics
+#
+#  Description:
+#
+#    This module maintains glucose statistics over rolling time windows
+#    (24h, 7 days, 14 days, 30 days by default) from the sensor glucose
+#    readings in the Carelink data:
+#
+#    - count, mean, standard deviation (SD), coefficient of variation (CV)
+#    - glucose management indicator (GMI)
+#    - time in range (TIR), time below range (TBR), time above range (TAR)
+#
+#    The statistics are updated incrementally: each window keeps running
+#    sums which are updated when a reading is added or drops out of the
+#    window, so the cost per new reading does not depend on the window size.
+#    Readings expire relative to the current time, so the statistics of a
+#    window become empty when no new readings arrive (e.g. sensor stopped).
+#    The range bounds are taken from the patient's limits in the Carelink
+#    data (default 70-180 mg/dL).
+#
+#    Usage:
+#
+#      stats = carelink_stats.StatsTracker()
+#      stats.add_data(recentData)
+#      print(stats.get_stats())
+#
+#  Author:
+#
+#    Ondrej Wisniewski (ondrej.wisniewski *at* gmail.com)
+#
+#  Changelog:
+#
+#    19/10/2026 - Initial version
+#    19/10/2026 - Expire readings relative to the current time
+#
+#  Copyright 2026, Ondrej Wisniewski
+#
+###############################################################################
+
+import math
+import time
+import carelink_history
+from collections import deque
+
+
+# Rolling windows: name -> length in seconds
+WINDOWS = { "24h": 86400, "7d": 7*86400, "14d": 14*86400, "30d": 30*86400 }
+
+# Default target range (mg/dL)
+DEFAULT_LOW_LIMIT  = 70
+DEFAULT_HIGH_LIMIT = 180
+
+# Reading categories
+BELOW, IN_RANGE, ABOVE = 0, 1, 2
+
+
+###########################################################
+# Get target range from the limits in Carelink data
+###########################################################
+def get_limits(data):
+   limits = carelink_history.get_patient_data(data).get("limits") or []
+   for l in limits:
+      try:
+         return int(l["lowLimit"]), int(l["highLimit"])
+      except (KeyError, TypeError, ValueError):
+         pass
+   return None
+
+
+###########################################################
+# Class WindowStats
+###########################################################
+class WindowStats(object):
+
+   def __init__(self, length, low=DEFAULT_LOW_LIMIT, high=DEFAULT_HIGH_LIMIT):
+      self.length = length
+      self.low = low
+      self.high = high
+      self.__readings = deque()
+      # Running sums (integers, so they never drift)
+      self.__sum = 0
+      self.__sumsq = 0
+      self.__categories = [0, 0, 0]
+
+   def _category(self, sg):
+      if sg < self.low:
+         return BELOW
+      if sg > self.high:
+         return ABOVE
+      return IN_RANGE
+
+   ###########################################################
+   # Add a reading (in time order) and drop expired ones
+   ###########################################################
+   def add(self, ts, sg):
+      self.__readings.append((ts, sg))
+      self.__sum += sg
+      self.__sumsq += sg * sg
+      self.__categories[self._category(sg)] += 1
+      self.expire(ts)
+
+   ###########################################################
+   # Drop readings which are outside the window at time now
+   ###########################################################
+   def expire(self, now):
+      while self.__readings and self.__readings[0][0] <= now - self.length:
+         old_ts, old_sg = self.__readings.popleft()
+         self.__sum -= old_sg
+         self.__sumsq -= old_sg * old_sg
+         self.__categories[self._category(old_sg)] -= 1
+
+   ###########################################################
+   # Change target range (recounts the window once)
+   ###########################################################
+   def set_limits(self, low, high):
+      if (low, high) == (self.low, self.high):
+         return
+      self.low, self.high = low, high
+      self.__categories = [0, 0, 0]
+      for ts, sg in self.__readings:
+         self.__categories[self._category(sg)] += 1
+
+   ###########################################################
+   # Get statistics of the window (at time now, default: time
+   # of the latest reading)
+   ###########################################################
+   def get_stats(self, now=None):
+      if now is not None:
+         self.expire(now)
+      n = len(self.__readings)
+      stats = { "count": n, "from": None, "to": None, "lowLimit": self.low, "highLimit": self.high }
+      if n == 0:
+         return stats
+      mean = self.__sum / n
+      sd = math.sqrt(max(0, self.__sumsq * n - self.__sum * self.__sum)) / n
+      stats.update({
+         "from": self.__readings[0][0],
+         "to":   self.__readings[-1][0],
+         "mean": round(mean, 1),
+         "sd":   round(sd, 1),
+         "cv":   round(100 * sd / mean, 1),
+         "gmi":  round(3.31 + 0.02392 * mean, 1),
+         "tbr":  round(100 * self.__categories[BELOW] / n, 1),
+         "tir":  round(100 * self.__categories[IN_RANGE] / n, 1),
+         "tar":  round(100 * self.__categories[ABOVE] / n, 1),
+         })
+      return stats
+
+
+###########################################################
+# Class StatsTracker
+###########################################################
+class StatsTracker(object):
+
+   def __init__(self, windows=WINDOWS, clock=time.time):
+      self.__windows = { name: WindowStats(length) for name, length in windows.items() }
+      self.__clock = clock
+      self.__last_ts = None
+      # Time span needed to fill all windows
+      self.span = max(windows.values())
+
+   ###########################################################
+   # Add readings (e.g. from the history store). Only readings
+   # newer than the latest one added so far are taken into
+   # account, invalid readings (sg 0) are skipped.
+   ###########################################################
+   def add_readings(self, readings):
+      added = 0
+      for r in sorted(readings, key=lambda r: r.timestamp):
+         if (self.__last_ts is not None and r.timestamp <= self.__last_ts) or not r.sg or r.sg <= 0:
+            continue
+         for w in self.__windows.values():
+            w.add(r.timestamp, r.sg)
+         self.__last_ts = r.timestamp
+         added += 1
+      return added
+
+   ###########################################################
+   # Add new readings and update limits from Carelink data
+   ###########################################################
+   def add_data(self, data):
+      limits = get_limits(data)
+      if limits is not None:
+         for w in self.__windows.values():
+            w.set_limits(*limits)
+      return self.add_readings(carelink_history.iter_sgs(data))
+
+   ###########################################################
+   # Get statistics of all windows at the current time
+   ###########################################################
+   def get_stats(self):
+      now = self.__clock()
+      return { name: w.get_stats(now) for name, w in self.__windows.items() }
@@ -23,8 +23,9 @@
 #    29/09/2023 - Add recaptcha workaround
 #    02/10/2023 - Add refresh of auth token
 #    09/10/2023 - Replace login procedure with initial token
+#    19/10/2026 - Add pluggable HTTP client (record/replay support)
 #
-#  Copyright 2021-2023, Ondrej Wisniewski 
+#  Copyright 2021-2026, Ondrej Wisniewski 
 #
 ###############################################################################
 
@@ -61,7 +62,7 @@ def printdbg(msg):
 
 class CareLinkClient(object):
    
-   def __init__(self, carelinkToken, carelinkCountry, carelinkPatient):
+   def __init__(self, carelinkToken, carelinkCountry, carelinkPatient, httpClient=None):
       
       self.__version = VERSION
       
@@ -99,7 +100,8 @@ class CareLinkClient(object):
           }
       '''
       # Create main http client session with CookieJar
-      self.__httpClient = requests.Session()
+      # (or use the provided one, e.g. carelink_replay.ReplaySession)
+      self.__httpClient = requests.Session() if httpClient is None else httpClient
    
    def getVersion(self):
       return self.__version